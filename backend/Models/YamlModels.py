@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Dict, Optional,List,Any
+from typing import Dict, Optional,List,Any,Literal,Union
 
 class SweepConfig(BaseModel):
     methodId: str
@@ -10,3 +10,21 @@ class YamlGenerateRequest(BaseModel):
     data: List[Dict[str, Any]]
     fileName: str
     sweepConfig: Optional[SweepConfig] = None
+
+class SweepRangeValues(BaseModel):
+    start: Union[int, float]
+    stop: Union[int, float]
+    step: Union[int, float]
+
+class SweepAxis(BaseModel):
+    methodId: str
+    paramName: str
+    values: Optional[List[Any]] = None
+    range: Optional[SweepRangeValues] = None
+
+class YamlBatchRequest(BaseModel):
+    data: List[Dict[str, Any]]
+    fileName: str
+    axes: List[SweepAxis]
+    mode: Literal["grid", "zip"] = "grid"
+    sweepConfig: Optional[SweepConfig] = None
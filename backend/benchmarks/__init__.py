@@ -0,0 +1,4 @@
+"""
+Benchmarks for the backend. Each module can be run with python -m from the
+backend directory, and exposes plain functions that tests can call.
+"""
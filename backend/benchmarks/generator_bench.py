@@ -0,0 +1,277 @@
+"""
+Benchmark of the method-template generator (utils.generator) against a
+synthetic module of numpy-docstring functions. No GPU or method library is
+needed.
+
+Run from the backend directory:
+
+    python -m benchmarks.generator_bench --methods 300 --save baseline.json
+    python -m benchmarks.generator_bench --compare baseline.json
+
+From pytest, call run_benchmarks() and compare_to_baseline() directly.
+"""
+import argparse
+import inspect
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+from typing import Callable, Dict, List, Optional
+
+from utils.generator import _convert_type_to_string, generate_method_template, parse_docstring
+from utils.method_catalog import get_methods_templates
+
+# Name under which the synthetic module is registered in sys.modules
+SYNTHETIC_MODULE = "tomohub_bench_synthetic"
+
+# Annotations cycled through the synthetic signatures
+ANNOTATIONS = (
+    "int",
+    "float",
+    "str",
+    "bool",
+    "Optional[int]",
+    "Optional[float]",
+    "Union[int, float]",
+    "Union[int, float, None]",
+    "Optional[Union[str, List[int]]]",
+    "List[float]",
+    "Tuple[int, int]",
+    "Tuple[int, ...]",
+    "Dict[str, List[float]]",
+    "Dict[str, Optional[Tuple[int, float]]]",
+    "Literal['mean', 'median']",
+    "Callable[[np.ndarray], np.ndarray]",
+    "np.ndarray",
+    "Sequence[Union[int, str]]",
+)
+
+# Names the generator treats specially, mixed into the signatures
+SPECIAL_PARAMS = ("data", "axis", "center", "overlap", "asynchronous", "gpu_id")
+
+
+def synthetic_source(methods: int, params_per_method: int = 8) -> str:
+    """
+    Return the source of a module with the given number of functions, each
+    with params_per_method annotated parameters and a numpy docstring.
+    """
+    lines = [
+        "from typing import Callable, Dict, List, Literal, Optional, Sequence, Tuple, Union",
+        "import numpy as np",
+        "",
+    ]
+    for index in range(methods):
+        params = [f"{SPECIAL_PARAMS[index % len(SPECIAL_PARAMS)]}: np.ndarray"]
+        docs = [
+            f"    {SPECIAL_PARAMS[index % len(SPECIAL_PARAMS)]} : np.ndarray",
+            "        Input data, read along the first axis.",
+        ]
+        for number in range(params_per_method):
+            annotation = ANNOTATIONS[(index + number) % len(ANNOTATIONS)]
+            name = f"param_{number}"
+            default = "" if number < params_per_method // 3 else " = None"
+            params.append(f"{name}: {annotation}{default}")
+            docs.extend([
+                f"    {name} : {annotation}",
+                f"        Parameter {number} of method {index}. It controls the behaviour of the",
+                f"        filter :cite:`Author{number}:2024` and is ignored when set to None.",
+            ])
+        lines.extend([
+            f"def method_{index}({', '.join(params)}) -> np.ndarray:",
+            '    """',
+            f"    Apply synthetic operation {index} to the data. Additional detail follows here.",
+            "",
+            "    Parameters",
+            "    ----------",
+            *docs,
+            "",
+            "    Returns",
+            "    -------",
+            "    np.ndarray",
+            "        The processed data.",
+            "",
+            "    Raises",
+            "    ------",
+            "    ValueError",
+            "        If the data is empty.",
+            '    """',
+            "    return data",
+            "",
+        ])
+    return "\n".join(lines)
+
+
+def install_synthetic_module(methods: int, params_per_method: int = 8) -> types.ModuleType:
+    """Build the synthetic module and register it in sys.modules so it can be imported"""
+    module = types.ModuleType(SYNTHETIC_MODULE)
+    exec(compile(synthetic_source(methods, params_per_method), SYNTHETIC_MODULE, "exec"), module.__dict__)
+    sys.modules[SYNTHETIC_MODULE] = module
+    return module
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+
+def _latency(fn: Callable[[], object], repeat: int) -> float:
+    """Return the fastest of repeat timed calls of fn, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def _allocations(fn: Callable[[], object]) -> Dict[str, float]:
+    """
+    Return the peak memory traced while fn runs and the bytes and blocks it
+    leaves allocated afterwards (its result and any caches it fills).
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    return {
+        "retained_bytes": sum(stat.size_diff for stat in diff if stat.size_diff > 0),
+        "retained_blocks": sum(stat.count_diff for stat in diff if stat.count_diff > 0),
+        "peak_bytes": peak,
+    }
+
+
+def run_benchmarks(methods: int = 300, params_per_method: int = 8, repeat: int = 5) -> Dict:
+    """
+    Benchmark the generator on a synthetic module.
+
+    Parameters
+    ----------
+    methods : int
+        The number of synthetic functions
+    params_per_method : int
+        The annotated parameters of each function
+    repeat : int
+        Timing rounds; the fastest round is reported
+
+    Returns
+    -------
+    Dict
+        "metrics" maps metric names to values (seconds or bytes; lower is
+        better) and "slowest_methods" lists the five slowest templates.
+    """
+    module = install_synthetic_module(methods, params_per_method)
+    names = [f"method_{index}" for index in range(methods)]
+    docstrings = [getattr(module, name).__doc__ for name in names]
+    annotations = [
+        parameter.annotation
+        for name in names
+        for parameter in inspect.signature(getattr(module, name)).parameters.values()
+    ]
+
+    per_method = {
+        name: _latency(lambda name=name: generate_method_template(SYNTHETIC_MODULE, name), repeat)
+        for name in names
+    }
+    latencies = list(per_method.values())
+    parse_seconds = _latency(lambda: [parse_docstring(doc) for doc in docstrings], repeat)
+    convert_seconds = _latency(lambda: [_convert_type_to_string(a) for a in annotations], repeat)
+    catalog_seconds = _latency(lambda: get_methods_templates({SYNTHETIC_MODULE: names}), repeat)
+    allocations = _allocations(lambda: get_methods_templates({SYNTHETIC_MODULE: names}))
+    template_allocations = _allocations(lambda: generate_method_template(SYNTHETIC_MODULE, names[0]))
+
+    metrics = {
+        "template_mean_seconds": statistics.fmean(latencies),
+        "template_p50_seconds": _percentile(latencies, 50),
+        "template_p95_seconds": _percentile(latencies, 95),
+        "template_max_seconds": max(latencies),
+        "parse_docstring_mean_seconds": parse_seconds / len(docstrings),
+        "convert_type_mean_seconds": convert_seconds / len(annotations),
+        "catalog_build_seconds": catalog_seconds,
+        "catalog_peak_bytes": allocations["peak_bytes"],
+        "catalog_retained_bytes": allocations["retained_bytes"],
+        "catalog_retained_blocks": allocations["retained_blocks"],
+        "template_peak_bytes": template_allocations["peak_bytes"],
+    }
+    slowest = sorted(per_method.items(), key=lambda item: item[1], reverse=True)[:5]
+    return {
+        "config": {"methods": methods, "params_per_method": params_per_method, "repeat": repeat},
+        "metrics": metrics,
+        "slowest_methods": [{"method": name, "seconds": seconds} for name, seconds in slowest],
+    }
+
+
+def save_baseline(results: Dict, path: str) -> None:
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, tolerance: float = 1.5) -> Dict[str, Dict]:
+    """
+    Compare results with a baseline from the same machine and configuration.
+
+    Returns
+    -------
+    Dict[str, Dict]
+        The metrics more than tolerance times worse than the baseline, with
+        both values and their ratio. Empty when there is no regression.
+    """
+    regressions = {}
+    for name, value in results["metrics"].items():
+        reference = baseline["metrics"].get(name)
+        if not reference:
+            continue
+        ratio = value / reference
+        if ratio > tolerance:
+            regressions[name] = {"baseline": reference, "current": value, "ratio": ratio}
+    return regressions
+
+
+def _format_metric(name: str, value: float) -> str:
+    if name.endswith("_seconds"):
+        return f"{value * 1e6:12.1f} us"
+    return f"{value:12.0f}"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the method-template generator")
+    parser.add_argument("--methods", type=int, default=300, help="Synthetic functions to generate")
+    parser.add_argument("--params", type=int, default=8, help="Annotated parameters per function")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing rounds per measurement")
+    parser.add_argument("--save", help="Write the results to this baseline file")
+    parser.add_argument("--compare", help="Compare the results with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed slowdown ratio")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.methods, args.params, args.repeat)
+    for name, value in results["metrics"].items():
+        print(f"{name:32s} {_format_metric(name, value)}")
+    for entry in results["slowest_methods"]:
+        print(f"slowest: {entry['method']:20s} {entry['seconds'] * 1e6:10.1f} us")
+
+    if args.save:
+        save_baseline(results, args.save)
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get("config") != results["config"]:
+            print("Warning: baseline was recorded with a different configuration")
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for name, entry in regressions.items():
+            print(f"REGRESSION {name}: {entry['baseline']:.3g} -> {entry['current']:.3g} ({entry['ratio']:.2f}x)")
+        if regressions:
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+A local stand-in for the S3 object store, serving in-memory objects over
+HTTP with single Range requests, ETags and conditional headers, plus
+synthetic multi-page TIFFs to serve from it.
+"""
+import hashlib
+import io
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import tifffile
+
+
+def synthetic_tiff(
+    pages: int,
+    height: int,
+    width: int,
+    dtype: str = "uint16",
+    compression: Optional[str] = None,
+    tile: Optional[Tuple[int, int]] = None,
+    seed: int = 0,
+) -> bytes:
+    """
+    Return a multi-page TIFF of smooth random images, one IFD per page.
+
+    Parameters
+    ----------
+    pages, height, width : int
+        The stack shape
+    dtype : str
+        uint8, uint16 (Pillow mode I;16) or float32
+    compression : Optional[str]
+        Any tifffile compression, e.g. zlib or lzma; None for uncompressed
+    tile : Optional[Tuple[int, int]]
+        Write tiles of this shape instead of strips
+    """
+    rng = np.random.default_rng(seed)
+    # A coarse random field upsampled per page compresses like real projections
+    coarse = rng.random((pages, -(-height // 16), -(-width // 16)), dtype=np.float32)
+    field = np.repeat(np.repeat(coarse, 16, axis=1), 16, axis=2)[:, :height, :width]
+    noise = rng.random(field.shape, dtype=np.float32) * 0.05
+    values = field + noise
+    if dtype == "uint8":
+        stack = (values * 250).astype(np.uint8)
+    elif dtype == "uint16":
+        stack = (values * 60000).astype(np.uint16)
+    elif dtype == "float32":
+        stack = (values * 2.0 - 1.0).astype(np.float32)
+    else:
+        raise ValueError(f"Unsupported dtype: {dtype}")
+
+    buffer = io.BytesIO()
+    with tifffile.TiffWriter(buffer) as writer:
+        for page in stack:
+            writer.write(page, compression=compression, tile=tile, photometric="minisblack")
+    return buffer.getvalue()
+
+
+class _ObjectHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store: "ObjectStore"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _object(self) -> Optional[Tuple[bytes, str]]:
+        entry = self.store.objects.get(self.path.lstrip("/").split("?")[0])
+        if entry is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        return entry
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def _serve(self, head: bool) -> None:
+        entry = self._object()
+        if entry is None:
+            return
+        data, etag = entry
+        self.store.count(self.command, self.headers.get("Range"))
+        size = len(data)
+
+        if_match = self.headers.get("If-Match")
+        if if_match and if_match not in ("*", etag):
+            self._empty(412, etag)
+            return
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and if_none_match in ("*", etag):
+            self._empty(304, etag)
+            return
+
+        status, start, end = 200, 0, size - 1
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        body = data[start:end + 1]
+        self.send_response(status)
+        self.send_header("Content-Type", "image/tiff")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not head:
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away, e.g. a cancelled fetch
+                pass
+
+    def _empty(self, status: int, etag: str) -> None:
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class ObjectStore:
+    """
+    Serves objects from memory on 127.0.0.1 in a background thread. Use as a
+    context manager, or call start() and stop().
+    """
+
+    def __init__(self):
+        self.objects: Dict[str, Tuple[bytes, str]] = {}
+        self.requests = 0
+        self.range_requests = 0
+        self._lock = threading.Lock()
+        handler = type("Handler", (_ObjectHandler,), {"store": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def put(self, name: str, data: bytes) -> str:
+        """Store an object and return its URL"""
+        self.objects[name] = (data, f'"{hashlib.md5(data).hexdigest()}"')
+        return self.base_url + name
+
+    def count(self, method: str, range_header: Optional[str]) -> None:
+        with self._lock:
+            self.requests += 1
+            if range_header:
+                self.range_requests += 1
+
+    def start(self) -> "ObjectStore":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "ObjectStore":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
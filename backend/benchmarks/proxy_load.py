@@ -0,0 +1,337 @@
+"""
+Offline load test of the TIFF proxy endpoints. Synthetic multi-page TIFFs are
+served by a local object-store stand-in (benchmarks.object_store) and the
+FastAPI app runs in-process, so no network, S3 or browser is needed.
+
+Each scenario fixes a stack (page count, dimensions, dtype, compression) and
+runs concurrent virtual users that move through it the way the viewer's
+slider does: stepping page by page, scrubbing back and forth, or jumping.
+Latency percentiles, throughput and peak RSS are reported per scenario.
+
+Run from the backend directory:
+
+    python -m benchmarks.proxy_load --quick
+    python -m benchmarks.proxy_load --users 16 --requests 50 --save load.json
+    python -m benchmarks.proxy_load --compare load.json
+"""
+import os
+
+# The method catalog is not under test; keep its warm-up off the event loop
+os.environ.setdefault("TOMOHUB_METHOD_WARMUP", "0")
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.generator_bench import compare_to_baseline, save_baseline
+from benchmarks.object_store import ObjectStore, synthetic_tiff
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """One stack and the way the virtual users read it"""
+    pages: int
+    height: int
+    width: int
+    dtype: str = "uint16"
+    compression: Optional[str] = None
+    pattern: str = "scrub"
+    endpoint: str = "tiff-pages"
+    format: str = "png"
+    downsample_rate: int = 1
+
+    @property
+    def name(self) -> str:
+        return (
+            f"{self.endpoint}-{self.pattern}-{self.pages}x{self.height}x{self.width}"
+            f"-{self.dtype}-{self.compression or 'none'}-{self.format}-ds{self.downsample_rate}"
+        )
+
+
+def default_scenarios(quick: bool = False) -> List[Scenario]:
+    """
+    The scenario matrix: every dtype and compression on a small stack,
+    access patterns, encodings and downsampling on one of them, and the
+    whole-file proxy, which ignores the page sequence.
+    """
+    size = 256 if quick else 1024
+    pages = 16 if quick else 128
+    scenarios = [
+        Scenario(pages, size, size, dtype, compression)
+        for dtype, compression in itertools.product(("uint8", "uint16", "float32"), (None, "zlib", "lzma"))
+    ]
+    scenarios += [Scenario(pages, size, size, "uint16", "zlib", pattern) for pattern in ("sequential", "jump")]
+    scenarios += [
+        Scenario(pages, size, size, "uint16", "zlib", "scrub", format=fmt) for fmt in ("png-fast", "jpeg", "raw-uint8")
+    ]
+    scenarios.append(Scenario(pages, size, size, "uint16", "zlib", "scrub", downsample_rate=4))
+    scenarios.append(Scenario(pages, size, size, "uint16", None, "sequential", endpoint="tiff"))
+    return scenarios
+
+
+def page_sequence(pattern: str, pages: int, count: int, rng: random.Random) -> List[int]:
+    """
+    Return the pages one virtual user requests.
+
+    Parameters
+    ----------
+    pattern : str
+        sequential: step forward one page at a time from a random start;
+        scrub: drag the slider back and forth by a few pages per event;
+        jump: uniformly random pages
+    """
+    if pattern == "jump":
+        return [rng.randrange(pages) for _ in range(count)]
+    page = rng.randrange(pages)
+    direction = 1
+    sequence = []
+    for _ in range(count):
+        sequence.append(page)
+        if pattern == "sequential":
+            page = (page + 1) % pages
+            continue
+        if rng.random() < 0.1:
+            direction = -direction
+        page = page + direction * rng.randint(1, 4)
+        if page < 0 or page >= pages:
+            direction = -direction
+            page = min(max(page, 0), pages - 1)
+    return sequence
+
+
+class RssSampler:
+    """
+    Track the peak resident set size of this process from a background
+    thread. Uses /proc where available, otherwise the process-wide
+    ru_maxrss, which never goes down between scenarios.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def current(self) -> int:
+        try:
+            with open("/proc/self/statm") as file:
+                return int(file.read().split()[1]) * self._page_size
+        except OSError:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self.peak = self.current()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+
+async def _virtual_user(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    url: str,
+    pages: List[int],
+    think_time: float,
+    latencies: List[float],
+    errors: List[str],
+) -> int:
+    """Open the stack like the viewer does, then request its pages; return bytes received"""
+    received = 0
+    if scenario.endpoint == "tiff-pages":
+        response = await client.get("/proxy/tiff-pages", params={"url": url})
+        if response.status_code != 200:
+            errors.append(f"metadata: {response.status_code}")
+    for page in pages:
+        if scenario.endpoint == "tiff":
+            request = client.get("/proxy/tiff", params={"url": url})
+        else:
+            request = client.get("/proxy/tiff-pages", params={
+                "url": url,
+                "page": page,
+                "format": scenario.format,
+                "downsample_rate": scenario.downsample_rate,
+            })
+        started = time.perf_counter()
+        response = await request
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            errors.append(f"page {page}: {response.status_code}")
+        received += len(response.content)
+        if think_time:
+            await asyncio.sleep(think_time)
+    return received
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    store: ObjectStore,
+    scenario: Scenario,
+    users: int,
+    requests_per_user: int,
+    think_time: float = 0.0,
+    seed: int = 0,
+) -> Dict:
+    """
+    Serve the scenario's stack under a fresh name, so every scenario starts
+    with cold caches, and run the virtual users concurrently against it.
+    """
+    data = synthetic_tiff(scenario.pages, scenario.height, scenario.width, scenario.dtype, scenario.compression, seed=seed)
+    url = store.put(f"{scenario.name}-{seed}.tif", data)
+    rng = random.Random(seed)
+    sequences = [page_sequence(scenario.pattern, scenario.pages, requests_per_user, rng) for _ in range(users)]
+    latencies: List[float] = []
+    errors: List[str] = []
+    upstream_before = store.requests
+
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        received = await asyncio.gather(*(
+            _virtual_user(client, scenario, url, pages, think_time, latencies, errors) for pages in sequences
+        ))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": asdict(scenario),
+        "object_bytes": len(data),
+        "metrics": {
+            "latency_p50_seconds": _percentile(latencies, 50),
+            "latency_p95_seconds": _percentile(latencies, 95),
+            "latency_p99_seconds": _percentile(latencies, 99),
+            "latency_mean_seconds": statistics.fmean(latencies),
+            "latency_max_seconds": max(latencies),
+            "peak_rss_bytes": rss.peak,
+        },
+        "throughput_rps": len(latencies) / elapsed,
+        "throughput_bytes_per_second": sum(received) / elapsed,
+        "requests": len(latencies),
+        "upstream_requests": store.requests - upstream_before,
+        "errors": len(errors),
+        "first_errors": errors[:5],
+    }
+
+
+async def run_load_test(
+    scenarios: List[Scenario],
+    users: int = 8,
+    requests_per_user: int = 25,
+    think_time: float = 0.0,
+    seed: int = 0,
+) -> Dict:
+    """
+    Run the scenarios one after another against an in-process app.
+
+    Returns
+    -------
+    Dict
+        "scenarios" maps scenario names to their results; each has
+        "metrics" (lower is better, comparable with compare_to_baseline)
+        and throughput, request and error counts.
+    """
+    from main import app
+
+    results = {}
+    with ObjectStore() as store:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://tomohub/api", timeout=120) as client:
+                for scenario in scenarios:
+                    results[scenario.name] = await run_scenario(
+                        client, store, scenario, users, requests_per_user, think_time, seed
+                    )
+    return {
+        "config": {"users": users, "requests_per_user": requests_per_user, "think_time": think_time, "seed": seed},
+        "scenarios": results,
+    }
+
+
+def compare_load_to_baseline(results: Dict, baseline: Dict, tolerance: float = 1.5) -> Dict[str, Dict]:
+    """Compare every scenario present in both runs; returns regressions keyed by scenario"""
+    regressions = {}
+    for name, result in results["scenarios"].items():
+        reference = baseline["scenarios"].get(name)
+        if reference is None:
+            continue
+        found = compare_to_baseline(result, reference, tolerance)
+        if found:
+            regressions[name] = found
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the TIFF proxy endpoints offline")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent virtual users per scenario")
+    parser.add_argument("--requests", type=int, default=25, help="Page requests per user")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Pause between a user's requests, in seconds")
+    parser.add_argument("--quick", action="store_true", help="Small stacks, for a fast smoke run")
+    parser.add_argument("--only", help="Run only scenarios whose name contains this text")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the data and access patterns")
+    parser.add_argument("--save", help="Write the results to this baseline file")
+    parser.add_argument("--compare", help="Compare the results with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed slowdown ratio")
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in default_scenarios(args.quick) if not args.only or args.only in s.name]
+    if not scenarios:
+        print("No scenarios selected")
+        return 1
+    results = asyncio.run(run_load_test(scenarios, args.users, args.requests, args.think_time, args.seed))
+
+    print(f"{'scenario':68s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} {'req/s':>8s} {'MB/s':>8s} {'RSS MB':>8s} {'errors':>6s}")
+    for name, result in results["scenarios"].items():
+        metrics = result["metrics"]
+        print(
+            f"{name:68s} {metrics['latency_p50_seconds'] * 1000:8.1f} {metrics['latency_p95_seconds'] * 1000:8.1f}"
+            f" {metrics['latency_p99_seconds'] * 1000:8.1f} {result['throughput_rps']:8.1f}"
+            f" {result['throughput_bytes_per_second'] / 1e6:8.1f} {metrics['peak_rss_bytes'] / 1e6:8.0f}"
+            f" {result['errors']:6d}"
+        )
+        for error in result["first_errors"]:
+            print(f"    error: {error}")
+
+    if args.save:
+        save_baseline(results, args.save)
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get("config") != results["config"]:
+            print("Warning: baseline was recorded with a different configuration")
+        regressions = compare_load_to_baseline(results, baseline, args.tolerance)
+        for name, found in regressions.items():
+            for metric, entry in found.items():
+                print(f"REGRESSION {name} {metric}: {entry['baseline']:.3g} -> {entry['current']:.3g} ({entry['ratio']:.2f}x)")
+        if regressions:
+            return 1
+        print("No regressions")
+    return 0 if all(result["errors"] == 0 for result in results["scenarios"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
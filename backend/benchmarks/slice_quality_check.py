@@ -0,0 +1,78 @@
+"""
+Sanity check of the slice-quality metrics behind /proxy/tiff-pages/ranking.
+
+A synthetic focus sweep is built from one sharp slice blurred more and more
+on either side of an in-focus page. Every metric, and the combined ranking,
+must rank the in-focus page first; the exit status is 1 otherwise.
+
+Run from the backend directory:
+
+    python -m benchmarks.slice_quality_check
+"""
+import io
+import sys
+from typing import List
+
+import numpy as np
+import tifffile
+
+from utils.slice_quality import COMBINED, QUALITY_METRICS, quality_scores, rank_pages
+from utils.tiff_range import TiffSource
+
+# Pages of the sweep and the in-focus one. Blur grows by 2 pixels of radius
+# per page, so the farthest page is blurred over 21x21 pixels; much stronger
+# blur flattens the histogram enough for entropy to favour it again.
+SWEEP_PAGES = 11
+SWEEP_FOCUS = 5
+
+
+def box_blur(array: np.ndarray, radius: int) -> np.ndarray:
+    """Separable box blur with edge padding; radius 0 returns the array unchanged"""
+    if radius == 0:
+        return array
+    size = 2 * radius + 1
+    for axis in (0, 1):
+        padding = [(radius, radius) if index == axis else (0, 0) for index in range(2)]
+        sums = np.cumsum(np.pad(array, padding, mode="edge"), axis=axis, dtype=np.float64)
+        sums = np.insert(sums, 0, 0, axis=axis)
+        length = array.shape[axis]
+        array = (sums.take(range(size, size + length), axis=axis) - sums.take(range(length), axis=axis)) / size
+    return array
+
+
+def focus_sweep(pages: int, focus: int, size: int = 256, step: int = 2, seed: int = 0) -> bytes:
+    """A uint16 TIFF whose page focus is sharp and others blur with their distance to it"""
+    rng = np.random.default_rng(seed)
+    blocks = size // 16
+    sharp = np.kron(rng.random((blocks, blocks)), np.ones((16, 16)))
+    buffer = io.BytesIO()
+    with tifffile.TiffWriter(buffer) as tif:
+        for page in range(pages):
+            blurred = box_blur(sharp, abs(page - focus) * step)
+            tif.write((blurred * 60000).astype(np.uint16))
+    return buffer.getvalue()
+
+
+def check(pages: int, focus: int) -> List[str]:
+    """Return the metrics that do not rank the in-focus page first"""
+    source = TiffSource.from_bytes(focus_sweep(pages, focus))
+    scores = quality_scores(source, list(range(pages)), (0, 60000))
+    failures = []
+    for metric in (*QUALITY_METRICS, COMBINED):
+        best = rank_pages(scores, metric)[0]
+        print(f"{metric:<16} best page {best}")
+        if best != focus:
+            failures.append(metric)
+    return failures
+
+
+def main() -> None:
+    failures = check(SWEEP_PAGES, SWEEP_FOCUS)
+    if failures:
+        print(f"Did not pick page {SWEEP_FOCUS}: {', '.join(failures)}")
+        sys.exit(1)
+    print(f"Every metric picked page {SWEEP_FOCUS}")
+
+
+if __name__ == "__main__":
+    main()
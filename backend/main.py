@@ -1,10 +1,41 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routers.methods import methods_router
 from routers.yaml import yaml_router
 from routers.proxy import proxy_router
+from routers.health import health_router
+from routers.metrics import metrics_router
+from utils.config import EVENT_LOOP_LAG_INTERVAL, METHOD_WARMUP, METHOD_WARMUP_WORKERS
+from utils.metrics import monitor_event_loop, timing_middleware
+from utils.method_catalog import warm_up
+from utils.prefetch import prefetch_manager
+from utils.tiff_loader import cancel_stack_stats_refinements
+from utils.http_client import create_http_client
+from utils.workers import create_image_pool
 
-app = FastAPI(root_path="/api")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for all upstream requests, so connections are reused
+    app.state.http_client = create_http_client()
+    # CPU-bound image work runs here instead of on the event loop
+    app.state.image_pool = create_image_pool()
+    # Import the method backends and build the method catalog in the background
+    app.state.warmup = asyncio.create_task(warm_up(METHOD_WARMUP_WORKERS)) if METHOD_WARMUP else None
+    app.state.loop_monitor = asyncio.create_task(monitor_event_loop(EVENT_LOOP_LAG_INTERVAL))
+    yield
+    await prefetch_manager.shutdown()
+    await cancel_stack_stats_refinements()
+    app.state.loop_monitor.cancel()
+    if app.state.warmup is not None:
+        app.state.warmup.cancel()
+    app.state.image_pool.shutdown()
+    await app.state.http_client.aclose()
+
+
+app = FastAPI(root_path="/api", lifespan=lifespan)
 
 # Existing middleware and routers
 app.add_middleware(
@@ -14,10 +45,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Request timing for /metrics and Server-Timing headers
+app.middleware("http")(timing_middleware)
 
 
 
 app.include_router(methods_router)
 app.include_router(yaml_router)
 app.include_router(proxy_router)
+app.include_router(health_router)
+app.include_router(metrics_router)
 
@@ -0,0 +1,38 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from utils.admission import limiters
+from utils.method_catalog import method_catalog
+from utils.method_imports import module_importer
+
+health_router = APIRouter(
+    prefix="/health",
+    tags=["health"],
+)
+
+@health_router.get("")
+async def health():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+@health_router.get("/ready")
+async def ready(request: Request):
+    """
+    Readiness: 200 once the startup warm-up has finished, 503 before.
+    Reports the import time and any failure of each method module, and the
+    capacity in use and queue depth of each admission-controlled resource.
+    """
+    warmup = request.app.state.warmup
+    is_ready = warmup is None or warmup.done()
+    content = {
+        "ready": is_ready,
+        "warmup_seconds": None,
+        "catalog_versions": dict(method_catalog.versions) if method_catalog.versions else None,
+        "modules": [record.to_dict() for record in module_importer.imports()],
+        "admission": {name: limiter.to_dict() for name, limiter in limiters.items()},
+    }
+    if warmup is not None and warmup.done() and not warmup.cancelled():
+        if warmup.exception() is None:
+            content["warmup_seconds"] = round(warmup.result(), 3)
+        else:
+            content["warmup_error"] = str(warmup.exception())
+    return JSONResponse(content=content, status_code=200 if is_ready else 503)
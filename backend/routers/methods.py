@@ -1,9 +1,11 @@
+import asyncio
 from utils.methods import METHOD_CATEGORIES
-from fastapi import HTTPException,APIRouter
-from utils.generator import generate_method_template
-from typing import Dict, List
+from fastapi import HTTPException,APIRouter,Query,Request
+from fastapi.responses import Response
+from utils.method_catalog import ALL_CATEGORIES, method_catalog
+from utils.pipelines import pipeline_catalog
+from typing import Optional
 from Models.MethodsTemplate import AllTemplates
-from httomo_backends.scripts.json_pipelines_generator import process_all_yaml_files
 
 
 methods_router = APIRouter(
@@ -11,32 +13,35 @@ methods_router = APIRouter(
     tags=["methods"],
 )
 
-def get_methods_templates(module_methods: Dict[str, List[str]]) -> Dict:
+async def catalog_response(request: Request, category: str) -> Response:
     """
-    Helper function to generate templates for a given module and its methods
+    Serve one pre-serialised catalog entry in the smallest encoding the client
+    accepts. Each encoding has its own ETag; clients presenting the ETag of
+    the encoding they would get in If-None-Match get a 304.
     """
-    result = {}
-    for module, methods in module_methods.items():
-        module_templates = {}
-        try:
-            for method in methods:
-                template = generate_method_template(module, method)
-                if template:
-                    module_templates[method] = template
-            if module_templates:
-                result[module] = module_templates
-        except ImportError:
-            print(f"Could not import module {module}")
-    return result
+    # The first call builds the catalog, which imports every method module
+    entry = await asyncio.to_thread(method_catalog.get, category)
+    body, content_encoding = entry.encoded(request.headers.get("accept-encoding", ""))
+    etag = entry.etag_of(content_encoding)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # Generic endpoint generator
 def create_category_endpoint(category: str):
-    async def endpoint():
+    async def endpoint(request: Request):
         try:
-            methods = METHOD_CATEGORIES[category]
-            result = get_methods_templates(methods)
-            return AllTemplates(root=result)
+            return await catalog_response(request, category)
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     return endpoint
@@ -46,44 +51,38 @@ for category in METHOD_CATEGORIES.keys():
     endpoint = create_category_endpoint(category)
     methods_router.get(f"/{category}", response_model=AllTemplates)(endpoint)
 
-def filter_pipelines_with_tomopy(pipelines: dict) -> dict:
-    """
-    Filters out pipelines where any method has a module_path starting with 'tomopy.'.
-
-    Args:
-        pipelines (dict): The dictionary of pipelines to filter.
-
-    Returns:
-        dict: The filtered pipelines.
-    """
-    filtered_pipelines = {}
-    for pipeline_name, methods in pipelines.items():
-        # Check if any method in the pipeline has a module_path starting with 'tomopy.'
-        has_tomopy = any(
-            method.get("module_path", "").startswith("tomopy.")
-            for method in methods.values()
-        )
-        if not has_tomopy:
-            filtered_pipelines[pipeline_name] = methods
-
-    return filtered_pipelines
-
 @methods_router.get("/fullpipelines")
-async def get_full_pipelines():
+async def get_full_pipelines(
+    include_tomopy: bool = Query(False, description="Include pipelines using tomopy methods"),
+    gpu_only: bool = Query(False, description="Only pipelines running on httomolibgpu"),
+    category: Optional[str] = Query(None, description="Only pipelines with a method of this category"),
+):
+    try:
+        if category is not None and category not in METHOD_CATEGORIES:
+            raise HTTPException(status_code=404, detail=f"Unknown category: {category}")
+        index = await asyncio.to_thread(pipeline_catalog.get)
+        return index.select(include_tomopy=include_tomopy, gpu_only=gpu_only, category=category)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@methods_router.get("/fullpipelines/{name}")
+async def get_full_pipeline(name: str):
     try:
-        return filter_pipelines_with_tomopy(process_all_yaml_files())
+        index = await asyncio.to_thread(pipeline_catalog.get)
+        if name not in index.pipelines:
+            raise HTTPException(status_code=404, detail=f"Pipeline {name} not found")
+        return index.pipelines[name]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Main endpoint for all methods
 @methods_router.get("/", response_model=AllTemplates)
-async def get_all_methods():
+async def get_all_methods(request: Request):
     try:
-        all_templates = {}
-        for category_methods in METHOD_CATEGORIES.values():
-            category_templates = get_methods_templates(category_methods)
-            all_templates.update(category_templates)
-        return AllTemplates(root=all_templates)
+        return await catalog_response(request, ALL_CATEGORIES)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
\ No newline at end of file
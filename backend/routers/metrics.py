@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from utils.metrics import registry
+
+metrics_router = APIRouter(tags=["metrics"])
+
+@metrics_router.get("/metrics")
+async def metrics():
+    """Every backend metric in the Prometheus text exposition format"""
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
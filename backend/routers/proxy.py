@@ -1,190 +1,1107 @@
-from fastapi import APIRouter, HTTPException, Query
-from fastapi.responses import Response, JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+import asyncio
 import httpx
 import logging
-from PIL import Image
-from io import BytesIO
-import json
-import numpy as np
+import re
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+from utils.tiff_cache import tiff_cache, CachedTiff, UpstreamError
+from utils.config import PROXY_STREAM_CHUNK_BYTES
+from utils.tiff_descriptor import StackDescriptor
+from utils.tiff_loader import load_descriptor, load_pages_source, load_stack_stats
+from utils.tiff_pages import ENCODINGS, EncodedPage, render_page, render_pages, pack_pages
+from utils.tiff_stats import NORMALISATIONS, sample_pages
+from utils.montage import MONTAGE_ENCODINGS, Roi, check_montage_size, montage_grid, montage_tiles, render_montage, tile_shape
+from utils.slice_quality import COMBINED, QUALITY_METRICS, quality_scores, rank_pages
+from utils.pyramid import PagePyramid, build_page_pyramid, encode_tile, pyramid_cache
+from utils.http_client import get_http_client
+from utils.metrics import proxied_bytes, record_cache, record_span, span, stream_pages
+from utils.shared_store import shared_store
+from utils.singleflight import SingleFlight
+from utils.prefetch import PrefetchLimitError, get_page, page_key, prefetch_manager, put_page
+from utils.volume_store import SLICE_AXES, render_volume_slice, volume_store
+from utils.workers import ImageWorkerPool, get_image_pool
+from utils.admission import BATCH, Overloaded, priority, reserve_bytes
 
 logger = logging.getLogger(__name__)
 
 proxy_router = APIRouter(prefix="/proxy", tags=["proxy"])
 
-@proxy_router.get("/tiff")
-async def proxy_tiff(url: str = Query(..., description="The S3 URL to proxy")):
+# Upper bound on the pages returned by a single batch request
+MAX_BATCH_PAGES = 512
+# Upper bound on the pages scored by a ranking request; a whole stack with
+# more pages is ranked on this many evenly spaced pages
+MAX_RANK_PAGES = 4096
+# Pages fetched and scored together by a ranking request
+RANK_CHUNK_PAGES = 64
+# Allowed tile edge lengths for the pyramid endpoints
+TILE_SIZES = (128, 256, 512, 1024)
+# Montage layout headers: grid rows and columns, tile size and gap in pixels
+MONTAGE_HEADERS = ("X-Montage-Rows", "X-Montage-Columns", "X-Montage-Tile-Width", "X-Montage-Tile-Height", "X-Montage-Gap")
+
+# Concurrent identical page renders and pyramid builds share one task
+render_flight = SingleFlight("render")
+pyramid_flight = SingleFlight("pyramid")
+
+# Client request headers forwarded upstream by /proxy/tiff
+FORWARDED_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+# Upstream response headers passed back down by /proxy/tiff
+FORWARDED_RESPONSE_HEADERS = (
+    "content-type", "content-length", "content-range", "content-encoding",
+    "accept-ranges", "etag", "last-modified",
+)
+
+PROXY_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET",
+    "Access-Control-Allow-Headers": "*",
+    "Access-Control-Expose-Headers": "Content-Range, ETag, Last-Modified, X-Cache",
+    "Cache-Control": "public, max-age=3600",  # Cache for 1 hour
+}
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
     """
-    Proxy endpoint to fetch TIFF files from S3 and return them to avoid CORS issues.
+    Parse a single-range Range header against an object of the given size.
+    Returns the inclusive (start, end) byte positions, or None when the header
+    should be ignored and the whole object served: an unsupported unit,
+    several ranges, or a malformed range such as bytes=abc or bytes=10-5.
+
+    Raises
+    ------
+    ValueError
+        If the range is well formed but cannot be satisfied, e.g. it starts
+        past the end of the object
     """
-    try:
-        logger.info(f"Proxying TIFF file from URL: {url}")
-        
-        # Validate that it's a reasonable URL (basic security)
-        if not url.startswith(("https://", "http://")):
-            raise HTTPException(status_code=400, detail="Invalid URL scheme")
-        
-        # Use httpx to fetch the file
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.get(url)
-            
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch file: {response.status_code} - {response.text}")
-                raise HTTPException(
-                    status_code=response.status_code, 
-                    detail=f"Failed to fetch file: {response.status_code}"
-                )
-            
-            # Get the content type from the original response
-            content_type = response.headers.get("content-type", "image/tiff")
-            
-            logger.info(f"Successfully fetched file, size: {len(response.content)} bytes")
-            
-            # Return the file content with appropriate headers
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    match = re.fullmatch(r"(\d*)-(\d*)", spec.strip(), re.ASCII)
+    if match is None or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError(f"Unsatisfiable range: {header}")
+    return start, end
+
+def _cached_response(request: Request, cached: CachedTiff) -> Response:
+    """Serve a cached object, answering conditional and Range requests locally"""
+    headers = dict(PROXY_HEADERS)
+    headers["Accept-Ranges"] = "bytes"
+    headers["X-Cache"] = cached.cache_status
+    if cached.etag:
+        headers["ETag"] = cached.etag
+    if cached.last_modified:
+        headers["Last-Modified"] = cached.last_modified
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and cached.etag and if_none_match in ("*", cached.etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header:
+        try:
+            byte_range = _parse_range(range_header, cached.size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{cached.size}"
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{cached.size}"
+            proxied_bytes.inc(end + 1 - start, "tiff")
             return Response(
-                content=response.content,
-                media_type=content_type,
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "GET",
-                    "Access-Control-Allow-Headers": "*",
-                    "Content-Length": str(len(response.content)),
-                    "Cache-Control": "public, max-age=3600"  # Cache for 1 hour
-                }
+                content=cached.data[start:end + 1],
+                status_code=206,
+                media_type=cached.content_type,
+                headers=headers
             )
-            
+
+    proxied_bytes.inc(cached.size, "tiff")
+    return Response(content=cached.data, media_type=cached.content_type, headers=headers)
+
+@contextmanager
+def upstream_errors(url: str, action: str) -> Iterator[None]:
+    """
+    Map errors raised while serving url to HTTP errors: overload to 503 with
+    Retry-After, upstream failures to their status, timeouts to 504, other
+    HTTP errors to 502 and anything unexpected to 500. HTTPException passes
+    through unchanged.
+
+    Parameters
+    ----------
+    url : str
+        The proxied URL, for the log
+    action : str
+        What was being done, logged with unexpected errors, e.g. "building pyramid"
+    """
+    try:
+        yield
+
+    except HTTPException:
+        raise
+
+    except Overloaded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    except UpstreamError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
     except httpx.TimeoutException:
         logger.error(f"Timeout while fetching URL: {url}")
         raise HTTPException(status_code=504, detail="Timeout while fetching file")
-    
+
     except httpx.HTTPError as e:
         logger.error(f"HTTP error while fetching URL {url}: {str(e)}")
         raise HTTPException(status_code=502, detail=f"Error fetching file: {str(e)}")
-    
+
     except Exception as e:
-        logger.error(f"Unexpected error while proxying URL {url}: {str(e)}")
+        logger.error(f"Unexpected error {action} for URL {url}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+async def _count_proxied(chunks: AsyncIterator[bytes], endpoint: str) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        proxied_bytes.inc(len(chunk), endpoint)
+        yield chunk
+
+@proxy_router.get("/tiff")
+async def proxy_tiff(
+    request: Request,
+    url: str = Query(..., description="The S3 URL to proxy"),
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    """
+    Proxy endpoint to fetch TIFF files from S3 and return them to avoid CORS issues.
+    The upstream body is streamed through in fixed-size chunks, so memory use
+    does not grow with the file size. Range and conditional request headers
+    are passed upstream and 206/304 answers are passed back down.
+    """
+    with upstream_errors(url, "proxying"):
+        logger.info(f"Proxying TIFF file from URL: {url}")
+        
+        # Validate that it's a reasonable URL (basic security)
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+
+        # Serve from the TIFF cache when the whole file was fetched before,
+        # revalidating it upstream once it is older than the TTL
+        if tiff_cache.contains(url):
+            with span("cache"):
+                cached = await tiff_cache.fetch(client, url)
+            logger.info(f"Serving cached file, size: {cached.size} bytes")
+            return _cached_response(request, cached)
+
+        forwarded = {
+            name: request.headers[name]
+            for name in FORWARDED_REQUEST_HEADERS
+            if name in request.headers
+        }
+        with span("upstream"):
+            upstream = await client.send(client.build_request("GET", url, headers=forwarded, extensions={"passthrough": True}), stream=True)
+
+        if upstream.status_code not in (200, 206, 304):
+            await upstream.aclose()
+            logger.error(f"Failed to fetch file: {upstream.status_code}")
+            raise HTTPException(
+                status_code=upstream.status_code,
+                detail=f"Failed to fetch file: {upstream.status_code}"
+            )
+
+        headers = dict(PROXY_HEADERS)
+        headers["X-Cache"] = "MISS"
+        for name in FORWARDED_RESPONSE_HEADERS:
+            if name in upstream.headers:
+                headers[name] = upstream.headers[name]
+
+        logger.info(f"Streaming file ({upstream.status_code}), size: {upstream.headers.get('content-length')} bytes")
+
+        return StreamingResponse(
+            _count_proxied(upstream.aiter_raw(PROXY_STREAM_CHUNK_BYTES), "tiff"),
+            status_code=upstream.status_code,
+            headers=headers,
+            background=BackgroundTask(upstream.aclose)
+        )
+
+def _validate_rendering(encoding: str, downsample_rate: int, norm: str = "page") -> None:
+    if encoding not in ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(ENCODINGS)}")
+    if downsample_rate < 1:
+        raise HTTPException(status_code=400, detail="downsample_rate must be at least 1")
+    if norm not in NORMALISATIONS:
+        raise HTTPException(status_code=400, detail=f"norm must be one of {', '.join(NORMALISATIONS)}")
+
+def _check_downsample(descriptor: StackDescriptor, pages: Iterable[int], downsample_rate: int) -> None:
+    """
+    Reject a downsample rate that would leave one of the pages without
+    pixels, before any page data is fetched. Pages outside the stack are
+    left for the render to report.
+    """
+    for page in pages:
+        if 0 <= page < len(descriptor.pages):
+            height, width = descriptor.pages[page].shape[:2]
+            if downsample_rate > min(height, width):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"downsample_rate {downsample_rate} is larger than page {page} ({width}x{height})",
+                )
+
+async def _display_window(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    norm: str,
+) -> Optional[Tuple[float, float]]:
+    """Return the display window of a normalisation; None means per page"""
+    if norm == "page":
+        return None
+    stats = await load_stack_stats(client, pool, url)
+    return stats.window(norm)
+
+def _encoding_headers(encoded: List[EncodedPage]) -> dict:
+    """Response headers reporting how long encoding took and how large the result is"""
+    headers = dict(PROXY_HEADERS)
+    headers["Access-Control-Expose-Headers"] += ", X-Encode-Time-Ms, X-Encoded-Bytes"
+    headers["X-Encode-Time-Ms"] = f"{sum(item.encode_seconds for item in encoded) * 1000:.2f}"
+    headers["X-Encoded-Bytes"] = str(sum(len(item.body) for item in encoded))
+    return headers
+
+async def _fetch_and_render(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    page: int,
+    downsample_rate: int,
+    encoding: str,
+    quality: int,
+    window: Optional[Tuple[float, float]],
+    key: Tuple,
+) -> EncodedPage:
+    """
+    Fetch one page and render it in the worker pool, keeping the event loop
+    free, and store the result in the page cache under key. Across worker
+    processes only one renders a page at a time; the others wait and then
+    read it from the shared cache.
+    """
+    async with shared_store.alock(("page", *key)):
+        encoded = await get_page(key, recheck=True)
+        if encoded is not None:
+            return encoded
+        return await _render_page(client, pool, url, page, downsample_rate, encoding, quality, window, key)
+
+async def _render_page(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    page: int,
+    downsample_rate: int,
+    encoding: str,
+    quality: int,
+    window: Optional[Tuple[float, float]],
+    key: Tuple,
+) -> EncodedPage:
+    with span("fetch"):
+        source = await load_pages_source(client, pool, url, [page])
+    try:
+        with span("render"):
+            encoded = await pool.run(render_page, source, page, downsample_rate, encoding, quality, window)
+        await put_page(key, encoded)
+        return encoded
+    except (IndexError, Overloaded):
+        raise
+    except Exception as e:
+        logger.error(f"Error processing page {page}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing page: {str(e)}")
+
+async def _render_cached(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    page: int,
+    downsample_rate: int,
+    encoding: str,
+    quality: int,
+    norm: str,
+) -> Tuple[EncodedPage, str]:
+    """
+    Return one rendered page from the page cache, or fetch and render it.
+    Also returns the cache status, HIT or MISS.
+
+    Raises
+    ------
+    IndexError
+        If the TIFF has no such page
+    """
+    with span("describe"):
+        descriptor = await load_descriptor(client, pool, url)
+    _check_downsample(descriptor, [page], downsample_rate)
+    with span("normalise"):
+        window = await _display_window(client, pool, url, norm)
+    key = page_key(url, descriptor.version, page, downsample_rate, encoding, quality, window)
+    encoded = await get_page(key)
+    if encoded is not None:
+        return encoded, "HIT"
+    # Identical page requests arriving together share one fetch and render
+    encoded = await render_flight.do(
+        key, lambda: _fetch_and_render(client, pool, url, page, downsample_rate, encoding, quality, window, key)
+    )
+    record_span("encode", encoded.encode_seconds)
+    return encoded, "MISS"
+
+def parse_page_selection(pages: str, limit: int = MAX_BATCH_PAGES) -> List[int]:
+    """
+    Parse a page selection such as "0,3,10-20" into a list of page indices.
+    Ranges are inclusive at both ends and must not be reversed; at most
+    limit pages may be selected.
+    """
+    selected = []
+    try:
+        for part in pages.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if "-" in part:
+                first, last = (int(value) for value in part.split("-", 1))
+                if first > last:
+                    raise HTTPException(status_code=400, detail=f"Invalid page range {part}: start is after end")
+                if len(selected) + last + 1 - first > limit:
+                    raise HTTPException(status_code=400, detail=f"At most {limit} pages can be requested at once")
+                selected.extend(range(first, last + 1))
+            else:
+                selected.append(int(part))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid page selection: {pages}")
+    if not selected:
+        raise HTTPException(status_code=400, detail="No pages selected")
+    if len(selected) > limit:
+        raise HTTPException(status_code=400, detail=f"At most {limit} pages can be requested at once")
+    return selected
+
 @proxy_router.get("/tiff-pages")
 async def proxy_tiff_pages(
     url: str = Query(..., description="The S3 URL to proxy"),
     page: int = Query(None, description="Page number to extract (0-based). If not provided, returns metadata."),
-    downsample_rate: int = 1
+    downsample_rate: int = 1,
+    format: str = Query("png", description=f"Page encoding, one of {', '.join(ENCODINGS)}"),
+    quality: int = Query(90, ge=1, le=100, description="JPEG quality"),
+    norm: str = Query("page", description="Contrast normalisation: page (own min/max), stack (stack min/max) or percentile (stack percentiles)"),
+    detailed: bool = Query(False, description="Include the structure and byte offsets of every page in the metadata"),
+    prefetch: bool = Query(False, description="With the metadata, start rendering every page in the background"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
 ):
     """
-    Process multi-page TIFF files server-side using Pillow.
-    Returns metadata (page count, dimensions) when no page parameter is provided.
-    Returns individual pages as PNG when page parameter is provided.
+    Process multi-page TIFF files server-side.
+    Returns metadata (page count, dimensions, dtype, compression) when no page
+    parameter is provided. Metadata is read from the IFD chain alone and cached
+    per URL and ETag.
+    Returns individual pages when page parameter is provided, as PNG by default
+    or in another encoding chosen with format. Pages are read with HTTP Range
+    requests, so only the requested page is downloaded. With norm=stack or
+    norm=percentile every page is scaled with the same cached stack-wide window.
+    Rendered pages are cached, and prefetch=true on the metadata request
+    starts a prefetch job with the given rendering parameters, as
+    POST /proxy/tiff-pages/prefetch does.
     """
-    try:
+    with upstream_errors(url, "processing TIFF"):
         logger.info(f"Processing TIFF pages from URL: {url}, page: {page}")
         
         # Validate URL
         if not url.startswith(("https://", "http://")):
             raise HTTPException(status_code=400, detail="Invalid URL scheme")
         
-        # Fetch the TIFF file
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.get(url)
-            
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch TIFF file: {response.status_code}")
-                raise HTTPException(
-                    status_code=response.status_code, 
-                    detail=f"Failed to fetch TIFF file: {response.status_code}"
-                )
-            
-            logger.info(f"Fetched TIFF file, size: {len(response.content)} bytes")
-        
-        # Process TIFF with Pillow
-        tiff_data = BytesIO(response.content)
-        
-        with Image.open(tiff_data) as img:
-            # If no page specified, return metadata
-            if page is None:
-                # Count pages
-                page_count = 0
-                try:
-                    while True:
-                        img.seek(page_count)
-                        page_count += 1
-                except EOFError:
-                    pass
-                
-                # Get dimensions from first page
-                img.seek(0)
-                width, height = img.size
-                
-                metadata = {
-                    "page_count": page_count,
-                    "width": width,
-                    "height": height,
-                    "format": img.format,
-                    "mode": img.mode
-                }
-                
-                logger.info(f"TIFF metadata: {metadata}")
-                
-                return JSONResponse(
-                    content=metadata,
-                    headers={
-                        "Access-Control-Allow-Origin": "*",
-                        "Access-Control-Allow-Methods": "GET",
-                        "Access-Control-Allow-Headers": "*",
-                        "Cache-Control": "public, max-age=3600"
-                    }
+        # Extract a specific page, fetching only the byte ranges it needs
+        if page is not None:
+            _validate_rendering(format, downsample_rate, norm)
+            try:
+                encoded, cache_status = await _render_cached(client, pool, url, page, downsample_rate, format, quality, norm)
+            except IndexError as e:
+                logger.error(f"Page {page} does not exist in TIFF")
+                raise HTTPException(status_code=404, detail=str(e))
+
+            logger.info(f"Converted page {page} to {format}, size: {len(encoded.body)} bytes, cache: {cache_status}")
+            proxied_bytes.inc(len(encoded.body), "tiff-pages")
+
+            headers = _encoding_headers([encoded])
+            headers["X-Cache"] = cache_status
+            return Response(
+                content=encoded.body,
+                media_type=encoded.media_type,
+                headers=headers
+            )
+
+        # Describe the stack from its IFD chain alone, without reading pixel data
+        with span("describe"):
+            descriptor = await load_descriptor(client, pool, url)
+        metadata = descriptor.to_metadata(detailed)
+
+        logger.info(f"TIFF metadata: {metadata}")
+
+        headers = dict(PROXY_HEADERS)
+        if prefetch:
+            # The job status changes, so this answer must not be reused
+            headers["Cache-Control"] = "no-store"
+            _validate_rendering(format, downsample_rate, norm)
+            _check_downsample(descriptor, range(len(descriptor.pages)), downsample_rate)
+            window = await _display_window(client, pool, url, norm)
+            try:
+                job = prefetch_manager.start(client, pool, descriptor, downsample_rate, format, quality, norm, window)
+                metadata["prefetch"] = job.to_dict()
+            except PrefetchLimitError as e:
+                metadata["prefetch"] = {"status": "rejected", "error": str(e)}
+
+        return JSONResponse(content=metadata, headers=headers)
+
+@proxy_router.get("/tiff-pages/batch", dependencies=[Depends(priority(BATCH))])
+async def proxy_tiff_pages_batch(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    pages: str = Query(..., description="Pages to extract (0-based), e.g. '0,3,10-20'"),
+    downsample_rate: int = 1,
+    format: str = Query("png", description=f"Page encoding, one of {', '.join(ENCODINGS)}"),
+    quality: int = Query(90, ge=1, le=100, description="JPEG quality"),
+    norm: str = Query("page", description="Contrast normalisation: page (own min/max), stack (stack min/max) or percentile (stack percentiles)"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Return many pages of a multi-page TIFF in one response. The TIFF is fetched
+    and parsed once per batch and the pages are encoded across the worker pool.
+    The response body is packed as described in utils.tiff_pages.pack_pages.
+    """
+    with upstream_errors(url, "processing TIFF batch"):
+        logger.info(f"Processing TIFF page batch from URL: {url}, pages: {pages}")
+
+        # Validate URL
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+
+        selected = parse_page_selection(pages)
+        _validate_rendering(format, downsample_rate, norm)
+        with span("describe"):
+            descriptor = await load_descriptor(client, pool, url)
+        _check_downsample(descriptor, selected, downsample_rate)
+        try:
+            with span("normalise"):
+                window = await _display_window(client, pool, url, norm)
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+        # Split the pages into one job per worker so the batch uses every core
+        chunk_size = -(-len(selected) // pool.max_workers)
+        chunks = [selected[i:i + chunk_size] for i in range(0, len(selected), chunk_size)]
+        try:
+            # The page data counts against the byte limit until every page is rendered
+            async with reserve_bytes(descriptor.data_bytes(selected)):
+                with span("fetch"):
+                    source = await load_pages_source(client, pool, url, selected)
+                with span("render"):
+                    results = await asyncio.gather(
+                        *(pool.run(render_pages, source, chunk, downsample_rate, format, quality, window) for chunk in chunks)
+                    )
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+        encoded = [item for chunk in results for item in chunk]
+        body = pack_pages(selected, encoded)
+        logger.info(f"Packed {len(selected)} pages, size: {len(body)} bytes")
+        record_span("encode", sum(item.encode_seconds for item in encoded))
+        proxied_bytes.inc(len(body), "tiff-pages/batch")
+
+        return Response(
+            content=body,
+            media_type="application/octet-stream",
+            headers=_encoding_headers(encoded)
+        )
+
+def parse_roi(roi: Optional[str]) -> Optional[Roi]:
+    """Parse a region of interest "x,y,width,height" in full-resolution pixels"""
+    if roi is None:
+        return None
+    try:
+        x, y, width, height = (int(value) for value in roi.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid roi, expected x,y,width,height: {roi}")
+    if width < 1 or height < 1:
+        raise HTTPException(status_code=400, detail="roi width and height must be at least 1")
+    return x, y, width, height
+
+@proxy_router.get("/tiff-pages/montage", dependencies=[Depends(priority(BATCH))])
+async def proxy_tiff_montage(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    pages: str = Query(..., description="Pages to include (0-based), e.g. '0,3,10-20'"),
+    roi: Optional[str] = Query(None, description="Region of interest 'x,y,width,height' in full-resolution pixels"),
+    downsample_rate: int = 1,
+    columns: Optional[int] = Query(None, ge=1, description="Tiles per row; near-square by default"),
+    gap: int = Query(4, ge=0, le=64, description="Black pixels between tiles"),
+    labels: bool = Query(True, description="Label each tile with its page index"),
+    format: str = Query("png-fast", description=f"Montage encoding, one of {', '.join(MONTAGE_ENCODINGS)}"),
+    quality: int = Query(90, ge=1, le=100, description="JPEG quality"),
+    norm: str = Query("page", description="Contrast normalisation: page (each tile's own min/max), stack (stack min/max) or percentile (stack percentiles)"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Return the selected pages as one grid image, e.g. to review every result
+    of a centre-of-rotation sweep with one request. Pages are cropped to the
+    roi, downsampled, scaled to 8 bits and laid out row by row in the order
+    given. The X-Montage-* headers give the grid and tile size so clients can
+    map positions in the image back to pages.
+    """
+    with upstream_errors(url, "building TIFF montage"):
+        logger.info(f"Building TIFF montage from URL: {url}, pages: {pages}, roi: {roi}")
+
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+
+        selected = parse_page_selection(pages)
+        region = parse_roi(roi)
+        if format not in MONTAGE_ENCODINGS:
+            raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(MONTAGE_ENCODINGS)}")
+        _validate_rendering(format, downsample_rate, norm)
+
+        # Size the montage from the page shapes before any page data is fetched
+        with span("describe"):
+            descriptor = await load_descriptor(client, pool, url)
+        missing = [page for page in selected if not 0 <= page < len(descriptor.pages)]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Page {missing[0]} not found")
+        try:
+            check_montage_size(
+                [tile_shape(descriptor.pages[page].shape, region, downsample_rate) for page in selected], columns, gap
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        try:
+            with span("normalise"):
+                window = await _display_window(client, pool, url, norm)
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+        # Decode the tiles across the worker pool, then assemble and encode once
+        chunk_size = -(-len(selected) // pool.max_workers)
+        chunks = [selected[i:i + chunk_size] for i in range(0, len(selected), chunk_size)]
+        try:
+            # The page data counts against the byte limit until every tile is decoded
+            async with reserve_bytes(descriptor.data_bytes(selected)):
+                with span("fetch"):
+                    source = await load_pages_source(client, pool, url, selected)
+                with span("render"):
+                    results = await asyncio.gather(
+                        *(pool.run(montage_tiles, source, chunk, region, downsample_rate, window) for chunk in chunks)
+                    )
+            with span("render"):
+                tiles = [tile for chunk in results for tile in chunk]
+                page_labels = [str(page) for page in selected] if labels else None
+                encoded = await pool.run(render_montage, tiles, page_labels, columns, gap, format, quality)
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        rows, grid_columns = montage_grid(len(tiles), columns)
+        logger.info(f"Built {rows}x{grid_columns} montage of {len(tiles)} pages, size: {len(encoded.body)} bytes")
+        record_span("encode", encoded.encode_seconds)
+        proxied_bytes.inc(len(encoded.body), "tiff-pages/montage")
+
+        headers = _encoding_headers([encoded])
+        headers["Access-Control-Expose-Headers"] += ", " + ", ".join(MONTAGE_HEADERS)
+        headers.update(dict(zip(MONTAGE_HEADERS, (
+            str(rows),
+            str(grid_columns),
+            str(max(tile.shape[1] for tile in tiles)),
+            str(max(tile.shape[0] for tile in tiles)),
+            str(gap),
+        ))))
+        return Response(content=encoded.body, media_type=encoded.media_type, headers=headers)
+
+@proxy_router.get("/tiff-pages/ranking", dependencies=[Depends(priority(BATCH))])
+async def proxy_tiff_ranking(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    pages: Optional[str] = Query(None, description=f"Pages to rank (0-based), e.g. '0-49', at most {MAX_RANK_PAGES}; all pages by default"),
+    roi: Optional[str] = Query(None, description="Region of interest 'x,y,width,height' in full-resolution pixels"),
+    downsample_rate: int = 1,
+    metric: str = Query(COMBINED, description=f"Ranking metric, one of {', '.join([COMBINED, *QUALITY_METRICS])}"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Rank the pages of a sweep, e.g. the slices of a centre-of-rotation sweep,
+    by image quality. Every page is scored for gradient energy and total
+    variation (higher is better) and histogram entropy (lower is better)
+    after scaling with the stack's percentile window, optionally on a region
+    of interest or a downsampled copy. The combined ranking orders pages by
+    their mean rank over the three metrics. best_index is the position of
+    the best page in the selection, which matches the sweep value index.
+
+    Pages are fetched and scored RANK_CHUNK_PAGES at a time, so memory does
+    not grow with the selection. Without a selection, a stack of more than
+    MAX_RANK_PAGES pages is ranked on that many evenly spaced pages and the
+    response has sampled set to true.
+    """
+    with upstream_errors(url, "ranking TIFF pages"):
+        logger.info(f"Ranking TIFF pages from URL: {url}, pages: {pages}, metric: {metric}")
+
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+        if metric != COMBINED and metric not in QUALITY_METRICS:
+            raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join([COMBINED, *QUALITY_METRICS])}")
+        if downsample_rate < 1:
+            raise HTTPException(status_code=400, detail="downsample_rate must be at least 1")
+        region = parse_roi(roi)
+
+        with span("describe"):
+            descriptor = await load_descriptor(client, pool, url)
+        if pages is None:
+            selected = sample_pages(len(descriptor.pages), MAX_RANK_PAGES)
+            sampled = len(selected) < len(descriptor.pages)
+        else:
+            selected = parse_page_selection(pages, MAX_RANK_PAGES)
+            sampled = False
+        try:
+            with span("normalise"):
+                window = await _display_window(client, pool, url, "percentile")
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+        # Fetch and score chunk by chunk, one chunk per worker at a time, each
+        # chunk's page data counting against the byte limit until it is scored
+        semaphore = asyncio.Semaphore(pool.max_workers)
+
+        async def score(chunk: List[int]) -> dict:
+            async with semaphore, reserve_bytes(descriptor.data_bytes(chunk)):
+                source = await load_pages_source(client, pool, url, chunk)
+                return await pool.run(quality_scores, source, chunk, window, region, downsample_rate)
+
+        chunks = [selected[i:i + RANK_CHUNK_PAGES] for i in range(0, len(selected), RANK_CHUNK_PAGES)]
+        try:
+            with span("score"):
+                results = await asyncio.gather(*(score(chunk) for chunk in chunks))
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        scores = {name: [value for chunk in results for value in chunk[name]] for name in QUALITY_METRICS}
+        ranking = rank_pages(scores, metric)
+        logger.info(f"Ranked {len(selected)} pages, best page: {selected[ranking[0]]}")
+
+        return JSONResponse(
+            content={
+                "pages": selected,
+                "sampled": sampled,
+                "metric": metric,
+                "scores": scores,
+                "higher_is_better": QUALITY_METRICS,
+                "ranking": [selected[position] for position in ranking],
+                "best_index": ranking[0],
+                "best_page": selected[ranking[0]],
+                "window": list(window),
+            },
+            headers=PROXY_HEADERS
+        )
+
+def _stream_request(message: dict, defaults: dict) -> dict:
+    """
+    Validate a page request received on the page stream, filling in the
+    connection's rendering parameters for any that are not given.
+
+    Raises
+    ------
+    HTTPException
+        With status 400 if the request is invalid
+    """
+    request = {**defaults, **{name: message[name] for name in defaults if name in message}}
+    request["id"] = message.get("id")
+    try:
+        request["page"] = int(message["page"])
+        request["downsample_rate"] = int(request["downsample_rate"])
+        request["quality"] = int(request["quality"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Page requests need an integer page")
+    if not 1 <= request["quality"] <= 100:
+        raise HTTPException(status_code=400, detail="quality must be between 1 and 100")
+    _validate_rendering(request["format"], request["downsample_rate"], request["norm"])
+    return request
+
+async def _send_stream_page(
+    websocket: WebSocket,
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    request: dict,
+) -> None:
+    """Render one requested page and send it, or send the error that stopped it"""
+    page = request["page"]
+    try:
+        with upstream_errors(url, f"streaming page {page}"):
+            try:
+                encoded, cache_status = await _render_cached(
+                    client, pool, url, page, request["downsample_rate"], request["format"], request["quality"], request["norm"]
                 )
-            
-            # Extract specific page
+            except IndexError as e:
+                raise HTTPException(status_code=404, detail=str(e))
+    except HTTPException as e:
+        status, detail = e.status_code, e.detail
+    else:
+        body = pack_pages([page], [encoded], {
+            "id": request["id"],
+            "downsample_rate": request["downsample_rate"],
+            "cache": cache_status,
+            "encode_ms": round(encoded.encode_seconds * 1000, 2),
+        })
+        await websocket.send_bytes(body)
+        stream_pages.inc(1, "sent")
+        proxied_bytes.inc(len(body), "tiff-pages/stream")
+        return
+    stream_pages.inc(1, "failed")
+    await websocket.send_json({"id": request["id"], "page": page, "status": status, "error": detail})
+
+@proxy_router.websocket("/tiff-pages/stream")
+async def stream_tiff_pages(
+    websocket: WebSocket,
+    url: str = Query(..., description="The S3 URL to proxy"),
+    downsample_rate: int = 1,
+    format: str = Query("png", description=f"Page encoding, one of {', '.join(ENCODINGS)}"),
+    quality: int = Query(90, description="JPEG quality"),
+    norm: str = Query("page", description="Contrast normalisation: page (own min/max), stack (stack min/max) or percentile (stack percentiles)"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Stream the pages of one stack over a WebSocket while a slider is moved.
+
+    The client sends JSON text messages such as {"page": 12, "id": 7}, which
+    may override the connection's downsample_rate, format, quality and norm,
+    or {"cancel": true} to drop all outstanding work. Each page is sent as
+    a binary message packed like the batch endpoint (utils.tiff_pages.pack_pages),
+    with the request id, downsample rate, cache status and encode time in
+    the index. Failures are sent as JSON text {"id", "page", "status", "error"}.
+
+    One page is rendered at a time and only the newest request waits behind
+    it: a request replaced before it starts is dropped without being
+    fetched, decoded or sent. Pages come from the same cache as /tiff-pages.
+    """
+    defaults = {"downsample_rate": downsample_rate, "format": format, "quality": quality, "norm": norm}
+    try:
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+        _stream_request({"page": 0}, defaults)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await websocket.accept()
+    logger.info(f"Opened page stream for URL: {url}")
+
+    pending: Optional[dict] = None
+    current: Optional[asyncio.Task] = None
+    wanted = asyncio.Event()
+
+    async def receive() -> None:
+        nonlocal pending
+        while True:
+            message = await websocket.receive_json()
+            if not isinstance(message, dict):
+                await websocket.send_json({"status": 400, "error": "Messages must be JSON objects"})
+                continue
+            if message.get("cancel"):
+                if pending is not None:
+                    stream_pages.inc(1, "superseded")
+                    pending = None
+                if current is not None and not current.done():
+                    current.cancel()
+                continue
+            try:
+                request = _stream_request(message, defaults)
+            except HTTPException as e:
+                stream_pages.inc(1, "failed")
+                await websocket.send_json({"id": message.get("id"), "page": message.get("page"), "status": e.status_code, "error": e.detail})
+                continue
+            if pending is not None:
+                stream_pages.inc(1, "superseded")
+            pending = request
+            wanted.set()
+
+    async def serve() -> None:
+        nonlocal pending, current
+        while True:
+            await wanted.wait()
+            wanted.clear()
+            request, pending = pending, None
+            if request is None:
+                continue
+            current = asyncio.create_task(_send_stream_page(websocket, client, pool, url, request))
+            await asyncio.wait({current})
+            if current.cancelled():
+                stream_pages.inc(1, "cancelled")
             else:
-                try:
-                    img.seek(page)
-                    if downsample_rate != 1:
-                        width, height = img.size
-                        img = img.resize((width // downsample_rate, height // downsample_rate))
-                    logger.info(f"Extracting page {page}, size: {img.size}")
-                    
-                    # Convert to RGB if necessary (TIFF might be in different modes)
-                    if img.mode not in ('RGB', 'RGBA'):
-                        if img.mode == 'I;16':
-                            array = np.array(img)
-                            normalized = (array.astype(np.uint16) - array.min()) * 255.0 / (array.max() - array.min())
-                            img = Image.fromarray(normalized.astype(np.uint8))
-                        img = img.convert('RGB')
-                    
-                    # Save as PNG to BytesIO
-                    png_buffer = BytesIO()
-                    img.save(png_buffer, format='PNG', optimize=True)
-                    png_data = png_buffer.getvalue()
-                    
-                    logger.info(f"Converted page {page} to PNG, size: {len(png_data)} bytes")
-                    
-                    return Response(
-                        content=png_data,
-                        media_type="image/png",
-                        headers={
-                            "Access-Control-Allow-Origin": "*",
-                            "Access-Control-Allow-Methods": "GET",
-                            "Access-Control-Allow-Headers": "*",
-                            "Content-Length": str(len(png_data)),
-                            "Cache-Control": "public, max-age=3600"
-                        }
-                    )
-                    
-                except EOFError:
-                    logger.error(f"Page {page} does not exist in TIFF")
-                    raise HTTPException(status_code=404, detail=f"Page {page} not found")
-                except Exception as e:
-                    logger.error(f"Error processing page {page}: {str(e)}")
-                    raise HTTPException(status_code=500, detail=f"Error processing page: {str(e)}")
-    
-    except httpx.TimeoutException:
-        logger.error(f"Timeout while fetching URL: {url}")
-        raise HTTPException(status_code=504, detail="Timeout while fetching file")
-    
-    except httpx.HTTPError as e:
-        logger.error(f"HTTP error while fetching URL {url}: {str(e)}")
-        raise HTTPException(status_code=502, detail=f"Error fetching file: {str(e)}")
-    
+                current.result()
+
+    tasks = [asyncio.create_task(receive()), asyncio.create_task(serve())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    except WebSocketDisconnect:
+        logger.info(f"Closed page stream for URL: {url}")
     except Exception as e:
-        logger.error(f"Unexpected error processing TIFF: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
\ No newline at end of file
+        logger.error(f"Unexpected error on page stream for URL {url}: {str(e)}")
+        await websocket.close(code=1011)
+    finally:
+        for task in tasks + ([current] if current is not None else []):
+            task.cancel()
+        await asyncio.gather(*tasks, *([current] if current is not None else []), return_exceptions=True)
+
+@proxy_router.post("/tiff-pages/prefetch", status_code=202)
+async def start_tiff_prefetch(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    downsample_rate: int = 1,
+    format: str = Query("png", description=f"Page encoding, one of {', '.join(ENCODINGS)}"),
+    quality: int = Query(90, ge=1, le=100, description="JPEG quality"),
+    norm: str = Query("page", description="Contrast normalisation: page (own min/max), stack (stack min/max) or percentile (stack percentiles)"),
+    start: int = Query(0, ge=0, description="Page to render first; the rest follow in order, wrapping around"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Start rendering every page of a stack in the background, with the same
+    parameters as /proxy/tiff-pages, so later page requests are served from
+    the page cache. The stack is fetched once, chunk by chunk. Returns the
+    job; an identical running job is returned instead of starting another.
+    Only as many pages as fit in the page cache are rendered, nearest to
+    start first; such a job finishes as "partial" with planned < total.
+    Follow progress at /proxy/tiff-pages/prefetch/{job}/events.
+    """
+    with upstream_errors(url, "starting prefetch"):
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+        _validate_rendering(format, downsample_rate, norm)
+
+        with span("describe"):
+            descriptor = await load_descriptor(client, pool, url)
+        _check_downsample(descriptor, range(len(descriptor.pages)), downsample_rate)
+        with span("normalise"):
+            window = await _display_window(client, pool, url, norm)
+        try:
+            job = prefetch_manager.start(client, pool, descriptor, downsample_rate, format, quality, norm, window, start)
+        except PrefetchLimitError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+        return JSONResponse(status_code=202, content=job.to_dict(), headers={**PROXY_HEADERS, "Cache-Control": "no-store"})
+
+@proxy_router.get("/tiff-pages/prefetch/{job_id}")
+async def get_tiff_prefetch(job_id: str):
+    """Return the status of a prefetch job"""
+    job = prefetch_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Prefetch job {job_id} not found")
+    return JSONResponse(content=job.to_dict(), headers={**PROXY_HEADERS, "Cache-Control": "no-store"})
+
+@proxy_router.delete("/tiff-pages/prefetch/{job_id}")
+async def cancel_tiff_prefetch(job_id: str):
+    """Cancel a running prefetch job; pages already rendered stay cached"""
+    job = prefetch_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Prefetch job {job_id} not found")
+    return JSONResponse(content=job.to_dict(), headers={**PROXY_HEADERS, "Cache-Control": "no-store"})
+
+@proxy_router.get("/tiff-pages/prefetch/{job_id}/events")
+async def tiff_prefetch_events(job_id: str):
+    """
+    Stream the progress of a prefetch job as Server-Sent Events: a "status"
+    event listing the pages already ready, a "page" event for each page as
+    it becomes ready, and a final complete, partial, failed or cancelled event.
+    """
+    job = prefetch_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Prefetch job {job_id} not found")
+    headers = {**PROXY_HEADERS, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(job.events(), media_type="text/event-stream", headers=headers)
+
+@proxy_router.get("/tiff-pages/volume")
+async def proxy_tiff_volume(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Store a stack as a memory-mapped volume on local disk, if it is not
+    stored yet, and describe it: shape, axes and dtype. The first call for
+    a stack version fetches and decodes every page once; later slices are
+    cut from the stored volume.
+    """
+    with upstream_errors(url, "storing volume"):
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+        try:
+            with span("volume"):
+                volume = await volume_store.load(client, pool, url)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        return JSONResponse(content=volume.to_dict(), headers=PROXY_HEADERS)
+
+@proxy_router.get("/tiff-pages/slice")
+async def proxy_tiff_slice(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    axis: str = Query("z", description="z for an XY page, y for an XZ reslice at a row, x for a YZ reslice at a column"),
+    index: int = Query(..., description="Position along the axis (0-based)"),
+    roi: Optional[str] = Query(None, description="Region of interest 'x,y,width,height' in the slice's pixels"),
+    downsample_rate: int = 1,
+    format: str = Query("png", description=f"Slice encoding, one of {', '.join(ENCODINGS)}"),
+    quality: int = Query(90, ge=1, le=100, description="JPEG quality"),
+    norm: str = Query("page", description="Contrast normalisation: page (the slice's own min/max), stack (stack min/max) or percentile (stack percentiles)"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Return a slice of a stack along any axis, e.g. an XZ or YZ reslice to
+    check a reconstruction along the rotation axis. The slice is cut as a
+    view of the stack's memory-mapped volume (see /tiff-pages/volume, which
+    it builds on first use), so only the slice's bytes are read from disk.
+    """
+    with upstream_errors(url, "slicing volume"):
+        logger.info(f"Slicing TIFF volume from URL: {url}, axis: {axis}, index: {index}")
+
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+        if axis not in SLICE_AXES:
+            raise HTTPException(status_code=400, detail=f"axis must be one of {', '.join(SLICE_AXES)}")
+        _validate_rendering(format, downsample_rate, norm)
+        region = parse_roi(roi)
+
+        try:
+            with span("volume"):
+                volume = await volume_store.load(client, pool, url)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        with span("normalise"):
+            window = await _display_window(client, pool, url, norm)
+        try:
+            with span("render"):
+                encoded = await pool.run(
+                    render_volume_slice, volume.path, axis, index, region, downsample_rate, format, quality, window
+                )
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        logger.info(f"Converted {axis} slice {index} to {format}, size: {len(encoded.body)} bytes")
+        record_span("encode", encoded.encode_seconds)
+        proxied_bytes.inc(len(encoded.body), "tiff-pages/slice")
+        return Response(content=encoded.body, media_type=encoded.media_type, headers=_encoding_headers([encoded]))
+
+@proxy_router.get("/tiff-pages/stats")
+async def proxy_tiff_stats(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Return the stack-wide statistics behind norm=stack and norm=percentile:
+    min/max, percentiles and a histogram, computed once per TIFF version.
+    """
+    with upstream_errors(url, "computing TIFF statistics"):
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+
+        stats = await load_stack_stats(client, pool, url)
+        return JSONResponse(content=stats.to_dict(), headers=PROXY_HEADERS)
+
+async def _load_pyramid(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    page: int,
+    tile_size: int
+) -> PagePyramid:
+    """Return the display pyramid of a page, building and caching it on first use"""
+    if tile_size not in TILE_SIZES:
+        raise HTTPException(status_code=400, detail=f"tile_size must be one of {TILE_SIZES}")
+    with span("describe"):
+        descriptor = await load_descriptor(client, pool, url)
+    if page < 0 or page >= len(descriptor.pages):
+        raise HTTPException(status_code=404, detail=f"Page {page} not found")
+
+    key = (url, descriptor.version, page, tile_size)
+    pyramid = pyramid_cache.get(key)
+    record_cache("pyramid", pyramid is not None)
+    if pyramid is None:
+        pyramid = await pyramid_flight.do(key, lambda: _build_pyramid(client, pool, url, page, tile_size, key))
+    return pyramid
+
+async def _build_pyramid(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    page: int,
+    tile_size: int,
+    key: Tuple,
+) -> PagePyramid:
+    with span("fetch"):
+        source = await load_pages_source(client, pool, url, [page])
+    with span("pyramid"):
+        pyramid = await pool.run(build_page_pyramid, source, page, tile_size)
+    pyramid_cache.put(key, pyramid, pyramid.nbytes)
+    logger.info(f"Built {len(pyramid.levels)}-level pyramid for page {page}, size: {pyramid.nbytes} bytes")
+    return pyramid
+
+@proxy_router.get("/tiff-pages/pyramid")
+async def proxy_tiff_pyramid(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    page: int = Query(..., description="Page number (0-based)"),
+    tile_size: int = Query(256, description="Tile edge length in pixels"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Describe the multi-resolution pyramid of a page: the size of every level
+    and how many tiles it has. Level 0 is full resolution and each further
+    level halves both dimensions, so viewers can show a coarse overview first
+    and fetch full-resolution tiles only for the visible region.
+    """
+    with upstream_errors(url, "building pyramid"):
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+
+        pyramid = await _load_pyramid(client, pool, url, page, tile_size)
+        return JSONResponse(content={"page": page, **pyramid.describe()}, headers=PROXY_HEADERS)
+
+@proxy_router.get("/tiff-pages/tile")
+async def proxy_tiff_tile(
+    url: str = Query(..., description="The S3 URL to proxy"),
+    page: int = Query(..., description="Page number (0-based)"),
+    level: int = Query(0, description="Pyramid level, 0 is full resolution"),
+    x: int = Query(..., description="Tile column"),
+    y: int = Query(..., description="Tile row"),
+    tile_size: int = Query(256, description="Tile edge length in pixels"),
+    format: str = Query("png-fast", description=f"Tile encoding, one of {', '.join(ENCODINGS)}"),
+    quality: int = Query(90, ge=1, le=100, description="JPEG quality"),
+    client: httpx.AsyncClient = Depends(get_http_client),
+    pool: ImageWorkerPool = Depends(get_image_pool)
+):
+    """
+    Return one 8-bit tile of a page's pyramid, as a grayscale PNG by default.
+    """
+    with upstream_errors(url, "serving tile"):
+        if not url.startswith(("https://", "http://")):
+            raise HTTPException(status_code=400, detail="Invalid URL scheme")
+
+        _validate_rendering(format, 1)
+        pyramid = await _load_pyramid(client, pool, url, page, tile_size)
+        if level < 0 or level >= len(pyramid.levels):
+            raise HTTPException(status_code=404, detail=f"Level {level} not found")
+        try:
+            encoded = await pool.run(encode_tile, pyramid.levels[level], x, y, tile_size, format, quality)
+        except IndexError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+        record_span("encode", encoded.encode_seconds)
+        proxied_bytes.inc(len(encoded.body), "tiff-pages/tile")
+        return Response(content=encoded.body, media_type=encoded.media_type, headers=_encoding_headers([encoded]))
@@ -1,8 +1,14 @@
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import Response
-import yaml
-import re
-from Models.YamlModels import YamlGenerateRequest
+from fastapi.responses import Response, StreamingResponse
+import copy
+import io
+import itertools
+import json
+import zipfile
+from typing import Any, Dict, Iterator, List, Tuple
+from Models.YamlModels import YamlBatchRequest, YamlGenerateRequest
+from utils.metrics import span
+from utils.sweeps import dump_pipeline, expand_range, pipeline_variants, tag_sweep
 
 
 yaml_router = APIRouter(
@@ -13,33 +19,21 @@ yaml_router = APIRouter(
 @yaml_router.post("/generate")
 async def generate_yaml(request: YamlGenerateRequest):
     try:
-        # Convert data to YAML
-        yaml_content = yaml.dump(request.data, sort_keys=False, default_flow_style=False)
-        
-        # Post-process the YAML string to add custom tags if needed
+        data = copy.deepcopy(request.data)
+
+        # Tag the swept parameter so the dumper writes it with !Sweep or !SweepRange
         if request.sweepConfig:
-            method_id = request.sweepConfig.methodId
-            param_name = request.sweepConfig.paramName
-            sweep_type = request.sweepConfig.sweepType
-            tag = "!SweepRange" if sweep_type == "range" else "!Sweep"
-            
-            # Split YAML content into entries (each method is a separate entry)
-            yaml_entries = yaml_content.split('- method:')
-            header = yaml_entries[0]  # Store any header content
-            entries = ['- method:' + entry for entry in yaml_entries[1:]]  # Restore the "- method:" prefix
-            
-            # Process each entry
-            for i, entry in enumerate(entries):
-                # Check if this is the target method
-                if f"method: {method_id}" in entry.split('\n')[0]:
-                    # Replace parameter in this entry only
-                    param_pattern = f"(\\s+{param_name}:)(\\s+)"
-                    entries[i] = re.sub(param_pattern, f"\\1 {tag}\\2", entry)
-                    break
-            
-            # Reconstruct the YAML content
-            yaml_content = header + ''.join(entries)
-        
+            tag_sweep(
+                data,
+                request.sweepConfig.methodId,
+                request.sweepConfig.paramName,
+                request.sweepConfig.sweepType,
+            )
+
+        # Convert data to YAML
+        with span("yaml_dump"):
+            yaml_content = dump_pipeline(data)
+
         # Set the response headers for file download
         filename = f"{request.fileName}.yaml"
         headers = {
@@ -52,6 +46,81 @@ async def generate_yaml(request: YamlGenerateRequest):
             media_type='application/x-yaml',
             headers=headers
         )
+
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid sweep: {e.args[0] if e.args else e}")
     
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating YAML: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error generating YAML: {str(e)}")
+
+class _ZipBuffer(io.RawIOBase):
+    """Write-only stream collecting what zipfile writes until it is drained"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _zip_variants(variants: Iterator[Tuple[str, Dict[str, Any], str]], file_name: str) -> Iterator[bytes]:
+    """Yield a zip archive of the variants file by file, ending with a manifest"""
+    buffer = _ZipBuffer()
+    manifest = []
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for stem, overrides, yaml_content in variants:
+            name = f"{file_name}_{stem}.yaml"
+            archive.writestr(name, yaml_content)
+            manifest.append({"file": name, "parameters": overrides})
+            yield buffer.drain()
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+    yield buffer.drain()
+
+@yaml_router.post("/generate/batch")
+async def generate_yaml_batch(request: YamlBatchRequest):
+    """
+    Generate one pipeline per combination of the sweep axes (every
+    combination in grid mode, element-wise in zip mode) and return them
+    all in a streamed zip, with a manifest.json of the values of each file.
+    """
+    try:
+        axes = []
+        for axis in request.axes:
+            if axis.range is not None:
+                values = expand_range(axis.range.start, axis.range.stop, axis.range.step)
+            elif axis.values is not None:
+                values = axis.values
+            else:
+                raise ValueError(f"Axis {axis.methodId}.{axis.paramName} needs values or a range")
+            axes.append((axis.methodId, axis.paramName, values))
+
+        sweep = None
+        if request.sweepConfig:
+            sweep = (request.sweepConfig.methodId, request.sweepConfig.paramName, request.sweepConfig.sweepType)
+
+        # Generate the first variant now so that invalid axes fail before the response starts
+        variants = pipeline_variants(request.data, axes, request.mode, sweep)
+        first = next(variants)
+
+        headers = {
+            'Content-Disposition': f'attachment; filename="{request.fileName}.zip"',
+        }
+        return StreamingResponse(
+            _zip_variants(itertools.chain([first], variants), request.fileName),
+            media_type='application/zip',
+            headers=headers
+        )
+
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid sweep: {e.args[0] if e.args else e}")
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating YAML: {str(e)}")
@@ -0,0 +1,226 @@
+"""
+Admission control for heavy proxy work. Upstream fetches, upstream bytes in
+flight and image decode/encode jobs each have a limit; work over a limit
+waits in a bounded queue ordered by priority, and requests arriving when
+the queue is full are rejected straight away so the client can retry later.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Coroutine, Dict, List, Optional
+
+from utils.config import (
+    ADMISSION_MAX_BYTES,
+    ADMISSION_MAX_FETCHES,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_QUEUE_DEPTH,
+    ADMISSION_RETRY_AFTER,
+)
+from utils.metrics import Counter, Gauge, Histogram, LabelValues, record_span, registry
+
+logger = logging.getLogger(__name__)
+
+# Lower values are admitted first
+INTERACTIVE, BATCH, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch", BACKGROUND: "background"}
+
+# Priority of the work running in the current request or task
+current_priority: ContextVar[int] = ContextVar("admission_priority", default=INTERACTIVE)
+# Set while the current request or task holds a byte reservation covering its upstream responses
+bytes_reserved: ContextVar[bool] = ContextVar("admission_bytes_reserved", default=False)
+
+
+def priority(level: int) -> Callable[[], Coroutine]:
+    """
+    FastAPI dependency setting the admission priority of a route, e.g.
+    dependencies=[Depends(priority(BATCH))]. Async so that it runs in the
+    request's own context rather than in a thread.
+    """
+    async def dependency() -> None:
+        current_priority.set(level)
+    return dependency
+
+
+class Overloaded(Exception):
+    """Raised when work cannot be admitted: its queue is full or it waited too long"""
+
+    def __init__(self, resource: str, message: str, retry_after: int = ADMISSION_RETRY_AFTER):
+        super().__init__(message)
+        self.resource = resource
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """
+    A capacity, counted in jobs or bytes, shared by concurrent work.
+
+    Work that does not fit waits in a queue, highest priority first and
+    first come first served within a priority; the head of the queue is
+    never overtaken, so large requests are not starved by small ones.
+    Background work always queues and waits as long as it takes. Other work
+    is rejected with Overloaded when max_queue callers are already waiting
+    or after waiting max_wait seconds.
+
+    Parameters
+    ----------
+    name : str
+        Label of the resource in the admission metrics
+    capacity : int
+        Amount that can be in use at once; larger requests are clamped to it
+        and run alone
+    max_queue : int
+        Non-background callers allowed to wait
+    max_wait : float
+        Seconds a non-background caller waits before being rejected
+    """
+
+    def __init__(self, name: str, capacity: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.capacity = max(capacity, 1)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_use = 0
+        self.queued = 0
+        self._queued_requests = 0
+        self._queue: List[list] = []
+        self._order = itertools.count()
+        limiters[name] = self
+
+    async def admit(self, amount: int = 1, level: Optional[int] = None) -> int:
+        """
+        Wait until amount fits, take it and return the amount taken, which
+        must be given back with release().
+
+        Raises
+        ------
+        Overloaded
+            If the queue is full or the wait exceeded max_wait
+        """
+        level = current_priority.get() if level is None else level
+        amount = min(max(amount, 0), self.capacity)
+        if not self._queue and self.in_use + amount <= self.capacity:
+            self.in_use += amount
+            admission_wait.observe(0.0, self.name, PRIORITY_NAMES[level])
+            return amount
+
+        background = level >= BACKGROUND
+        if not background and self._queued_requests >= self.max_queue:
+            admission_rejected.inc(1, self.name, "queue_full")
+            raise Overloaded(self.name, f"Server busy: {self.queued} {self.name} jobs are already waiting")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, [level, next(self._order), amount, future])
+        self._set_queued(1, background)
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(None if background else self.max_wait):
+                await future
+        except (TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Admitted just as the wait ended; hand the amount back
+                self.release(amount)
+            else:
+                future.cancel()
+                self._set_queued(-1, background)
+                self._wake()
+            if isinstance(e, TimeoutError):
+                admission_rejected.inc(1, self.name, "timeout")
+                raise Overloaded(self.name, f"Server busy: waited {self.max_wait:.0f} s for {self.name} capacity")
+            raise
+        waited = time.perf_counter() - started
+        admission_wait.observe(waited, self.name, PRIORITY_NAMES[level])
+        record_span(f"queue_{self.name}", waited)
+        return amount
+
+    def release(self, amount: int) -> None:
+        self.in_use -= amount
+        self._wake()
+
+    @asynccontextmanager
+    async def acquire(self, amount: int = 1, level: Optional[int] = None) -> AsyncIterator[None]:
+        """Hold amount of the capacity for the enclosed block"""
+        taken = await self.admit(amount, level)
+        try:
+            yield
+        finally:
+            self.release(taken)
+
+    def to_dict(self) -> Dict:
+        return {"capacity": self.capacity, "in_use": self.in_use, "queued": self.queued}
+
+    def _set_queued(self, change: int, background: bool) -> None:
+        self.queued += change
+        if not background:
+            self._queued_requests += change
+
+    def _wake(self) -> None:
+        while self._queue:
+            level, _, amount, future = self._queue[0]
+            if future.done():
+                # Left the queue after a timeout or cancellation
+                heapq.heappop(self._queue)
+                continue
+            if self.in_use + amount > self.capacity:
+                return
+            heapq.heappop(self._queue)
+            self.in_use += amount
+            self._set_queued(-1, level >= BACKGROUND)
+            future.set_result(None)
+
+
+# Every limiter by resource name, for the metrics and /health/ready
+limiters: Dict[str, Limiter] = {}
+
+admission_wait = registry.register(Histogram(
+    "tomohub_admission_wait_seconds",
+    "Time work waited for capacity before it was admitted, by resource and priority",
+    ("resource", "priority"),
+))
+admission_rejected = registry.register(Counter(
+    "tomohub_admission_rejected_total",
+    "Work rejected with 503 by resource and reason: queue_full or timeout",
+    ("resource", "reason"),
+))
+
+
+def _limiter_values(field: str) -> Callable[[], Dict[LabelValues, float]]:
+    return lambda: {(name,): getattr(limiter, field) for name, limiter in limiters.items()}
+
+
+registry.register(Gauge(
+    "tomohub_admission_in_use",
+    "Capacity in use by resource: upstream fetches, upstream bytes or image jobs",
+    ("resource",),
+    callback=_limiter_values("in_use"),
+))
+registry.register(Gauge(
+    "tomohub_admission_queue_depth",
+    "Work waiting for capacity, by resource",
+    ("resource",),
+    callback=_limiter_values("queued"),
+))
+
+# Upstream requests in flight, held until the response body is closed
+fetch_limiter = Limiter("fetch", ADMISSION_MAX_FETCHES, ADMISSION_QUEUE_DEPTH, ADMISSION_MAX_WAIT)
+# Upstream response bytes in flight, reserved from Content-Length
+bytes_limiter = Limiter("bytes", ADMISSION_MAX_BYTES, ADMISSION_QUEUE_DEPTH, ADMISSION_MAX_WAIT)
+
+
+@asynccontextmanager
+async def reserve_bytes(amount: int) -> AsyncIterator[None]:
+    """
+    Hold amount of the byte limit for the enclosed block, e.g. the page data
+    of a batch from its fetch until its pages are rendered, rather than only
+    while the upstream bodies are read. Upstream responses fetched inside the
+    block are covered by the reservation and not counted again.
+    """
+    async with bytes_limiter.acquire(amount):
+        token = bytes_reserved.set(True)
+        try:
+            yield
+        finally:
+            bytes_reserved.reset(token)
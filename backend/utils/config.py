@@ -0,0 +1,85 @@
+"""
+Runtime settings for the backend, read once from environment variables.
+Every setting has a default suitable for a single-container deployment.
+"""
+import os
+import tempfile
+from typing import Optional
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_str(name: str, default: Optional[str] = None) -> Optional[str]:
+    value = os.environ.get(name)
+    return value if value not in (None, "") else default
+
+
+# Upstream TIFF cache shared by the proxy endpoints
+TIFF_CACHE_MAX_BYTES = _env_int("TOMOHUB_TIFF_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+TIFF_CACHE_TTL = _env_float("TOMOHUB_TIFF_CACHE_TTL", 300.0)
+TIFF_CACHE_SPILL_DIR = _env_str("TOMOHUB_TIFF_CACHE_SPILL_DIR")
+TIFF_CACHE_SPILL_MAX_BYTES = _env_int("TOMOHUB_TIFF_CACHE_SPILL_MAX_BYTES", 8 * 1024 * 1024 * 1024)
+# Budget for cached stack descriptors (page structure and IFD bytes)
+DESCRIPTOR_CACHE_MAX_BYTES = _env_int("TOMOHUB_DESCRIPTOR_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+# Stack-wide statistics behind norm=stack and norm=percentile
+STACK_STATS_MAX_PAGES = _env_int("TOMOHUB_STACK_STATS_MAX_PAGES", 64)
+STACK_STATS_SAMPLE_PIXELS = _env_int("TOMOHUB_STACK_STATS_SAMPLE_PIXELS", 16 * 1024 * 1024)
+STACK_STATS_BINS = _env_int("TOMOHUB_STACK_STATS_BINS", 256)
+STACK_STATS_PERCENTILES = tuple(
+    float(value) for value in _env_str("TOMOHUB_STACK_STATS_PERCENTILES", "0.5,99.5").split(",")
+)
+STACK_STATS_EXACT = _env_int("TOMOHUB_STACK_STATS_EXACT", 0) == 1
+# Budget for the display pyramids behind the tile endpoints
+PYRAMID_CACHE_MAX_BYTES = _env_int("TOMOHUB_PYRAMID_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+# Budget for rendered pages, filled by the page endpoint and prefetch jobs
+PAGE_CACHE_MAX_BYTES = _env_int("TOMOHUB_PAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+# Background prefetch jobs rendering whole stacks
+PREFETCH_MAX_JOBS = _env_int("TOMOHUB_PREFETCH_MAX_JOBS", 4)
+PREFETCH_CHUNK_PAGES = _env_int("TOMOHUB_PREFETCH_CHUNK_PAGES", 16)
+PREFETCH_CONCURRENCY = _env_int("TOMOHUB_PREFETCH_CONCURRENCY", 2)
+# Memory-mapped local copies of stacks behind the slice endpoints
+VOLUME_STORE_DIR = _env_str("TOMOHUB_VOLUME_STORE_DIR", os.path.join(tempfile.gettempdir(), "tomohub-volumes"))
+VOLUME_STORE_MAX_BYTES = _env_int("TOMOHUB_VOLUME_STORE_MAX_BYTES", 32 * 1024 * 1024 * 1024)
+# On-disk cache shared by every worker process; disabled when unset
+SHARED_CACHE_DIR = _env_str("TOMOHUB_SHARED_CACHE_DIR")
+SHARED_CACHE_MAX_BYTES = _env_int("TOMOHUB_SHARED_CACHE_MAX_BYTES", 8 * 1024 * 1024 * 1024)
+SHARED_CACHE_LOCK_TIMEOUT = _env_float("TOMOHUB_SHARED_CACHE_LOCK_TIMEOUT", 120.0)
+# Chunk size used when /proxy/tiff streams a file through
+PROXY_STREAM_CHUNK_BYTES = _env_int("TOMOHUB_PROXY_STREAM_CHUNK_BYTES", 1024 * 1024)
+
+# Pooled HTTP client used for every upstream request
+HTTP_TIMEOUT = _env_float("TOMOHUB_HTTP_TIMEOUT", 60.0)
+HTTP_MAX_CONNECTIONS = _env_int("TOMOHUB_HTTP_MAX_CONNECTIONS", 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = _env_int("TOMOHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+HTTP_KEEPALIVE_EXPIRY = _env_float("TOMOHUB_HTTP_KEEPALIVE_EXPIRY", 30.0)
+HTTP2 = _env_int("TOMOHUB_HTTP2", 1) == 1
+HTTP_RETRIES = _env_int("TOMOHUB_HTTP_RETRIES", 3)
+HTTP_RETRY_BACKOFF = _env_float("TOMOHUB_HTTP_RETRY_BACKOFF", 0.25)
+
+# Worker pool for CPU-bound image decoding and encoding
+IMAGE_EXECUTOR = _env_str("TOMOHUB_IMAGE_EXECUTOR", "thread")
+IMAGE_WORKERS = _env_int("TOMOHUB_IMAGE_WORKERS", os.cpu_count() or 4)
+IMAGE_QUEUE_DEPTH = _env_int("TOMOHUB_IMAGE_QUEUE_DEPTH", 32)
+
+# Admission control: limits on heavy work, beyond which requests queue by
+# priority and are rejected with 503 once the queue is full or too slow
+ADMISSION_MAX_FETCHES = _env_int("TOMOHUB_ADMISSION_MAX_FETCHES", 32)
+ADMISSION_MAX_BYTES = _env_int("TOMOHUB_ADMISSION_MAX_BYTES", 1024 * 1024 * 1024)
+ADMISSION_QUEUE_DEPTH = _env_int("TOMOHUB_ADMISSION_QUEUE_DEPTH", 64)
+ADMISSION_MAX_WAIT = _env_float("TOMOHUB_ADMISSION_MAX_WAIT", 30.0)
+ADMISSION_RETRY_AFTER = _env_int("TOMOHUB_ADMISSION_RETRY_AFTER", 2)
+
+# Startup warm-up of the method backends and the method catalog
+METHOD_WARMUP = _env_int("TOMOHUB_METHOD_WARMUP", 1) == 1
+METHOD_WARMUP_WORKERS = _env_int("TOMOHUB_METHOD_WARMUP_WORKERS", 8)
+
+# Period of the event-loop lag probe behind /metrics, in seconds
+EVENT_LOOP_LAG_INTERVAL = _env_float("TOMOHUB_EVENT_LOOP_LAG_INTERVAL", 0.5)
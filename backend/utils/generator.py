@@ -8,6 +8,7 @@ import yaml
 import inspect
 import importlib
 from typing import Dict, Union
+from utils.method_imports import module_importer
 
  
 
@@ -97,8 +98,8 @@ def generate_method_template(module_name: str, method_name: str) -> Dict:
     discard_params = _get_discard_params()
     mustchange_params = _get_mustchange_params()
 
-    # Import the module
-    imported_module = importlib.import_module(str(module_name))
+    # Import the module, failing fast if it failed before
+    imported_module = module_importer.import_module(str(module_name))
     
     # Get the method 
     method = getattr(imported_module, method_name)
@@ -0,0 +1,151 @@
+import asyncio
+import importlib.util
+import logging
+
+import httpx
+from starlette.requests import HTTPConnection
+
+from utils.admission import bytes_limiter, bytes_reserved, fetch_limiter
+from utils.config import (
+    HTTP_TIMEOUT,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP2,
+    HTTP_RETRIES,
+    HTTP_RETRY_BACKOFF,
+)
+
+logger = logging.getLogger(__name__)
+
+# Upstream statuses worth retrying, S3 returns 503 "SlowDown" when throttling
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Transport wrapper that retries transient failures with exponential backoff.
+
+    Timeouts, connection errors and 5xx responses are retried up to
+    `retries` times, waiting backoff * 2**attempt seconds in between.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, retries: int, backoff: float):
+        self._transport = transport
+        self.retries = retries
+        self.backoff = backoff
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = await self._transport.handle_async_request(request)
+            except (httpx.TimeoutException, httpx.NetworkError) as e:
+                if attempt >= self.retries:
+                    raise
+                logger.warning(f"Retrying {request.url} after {type(e).__name__}")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response
+                await response.aclose()
+                logger.warning(f"Retrying {request.url} after status {response.status_code}")
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class AdmittedStream(httpx.AsyncByteStream):
+    """Response body that gives its admission back once it is closed"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+class AdmissionTransport(httpx.AsyncBaseTransport):
+    """
+    Transport wrapper holding a fetch slot from utils.admission for every
+    upstream request, and the response size in bytes once the headers are
+    in, until the response body is closed. Requests sent with the extension
+    {"passthrough": True} stream their body straight to the client, and
+    requests inside utils.admission.reserve_bytes are already covered by its
+    reservation; neither is counted against the byte limit.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        fetch = await fetch_limiter.admit()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            fetch_limiter.release(fetch)
+            raise
+        size = 0
+        if not request.extensions.get("passthrough") and not bytes_reserved.get():
+            try:
+                size = int(response.headers.get("content-length", 0))
+            except ValueError:
+                size = 0
+        try:
+            size = await bytes_limiter.admit(size)
+        except BaseException:
+            await response.aclose()
+            fetch_limiter.release(fetch)
+            raise
+
+        def release() -> None:
+            bytes_limiter.release(size)
+            fetch_limiter.release(fetch)
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=AdmittedStream(response.stream, release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Create the pooled client shared by every upstream request for the lifetime of the app.
+    """
+    http2 = HTTP2 and importlib.util.find_spec("h2") is not None
+    if HTTP2 and not http2:
+        logger.warning("The h2 package is not installed, falling back to HTTP/1.1")
+
+    transport = httpx.AsyncHTTPTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return httpx.AsyncClient(
+        transport=AdmissionTransport(RetryTransport(transport, HTTP_RETRIES, HTTP_RETRY_BACKOFF)),
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+def get_http_client(connection: HTTPConnection) -> httpx.AsyncClient:
+    """FastAPI dependency returning the client created in the app lifespan, for HTTP and WebSocket routes"""
+    return connection.app.state.http_client
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+
+class ByteLRU:
+    """
+    Least-recently-used mapping bounded by the total size of its values in bytes.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The byte budget; the oldest entries are evicted once it is exceeded
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the value for key and mark it as most recently used"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> List[Tuple[Hashable, Any]]:
+        """
+        Insert or replace an entry.
+
+        Returns
+        -------
+        List[Tuple[Hashable, Any]]
+            The entries evicted to stay within budget. A value larger than the
+            whole budget is not stored and is returned as evicted straight away.
+        """
+        self.pop(key)
+        if size > self.max_bytes:
+            return [(key, value)]
+        self._entries[key] = (value, size)
+        self.current_bytes += size
+        evicted = []
+        while self.current_bytes > self.max_bytes:
+            old_key, (old_value, old_size) = self._entries.popitem(last=False)
+            self.current_bytes -= old_size
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """Remove an entry, returning its value if it was present"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self.current_bytes -= entry[1]
+        return entry[0]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.current_bytes = 0
@@ -0,0 +1,222 @@
+"""
+The method catalog served by /methods, built once per installed version of
+the method libraries and kept as ready-to-send response bodies.
+"""
+import asyncio
+import gzip
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from importlib import metadata
+from typing import Dict, List, Optional, Tuple
+
+from Models.MethodsTemplate import AllTemplates
+from utils.generator import generate_method_template
+from utils.method_imports import import_method_modules
+from utils.metrics import record_cache, span
+from utils.methods import METHOD_CATEGORIES
+from utils.shared_store import shared_store
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Packages whose installed versions determine the catalog
+CATALOG_PACKAGES = ("httomolib", "httomolibgpu")
+# Catalog entry holding every category
+ALL_CATEGORIES = "all"
+# Bodies of a catalog entry kept in the shared cache
+CATALOG_PARTS = ("body", "gzip_body", "brotli_body")
+
+
+def get_methods_templates(module_methods: Dict[str, List[str]]) -> Dict:
+    """
+    Helper function to generate templates for a given module and its methods
+    """
+    result = {}
+    with span("method_templates"):
+        for module, methods in module_methods.items():
+            module_templates = {}
+            try:
+                for method in methods:
+                    template = generate_method_template(module, method)
+                    if template:
+                        module_templates[method] = template
+                if module_templates:
+                    result[module] = module_templates
+            except ImportError:
+                logger.debug(f"Could not import module {module}")
+    return result
+
+
+def package_versions() -> Tuple[Tuple[str, Optional[str]], ...]:
+    """Return the installed version of each of CATALOG_PACKAGES, None if missing"""
+    versions = []
+    for package in CATALOG_PACKAGES:
+        try:
+            versions.append((package, metadata.version(package)))
+        except metadata.PackageNotFoundError:
+            versions.append((package, None))
+    return tuple(versions)
+
+
+@dataclass
+class CatalogEntry:
+    """One serialised catalog response in every supported content encoding"""
+    etag: str
+    body: bytes
+    gzip_body: bytes
+    brotli_body: Optional[bytes]
+
+    def encoded(self, accept_encoding: str) -> Tuple[bytes, Optional[str]]:
+        """
+        Return the smallest body the client accepts and its Content-Encoding,
+        None meaning identity.
+        """
+        accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+        if self.brotli_body is not None and "br" in accepted:
+            return self.brotli_body, "br"
+        if "gzip" in accepted:
+            return self.gzip_body, "gzip"
+        return self.body, None
+
+    def etag_of(self, content_encoding: Optional[str]) -> str:
+        """
+        Return the strong ETag of the body in a content encoding, None meaning
+        identity. Each encoding is a different representation, so it gets its
+        own tag, e.g. "<digest>-gzip".
+        """
+        if content_encoding is None:
+            return self.etag
+        return f'{self.etag[:-1]}-{content_encoding}"'
+
+
+def _etag(body: bytes, versions: Tuple) -> str:
+    digest = hashlib.sha256(repr(versions).encode("utf-8") + body).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def _serialise(templates: Dict, versions: Tuple) -> CatalogEntry:
+    body = AllTemplates(root=templates).model_dump_json().encode("utf-8")
+    return CatalogEntry(
+        etag=_etag(body, versions),
+        body=body,
+        gzip_body=gzip.compress(body, compresslevel=9, mtime=0),
+        brotli_body=brotli.compress(body) if brotli is not None else None,
+    )
+
+
+def _load_shared(versions: Tuple) -> Optional[Dict[str, CatalogEntry]]:
+    """Return the catalog another worker process stored for versions, if complete"""
+    entries = {}
+    for category in (*METHOD_CATEGORIES, ALL_CATEGORIES):
+        bodies = {}
+        for part in CATALOG_PARTS:
+            if part == "brotli_body" and brotli is None:
+                bodies[part] = None
+                continue
+            bodies[part] = shared_store.get(("catalog", versions, category, part), "shared_catalog")
+            if bodies[part] is None:
+                return None
+        entries[category] = CatalogEntry(etag=_etag(bodies["body"], versions), **bodies)
+    return entries
+
+
+def _store_shared(versions: Tuple, entries: Dict[str, CatalogEntry]) -> None:
+    for category, entry in entries.items():
+        for part in CATALOG_PARTS:
+            if getattr(entry, part) is not None:
+                shared_store.put(("catalog", versions, category, part), getattr(entry, part))
+
+
+class MethodCatalog:
+    """
+    Templates of every method in METHOD_CATEGORIES, one entry per category
+    plus ALL_CATEGORIES. Each method is introspected once per catalog build
+    and the catalog is rebuilt only when the package versions change.
+    """
+
+    def __init__(self):
+        self.versions: Optional[Tuple] = None
+        self._entries: Dict[str, CatalogEntry] = {}
+        self._lock = threading.Lock()
+
+    def get(self, category: str) -> CatalogEntry:
+        """
+        Return the entry of a category, building the catalog if needed. This
+        blocks while the method modules are imported, so call it from a thread.
+
+        Raises
+        ------
+        KeyError
+            If there is no such category
+        """
+        if category != ALL_CATEGORIES and category not in METHOD_CATEGORIES:
+            raise KeyError(category)
+        entries = self._entries
+        record_cache("method_catalog", bool(entries))
+        if not entries:
+            self.build()
+            entries = self._entries
+        return entries[category]
+
+    def build(self) -> None:
+        """
+        Introspect every method and serialise the catalog, unless it is
+        current. A catalog already built by another worker process for the
+        same versions is read from the shared cache instead.
+        """
+        with self._lock:
+            versions = package_versions()
+            if self._entries and versions == self.versions:
+                return
+            with shared_store.lock(("catalog", versions)):
+                entries = _load_shared(versions)
+                if entries is not None:
+                    logger.info(f"Loaded method catalog for {dict(versions)} from the shared cache")
+                else:
+                    entries = self._introspect(versions)
+                    _store_shared(versions, entries)
+            self._entries = entries
+            self.versions = versions
+
+    def _introspect(self, versions: Tuple) -> Dict[str, CatalogEntry]:
+        entries = {}
+        all_templates = {}
+        for category, module_methods in METHOD_CATEGORIES.items():
+            templates = get_methods_templates(module_methods)
+            entries[category] = _serialise(templates, versions)
+            all_templates.update(templates)
+        entries[ALL_CATEGORIES] = _serialise(all_templates, versions)
+        logger.info(f"Built method catalog for {dict(versions)}")
+        return entries
+
+    def invalidate(self) -> None:
+        """Drop the catalog so the next request rebuilds it"""
+        with self._lock:
+            self.versions = None
+            self._entries = {}
+
+
+method_catalog = MethodCatalog()
+
+
+async def warm_up(max_workers: int) -> float:
+    """
+    Import every method module concurrently, then build the catalog, so that
+    the first request does not pay for either.
+
+    Returns
+    -------
+    float
+        The time the warm-up took, in seconds
+    """
+    started = time.perf_counter()
+    await asyncio.to_thread(import_method_modules, max_workers)
+    await asyncio.to_thread(method_catalog.build)
+    return time.perf_counter() - started
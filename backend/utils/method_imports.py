@@ -0,0 +1,114 @@
+"""
+Imports of the method backend modules, timed and negative-cached.
+"""
+import importlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import ModuleType
+from typing import Dict, List, Optional
+
+from utils.methods import METHOD_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ModuleImport:
+    """Outcome of importing one method module"""
+    module: str
+    seconds: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict:
+        return {
+            "module": self.module,
+            "ok": self.ok,
+            "import_ms": round(self.seconds * 1000, 2),
+            "error": self.error,
+        }
+
+
+class ModuleImporter:
+    """
+    Imports modules once and remembers the outcome. A module that failed to
+    import raises the same ImportError again without a new attempt, so
+    backends missing on a node (e.g. GPU libraries on CPU-only nodes) cost
+    nothing after the first try.
+    """
+
+    def __init__(self):
+        self._imports: Dict[str, ModuleImport] = {}
+        self._lock = threading.Lock()
+
+    def import_module(self, name: str) -> ModuleType:
+        """
+        Import a module, recording how long it took.
+
+        Raises
+        ------
+        ImportError
+            If the module cannot be imported, now or on an earlier attempt
+        """
+        record = self._imports.get(name)
+        if record is not None and not record.ok:
+            raise ImportError(f"{name} failed to import earlier: {record.error}")
+        if record is not None:
+            return importlib.import_module(name)
+
+        started = time.perf_counter()
+        try:
+            module = importlib.import_module(name)
+        except Exception as e:
+            # Any failure while importing, not just ImportError, makes the module unusable
+            with self._lock:
+                self._imports[name] = ModuleImport(name, time.perf_counter() - started, f"{type(e).__name__}: {e}")
+            logger.warning(f"Could not import {name}: {e}")
+            raise ImportError(f"Could not import {name}: {e}") from e
+        with self._lock:
+            self._imports.setdefault(name, ModuleImport(name, time.perf_counter() - started))
+        return module
+
+    def imports(self) -> List[ModuleImport]:
+        with self._lock:
+            return list(self._imports.values())
+
+    def forget(self) -> None:
+        """Drop every recorded outcome, so failed modules are tried again"""
+        with self._lock:
+            self._imports.clear()
+
+
+module_importer = ModuleImporter()
+
+
+def method_modules() -> List[str]:
+    """Every module named in METHOD_CATEGORIES, in order and without repeats"""
+    return list(dict.fromkeys(
+        module for module_methods in METHOD_CATEGORIES.values() for module in module_methods
+    ))
+
+
+def _try_import(name: str) -> None:
+    try:
+        module_importer.import_module(name)
+    except ImportError:
+        pass
+
+
+def import_method_modules(max_workers: int) -> None:
+    """Import every method module concurrently, recording each outcome"""
+    started = time.perf_counter()
+    modules = method_modules()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="method-import") as executor:
+        list(executor.map(_try_import, modules))
+    failed = [record.module for record in module_importer.imports() if not record.ok]
+    logger.info(
+        f"Imported {len(modules)} method modules in {time.perf_counter() - started:.2f}s, {len(failed)} failed"
+    )
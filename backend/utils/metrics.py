@@ -0,0 +1,308 @@
+"""
+In-process metrics: counters, gauges and histograms rendered in the
+Prometheus text format, request spans reported as Server-Timing headers,
+and an event-loop lag monitor.
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """Base of the metric types: a name, help text and label names"""
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A monotonically increasing count per label combination"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def items(self) -> List[Tuple[LabelValues, float]]:
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in self.items()
+        ]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Either set directly or, with a callback,
+    read at scrape time; the callback returns {label values: value}.
+    """
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+    ):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._callback = callback
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self) -> List[str]:
+        if self._callback is not None:
+            items = list(self._callback().items())
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in items
+        ]
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, with their sum and count"""
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label combination: bucket counts (last one +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            counts, total = self._values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[labels] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(labels, (list(counts), total)) for labels, (counts, total) in self._values.items()]
+        lines = self.header()
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The metrics rendered by /metrics, in registration order"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Could not collect metric {metric.name}: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Histogram(
+    "tomohub_http_request_duration_seconds",
+    "Time to produce the response headers, by route, method and status",
+    ("route", "method", "status"),
+))
+span_seconds = registry.register(Histogram(
+    "tomohub_span_duration_seconds",
+    "Time spent in each named step of request handling",
+    ("span",),
+))
+proxied_bytes = registry.register(Counter(
+    "tomohub_proxied_bytes_total",
+    "Bytes of TIFF data and rendered images sent to clients, by endpoint",
+    ("endpoint",),
+))
+upstream_bytes = registry.register(Counter(
+    "tomohub_upstream_bytes_total",
+    "Bytes read from the object store, by kind of request",
+    ("kind",),
+))
+cache_requests = registry.register(Counter(
+    "tomohub_cache_requests_total",
+    "Cache lookups by cache and result (hit or miss)",
+    ("cache", "result"),
+))
+singleflight_calls = registry.register(Counter(
+    "tomohub_singleflight_calls_total",
+    "Calls of coalesced work by flight and role: leaders started the work, "
+    "followers joined an identical call in flight and saved a repeat",
+    ("flight", "role"),
+))
+stream_pages = registry.register(Counter(
+    "tomohub_stream_pages_total",
+    "Page requests received on the page stream WebSocket by outcome: sent, "
+    "failed, superseded by a newer request before starting, or cancelled",
+    ("outcome",),
+))
+event_loop_lag = registry.register(Histogram(
+    "tomohub_event_loop_lag_seconds",
+    "Delay of a periodic timer beyond its due time on the event loop",
+))
+
+
+def _cache_hit_ratios() -> Dict[LabelValues, float]:
+    caches = {cache for (cache, _), _ in cache_requests.items()}
+    ratios = {}
+    for cache in caches:
+        hits = cache_requests.value(cache, "hit")
+        total = hits + cache_requests.value(cache, "miss")
+        ratios[(cache,)] = hits / total if total else 0.0
+    return ratios
+
+
+registry.register(Gauge(
+    "tomohub_cache_hit_ratio",
+    "Share of lookups answered by each cache since startup",
+    ("cache",),
+    callback=_cache_hit_ratios,
+))
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    cache_requests.inc(1, cache, "hit" if hit else "miss")
+
+
+# Spans of the request being handled, shared with threads started from it
+_request_spans: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "request_spans", default=None
+)
+
+
+def record_span(name: str, seconds: float) -> None:
+    """Record a step measured elsewhere, e.g. encode time reported by a worker"""
+    span_seconds.observe(seconds, name)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time the enclosed block as a named step of the current request. Works
+    around awaits, and from threads started with asyncio.to_thread.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+def server_timing(spans: List[Tuple[str, float]], total: float) -> str:
+    """Format spans as a Server-Timing header, summing repeated names"""
+    durations: Dict[str, float] = {}
+    for name, seconds in spans:
+        durations[name] = durations.get(name, 0.0) + seconds
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in durations.items()]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+async def timing_middleware(request: Request, call_next):
+    """
+    Time every request, record it by route template and add a Server-Timing
+    header listing the spans recorded while handling it.
+    """
+    spans: List[Tuple[str, float]] = []
+    token = _request_spans.set(spans)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _request_spans.reset(token)
+    elapsed = time.perf_counter() - started
+
+    route = request.scope.get("route")
+    path = getattr(route, "path", "unmatched")
+    http_requests.observe(elapsed, path, request.method, str(response.status_code))
+    response.headers["Server-Timing"] = server_timing(spans, elapsed)
+    response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
+
+async def monitor_event_loop(interval: float) -> None:
+    """Measure how late a timer fires on the event loop, until cancelled"""
+    loop = asyncio.get_running_loop()
+    while True:
+        due = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(loop.time() - due, 0.0))
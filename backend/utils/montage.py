@@ -0,0 +1,195 @@
+"""
+Montages of TIFF pages: many pages, optionally cropped to a region of
+interest and downsampled, laid out in a labelled grid and encoded as one
+image, e.g. to compare the results of a parameter sweep side by side.
+"""
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import tifffile
+from PIL import Image, ImageDraw, ImageFont
+
+from utils.tiff_pages import EncodedPage, _get_page, area_downsample, encode_array, to_display
+from utils.tiff_range import TiffSource
+
+# Encodings a montage can be returned in; montages are always 8-bit
+MONTAGE_ENCODINGS = ("png", "png-fast", "webp", "jpeg", "raw-uint8")
+# Upper bound on the pixels of one montage
+MAX_MONTAGE_PIXELS = 64 * 1024 * 1024
+
+# (x, y, width, height) in full-resolution pixels
+Roi = Tuple[int, int, int, int]
+
+
+def _crop_bounds(roi: Roi, page_height: int, page_width: int) -> Tuple[int, int, int, int]:
+    """Return the (x0, y0, x1, y1) of the region clipped to a page"""
+    x, y, width, height = roi
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, page_width), min(y + height, page_height)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"Region {roi} is outside the {page_width}x{page_height} page")
+    return x0, y0, x1, y1
+
+
+def crop(array: np.ndarray, roi: Optional[Roi]) -> np.ndarray:
+    """
+    Return a view of the region of interest of a page, clipped to the page.
+
+    Raises
+    ------
+    ValueError
+        If the region does not overlap the page
+    """
+    if roi is None:
+        return array
+    x0, y0, x1, y1 = _crop_bounds(roi, array.shape[0], array.shape[1])
+    return array[y0:y1, x0:x1]
+
+
+def tile_shape(page_shape: Sequence[int], roi: Optional[Roi] = None, downsample_rate: int = 1) -> Tuple[int, int]:
+    """
+    Return the (height, width) of the tile montage_tiles makes from a page
+    of the given shape, without reading the page.
+
+    Raises
+    ------
+    ValueError
+        If the region is outside the page or larger than the downsample rate allows
+    """
+    height, width = page_shape[0], page_shape[1]
+    if roi is not None:
+        x0, y0, x1, y1 = _crop_bounds(roi, height, width)
+        height, width = y1 - y0, x1 - x0
+    if downsample_rate > 1:
+        height, width = height // downsample_rate, width // downsample_rate
+        if height == 0 or width == 0:
+            raise ValueError(f"Downsample rate {downsample_rate} is larger than the page")
+    return height, width
+
+
+def check_montage_size(tile_shapes: Sequence[Tuple[int, int]], columns: Optional[int] = None, gap: int = 4) -> None:
+    """
+    Check that a montage of tiles of the given (height, width) fits in
+    MAX_MONTAGE_PIXELS, so that an oversized request can be rejected from
+    the page shapes before any page is fetched.
+
+    Raises
+    ------
+    ValueError
+        If the montage would exceed MAX_MONTAGE_PIXELS
+    """
+    if not tile_shapes:
+        raise ValueError("No tiles to assemble")
+    rows, columns = montage_grid(len(tile_shapes), columns)
+    tile_height = max(height for height, _ in tile_shapes)
+    tile_width = max(width for _, width in tile_shapes)
+    if rows * (tile_height + gap) * columns * (tile_width + gap) > MAX_MONTAGE_PIXELS:
+        raise ValueError(
+            f"A {rows}x{columns} montage of {tile_width}x{tile_height} tiles exceeds "
+            f"{MAX_MONTAGE_PIXELS} pixels; select fewer pages, a smaller region or downsample more"
+        )
+
+
+def montage_tiles(
+    source: TiffSource,
+    pages: List[int],
+    roi: Optional[Roi] = None,
+    downsample_rate: int = 1,
+    window: Optional[Tuple[float, float]] = None,
+) -> List[np.ndarray]:
+    """
+    Decode pages and return their 8-bit display tiles, cropped before they
+    are downsampled so that only the region is averaged and scaled. Without
+    a window each tile is stretched to its own min/max.
+
+    Raises
+    ------
+    IndexError
+        If the TIFF has no such page
+    ValueError
+        If the region is outside a page or larger than the downsample rate allows
+    """
+    tiles = []
+    with tifffile.TiffFile(source.open()) as tif:
+        for page in pages:
+            array = crop(_get_page(tif, page).asarray(), roi)
+            if array.ndim == 3:
+                # Montages are grayscale; average the samples of RGB pages
+                array = array.mean(axis=2, dtype=np.float32)
+            tiles.append(to_display(area_downsample(array, downsample_rate), window))
+    return tiles
+
+
+def montage_grid(count: int, columns: Optional[int] = None) -> Tuple[int, int]:
+    """Return the (rows, columns) of a grid of count tiles, near-square by default"""
+    if columns is None:
+        columns = math.ceil(math.sqrt(count))
+    columns = max(1, min(columns, count))
+    return math.ceil(count / columns), columns
+
+
+def _label_font(tile_height: int) -> ImageFont.ImageFont:
+    size = int(min(max(tile_height // 10, 10), 48))
+    try:
+        return ImageFont.load_default(size=size)
+    except (TypeError, ImportError, OSError):
+        # Pillow without FreeType only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+def assemble_montage(
+    tiles: List[np.ndarray],
+    labels: Optional[List[str]] = None,
+    columns: Optional[int] = None,
+    gap: int = 4,
+) -> np.ndarray:
+    """
+    Lay 8-bit tiles out row by row in a grid separated by gap black pixels.
+
+    The tiles are padded to the largest tile and the grid is built with one
+    reshape and transpose of the stacked tiles. Each label is drawn in the
+    top-left corner of its tile, white on a black box.
+
+    Raises
+    ------
+    ValueError
+        If the montage would exceed MAX_MONTAGE_PIXELS
+    """
+    check_montage_size([tile.shape[:2] for tile in tiles], columns, gap)
+    rows, columns = montage_grid(len(tiles), columns)
+    tile_height = max(tile.shape[0] for tile in tiles)
+    tile_width = max(tile.shape[1] for tile in tiles)
+    cell_height, cell_width = tile_height + gap, tile_width + gap
+
+    cells = np.zeros((rows * columns, cell_height, cell_width), dtype=np.uint8)
+    for index, tile in enumerate(tiles):
+        cells[index, :tile.shape[0], :tile.shape[1]] = tile
+    grid = cells.reshape(rows, columns, cell_height, cell_width).transpose(0, 2, 1, 3)
+    # Drop the gap after the last row and column
+    montage = grid.reshape(rows * cell_height, columns * cell_width)[:-gap or None, :-gap or None]
+
+    if labels:
+        image = Image.fromarray(np.ascontiguousarray(montage))
+        draw = ImageDraw.Draw(image)
+        font = _label_font(tile_height)
+        for index, label in enumerate(labels):
+            row, column = divmod(index, columns)
+            x, y = column * cell_width, row * cell_height
+            left, top, right, bottom = draw.textbbox((x + 2, y + 2), label, font=font)
+            draw.rectangle((x, y, right + 2, bottom + 2), fill=0)
+            draw.text((x + 2, y + 2), label, fill=255, font=font)
+        montage = np.asarray(image)
+    return montage
+
+
+def render_montage(
+    tiles: List[np.ndarray],
+    labels: Optional[List[str]] = None,
+    columns: Optional[int] = None,
+    gap: int = 4,
+    encoding: str = "png-fast",
+    quality: int = 90,
+) -> EncodedPage:
+    """Assemble a montage and encode it in one of MONTAGE_ENCODINGS"""
+    return encode_array(assemble_montage(tiles, labels, columns, gap), encoding, quality)
@@ -0,0 +1,136 @@
+"""
+The full pipelines bundled with httomo_backends, parsed once and indexed by
+backend, rebuilt only when the pipeline directory changes.
+"""
+import hashlib
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional, Set
+
+from utils.methods import METHOD_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+# Backend providing the GPU implementations
+GPU_BACKEND = "httomolibgpu"
+# Backend whose pipelines are hidden unless asked for
+TOMOPY_BACKEND = "tomopy"
+
+
+def _pipelines_dir() -> str:
+    # Imported on first use so that starting the app does not load httomo_backends
+    from httomo_backends.scripts.json_pipelines_generator import PIPELINES_DIR
+    return PIPELINES_DIR
+
+
+def pipelines_fingerprint(directory: str) -> str:
+    """
+    Fingerprint the pipeline directives and the priority file from their
+    names, sizes and modification times, without reading them.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith((".yaml", ".yml", ".json")):
+            stat = os.stat(os.path.join(directory, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+@dataclass
+class PipelineIndex:
+    """
+    Parsed pipelines in priority order, plus the names of the pipelines
+    using each backend (the first component of a module path) and each
+    method category.
+    """
+    fingerprint: str
+    pipelines: Dict[str, Dict]
+    by_backend: Dict[str, Set[str]]
+    by_category: Dict[str, Set[str]]
+
+    def select(
+        self,
+        include_tomopy: bool = False,
+        gpu_only: bool = False,
+        category: Optional[str] = None,
+    ) -> Dict[str, Dict]:
+        """
+        Return the pipelines matching every filter, in priority order.
+
+        Parameters
+        ----------
+        include_tomopy : bool
+            Keep pipelines with tomopy methods, which are left out by default
+        gpu_only : bool
+            Keep only pipelines running on the GPU backend, i.e. using
+            httomolibgpu and no tomopy methods
+        category : Optional[str]
+            Keep only pipelines with a method of this METHOD_CATEGORIES category
+
+        Raises
+        ------
+        KeyError
+            If the category does not exist
+        """
+        names: Optional[Set[str]] = None
+        if category is not None:
+            names = set(self.by_category[category])
+        if gpu_only:
+            gpu = self.by_backend.get(GPU_BACKEND, set()) - self.by_backend.get(TOMOPY_BACKEND, set())
+            names = gpu if names is None else names & gpu
+        excluded = set() if include_tomopy else self.by_backend.get(TOMOPY_BACKEND, set())
+        return {
+            name: methods for name, methods in self.pipelines.items()
+            if name not in excluded and (names is None or name in names)
+        }
+
+
+def build_pipeline_index(fingerprint: str, pipelines: Dict[str, Dict]) -> PipelineIndex:
+    """Index parsed pipelines by backend and by method category"""
+    category_methods = {
+        category: {(module, method) for module, methods in module_methods.items() for method in methods}
+        for category, module_methods in METHOD_CATEGORIES.items()
+    }
+    by_backend: Dict[str, Set[str]] = {}
+    by_category: Dict[str, Set[str]] = {category: set() for category in METHOD_CATEGORIES}
+    for name, methods in pipelines.items():
+        for method_name, method in methods.items():
+            module_path = method.get("module_path", "")
+            by_backend.setdefault(module_path.split(".")[0], set()).add(name)
+            for category, members in category_methods.items():
+                if (module_path, method_name) in members:
+                    by_category[category].add(name)
+    return PipelineIndex(fingerprint, pipelines, by_backend, by_category)
+
+
+class PipelineCatalog:
+    """
+    Keeps the index of the bundled pipelines, checking the fingerprint of the
+    pipeline directory on every access and re-parsing only when it changed.
+    """
+
+    def __init__(self):
+        self._index: Optional[PipelineIndex] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> PipelineIndex:
+        """
+        Return the current index. Parsing imports the pipeline methods, so
+        call this from a thread.
+        """
+        directory = _pipelines_dir()
+        fingerprint = pipelines_fingerprint(directory)
+        index = self._index
+        if index is not None and index.fingerprint == fingerprint:
+            return index
+        with self._lock:
+            if self._index is None or self._index.fingerprint != fingerprint:
+                from httomo_backends.scripts.json_pipelines_generator import process_all_yaml_files
+                self._index = build_pipeline_index(fingerprint, process_all_yaml_files())
+                logger.info(f"Indexed {len(self._index.pipelines)} pipelines from {directory}")
+            return self._index
+
+
+pipeline_catalog = PipelineCatalog()
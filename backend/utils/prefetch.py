@@ -0,0 +1,351 @@
+"""
+Cache of rendered pages and background jobs that fill it for a whole stack,
+so a viewer stepping through every page finds each one already encoded.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+from utils.config import (
+    PAGE_CACHE_MAX_BYTES,
+    PREFETCH_CHUNK_PAGES,
+    PREFETCH_CONCURRENCY,
+    PREFETCH_MAX_JOBS,
+)
+from utils.admission import BACKGROUND, current_priority
+from utils.lru import ByteLRU
+from utils.metrics import record_cache
+from utils.shared_store import shared_store
+from utils.tiff_descriptor import StackDescriptor
+from utils.tiff_loader import load_pages_source
+from utils.tiff_pages import ENCODINGS, EncodedPage, render_pages
+from utils.workers import ImageWorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Finished jobs kept so late subscribers can still read their outcome
+MAX_FINISHED_JOBS = 64
+# Share of the page cache a prefetch job may fill, leaving room for pages
+# requested directly
+PREFETCH_CACHE_SHARE = 0.75
+
+Window = Optional[Tuple[float, float]]
+
+# Encoded pages by (url, version, page, downsample rate, encoding, quality, window)
+page_cache = ByteLRU(PAGE_CACHE_MAX_BYTES)
+
+
+def page_key(
+    url: str,
+    version: str,
+    page: int,
+    downsample_rate: int,
+    encoding: str,
+    quality: int,
+    window: Window,
+) -> Tuple:
+    return (url, version, page, downsample_rate, encoding, quality, window)
+
+
+async def get_page(key: Tuple, recheck: bool = False) -> Optional[EncodedPage]:
+    """
+    Return a rendered page from the page cache, or from the shared cache
+    when another worker rendered it, keeping it in the page cache after.
+    With recheck only the shared cache is looked at again, uncounted, e.g.
+    after waiting for another worker rendering the page.
+    """
+    if not recheck:
+        encoded = page_cache.get(key)
+        record_cache("page", encoded is not None)
+        if encoded is not None:
+            return encoded
+    if not shared_store.enabled:
+        return None
+    body = await asyncio.to_thread(shared_store.get, ("page", *key), None if recheck else "shared_page")
+    if body is None:
+        return None
+    # The encoding is the fifth part of the key
+    encoded = EncodedPage(body, ENCODINGS[key[4]], 0.0)
+    page_cache.put(key, encoded, len(body))
+    return encoded
+
+
+async def put_page(key: Tuple, encoded: EncodedPage) -> None:
+    """Keep a rendered page in the page cache and the shared cache"""
+    page_cache.put(key, encoded, len(encoded.body))
+    if shared_store.enabled:
+        await asyncio.to_thread(shared_store.put, ("page", *key), encoded.body)
+
+
+class PrefetchLimitError(Exception):
+    """Raised when PREFETCH_MAX_JOBS jobs are already running"""
+
+
+@dataclass
+class PrefetchJob:
+    """
+    A background job rendering every page of one stack version with fixed
+    rendering parameters. ready lists the pages in the order they finished.
+
+    A job renders at most planned pages, as many as fit in its share of the
+    page cache judging by the size of the first pages it renders. A job that
+    could not cover the whole stack finishes as "partial" rather than
+    "complete". Pages evicted from the page cache since they were rendered
+    are not reported as ready.
+    """
+    id: str
+    url: str
+    version: str
+    page_count: int
+    downsample_rate: int
+    encoding: str
+    quality: int
+    norm: str
+    window: Window
+    ready: List[int] = field(default_factory=list)
+    planned: Optional[int] = None
+    status: str = "running"
+    error: Optional[str] = None
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+    _changed: asyncio.Condition = field(default_factory=asyncio.Condition, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status != "running"
+
+    def key(self, page: int) -> Tuple:
+        return page_key(self.url, self.version, page, self.downsample_rate, self.encoding, self.quality, self.window)
+
+    def cached_pages(self) -> List[int]:
+        """The ready pages still in the page cache"""
+        return [page for page in self.ready if self.key(page) in page_cache]
+
+    def to_dict(self) -> Dict:
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        cached = len(self.cached_pages())
+        return {
+            "job": self.id,
+            "url": self.url,
+            "status": self.status,
+            "error": self.error,
+            "ready": cached,
+            "evicted": len(self.ready) - cached,
+            "planned": self.planned if self.planned is not None else self.page_count,
+            "total": self.page_count,
+            "downsample_rate": self.downsample_rate,
+            "format": self.encoding,
+            "quality": self.quality,
+            "norm": self.norm,
+            "elapsed_seconds": end - self.started_at,
+        }
+
+    async def notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def events(self, heartbeat: float = 15.0) -> AsyncIterator[str]:
+        """
+        Yield the job's progress as Server-Sent Events until it finishes.
+
+        A "status" event first lists the pages already ready, then a "page"
+        event follows for every page as it becomes ready, and a final event
+        named after the outcome (complete, partial, failed or cancelled)
+        closes the stream. A comment is sent after heartbeat idle seconds to keep
+        proxies from closing the connection.
+        """
+        sent = len(self.ready)
+        yield _sse("status", {**self.to_dict(), "pages": self.cached_pages()})
+        while True:
+            while sent < len(self.ready):
+                page = self.ready[sent]
+                sent += 1
+                if self.key(page) in page_cache:
+                    yield _sse("page", {"page": page, "ready": sent, "total": self.page_count})
+            if self.finished:
+                yield _sse(self.status, self.to_dict())
+                return
+            idle = False
+            async with self._changed:
+                if sent == len(self.ready) and not self.finished:
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), heartbeat)
+                    except asyncio.TimeoutError:
+                        idle = True
+            if idle:
+                yield ": keep-alive\n\n"
+
+
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _page_order(page_count: int, start: int) -> List[int]:
+    """Every page, from start to the end and then from the beginning"""
+    start = min(max(start, 0), max(page_count - 1, 0))
+    return list(range(start, page_count)) + list(range(start))
+
+
+class PrefetchManager:
+    """
+    Starts, tracks and cancels prefetch jobs. Asking again for a stack and
+    rendering that already has a running or complete job returns that job.
+    """
+
+    def __init__(self, max_jobs: int, chunk_pages: int, concurrency: int):
+        self.max_jobs = max_jobs
+        self.chunk_pages = max(chunk_pages, 1)
+        self.concurrency = max(concurrency, 1)
+        self._jobs: "OrderedDict[str, PrefetchJob]" = OrderedDict()
+
+    def get(self, job_id: str) -> Optional[PrefetchJob]:
+        return self._jobs.get(job_id)
+
+    def running(self) -> int:
+        return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def start(
+        self,
+        client: httpx.AsyncClient,
+        pool: ImageWorkerPool,
+        descriptor: StackDescriptor,
+        downsample_rate: int,
+        encoding: str,
+        quality: int,
+        norm: str,
+        window: Window,
+        start_page: int = 0,
+    ) -> PrefetchJob:
+        """
+        Start prefetching every page of a described stack, or return the
+        matching job that is still running. A finished job is never reused:
+        its pages may have been evicted from the page cache since.
+
+        Raises
+        ------
+        PrefetchLimitError
+            If max_jobs other jobs are running
+        """
+        for job in self._jobs.values():
+            if (
+                (job.url, job.version, job.downsample_rate, job.encoding, job.quality, job.window)
+                == (descriptor.url, descriptor.version, downsample_rate, encoding, quality, window)
+                and not job.finished
+            ):
+                return job
+        if self.running() >= self.max_jobs:
+            raise PrefetchLimitError(f"{self.max_jobs} prefetch jobs are already running")
+
+        job = PrefetchJob(
+            id=uuid.uuid4().hex,
+            url=descriptor.url,
+            version=descriptor.version,
+            page_count=len(descriptor.pages),
+            downsample_rate=downsample_rate,
+            encoding=encoding,
+            quality=quality,
+            norm=norm,
+            window=window,
+        )
+        job.task = asyncio.create_task(self._run(job, client, pool, start_page))
+        self._jobs[job.id] = job
+        self._prune()
+        logger.info(f"Started prefetch job {job.id} for {job.url}: {job.page_count} pages")
+        return job
+
+    def cancel(self, job_id: str) -> Optional[PrefetchJob]:
+        job = self._jobs.get(job_id)
+        if job is not None and job.task is not None and not job.finished:
+            job.task.cancel()
+        return job
+
+    async def shutdown(self) -> None:
+        """Cancel every running job and wait for them to stop"""
+        tasks = [job.task for job in self._jobs.values() if job.task is not None and not job.finished]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[job_id]
+
+    async def _run(self, job: PrefetchJob, client: httpx.AsyncClient, pool: ImageWorkerPool, start_page: int) -> None:
+        # Waits behind request work for fetches and workers, and is never rejected
+        current_priority.set(BACKGROUND)
+        order = _page_order(job.page_count, start_page)
+        todo = []
+        for page in order:
+            if await get_page(job.key(page)) is not None:
+                job.ready.append(page)
+            else:
+                todo.append(page)
+        await job.notify()
+
+        # Fetch and render chunk by chunk, a few chunks at a time, so memory
+        # stays bounded and interactive requests still find free workers
+        semaphore = asyncio.Semaphore(self.concurrency)
+        rendered = [0, 0]
+
+        async def process(pages: List[int]) -> None:
+            async with semaphore:
+                source = await load_pages_source(client, pool, job.url, pages)
+                encoded = await pool.run(
+                    render_pages, source, pages, job.downsample_rate, job.encoding, job.quality, job.window
+                )
+            for page, item in zip(pages, encoded):
+                await put_page(job.key(page), item)
+                job.ready.append(page)
+                rendered[0] += 1
+                rendered[1] += len(item.body)
+            await job.notify()
+
+        try:
+            if todo:
+                # The first page tells how large the pages are, so the job
+                # can stop at the pages that fit instead of evicting its own
+                await process(todo[:1])
+                average = rendered[1] / rendered[0]
+                fit = max(int(page_cache.max_bytes * PREFETCH_CACHE_SHARE / max(average, 1)), 1)
+                if fit < job.page_count:
+                    job.planned = fit
+                    planned = set(order[:fit])
+                    todo = [page for page in todo if page in planned]
+                    logger.info(f"Prefetch job {job.id} limited to {fit} of {job.page_count} pages by the page cache size")
+                async with asyncio.TaskGroup() as group:
+                    for index in range(1, len(todo), self.chunk_pages):
+                        group.create_task(process(todo[index:index + self.chunk_pages]))
+            if job.planned is not None:
+                job.status = "partial"
+                job.error = (
+                    f"Only {job.planned} of {job.page_count} pages fit in the page cache, "
+                    "raise TOMOHUB_PAGE_CACHE_MAX_BYTES to prefetch the whole stack"
+                )
+            else:
+                job.status = "complete"
+            logger.info(f"Prefetch job {job.id} rendered {rendered[0]} pages of {job.url}")
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            logger.info(f"Prefetch job {job.id} cancelled after {len(job.ready)} pages")
+            raise
+        except Exception as e:
+            error = e.exceptions[0] if isinstance(e, ExceptionGroup) else e
+            job.status = "failed"
+            job.error = str(error)
+            logger.error(f"Prefetch job {job.id} failed: {job.error}")
+        finally:
+            job.finished_at = time.monotonic()
+            self._prune()
+            await job.notify()
+
+
+prefetch_manager = PrefetchManager(PREFETCH_MAX_JOBS, PREFETCH_CHUNK_PAGES, PREFETCH_CONCURRENCY)
@@ -0,0 +1,92 @@
+"""
+Multi-resolution pyramids of single TIFF pages, served as fixed-size tiles.
+"""
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+from utils.config import PYRAMID_CACHE_MAX_BYTES
+from utils.lru import ByteLRU
+from utils.tiff_pages import EncodedPage, area_downsample, encode_array, page_window, read_page, to_display
+from utils.tiff_range import TiffSource
+
+
+@dataclass
+class PagePyramid:
+    """
+    8-bit display levels of one page. Level 0 is full resolution and every
+    further level halves both dimensions, down to a single tile.
+    """
+    tile_size: int
+    levels: List[np.ndarray]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(level.nbytes for level in self.levels)
+
+    def describe(self) -> Dict:
+        return {
+            "tile_size": self.tile_size,
+            "levels": [
+                {
+                    "level": index,
+                    "width": level.shape[1],
+                    "height": level.shape[0],
+                    "columns": -(-level.shape[1] // self.tile_size),
+                    "rows": -(-level.shape[0] // self.tile_size),
+                }
+                for index, level in enumerate(self.levels)
+            ],
+        }
+
+
+def build_pyramid(array: np.ndarray, tile_size: int) -> PagePyramid:
+    """
+    Build the display pyramid of a page with area-averaged levels.
+
+    Non 8-bit pages are scaled with the min/max of the full-resolution page,
+    so that tiles from every level share one contrast.
+    """
+    if array.ndim == 3 and array.shape[2] not in (3, 4):
+        array = array[..., 0]
+    window = page_window(array) if array.dtype != np.uint8 else None
+
+    working = array.astype(np.float32) if array.dtype != np.uint8 else array
+    levels = [to_display(working, window)]
+    while max(working.shape[0], working.shape[1]) > tile_size and min(working.shape[0], working.shape[1]) >= 2:
+        working = area_downsample(working, 2)
+        levels.append(to_display(working, window))
+    return PagePyramid(tile_size=tile_size, levels=levels)
+
+
+def build_page_pyramid(source: TiffSource, page: int, tile_size: int) -> PagePyramid:
+    """Decode a page and build its pyramid"""
+    return build_pyramid(read_page(source, page), tile_size)
+
+
+def encode_tile(
+    level: np.ndarray,
+    x: int,
+    y: int,
+    tile_size: int,
+    encoding: str = "png-fast",
+    quality: int = 90,
+) -> EncodedPage:
+    """
+    Encode the tile at column x and row y of a pyramid level. Tiles on the
+    right and bottom edges are smaller than tile_size.
+
+    Raises
+    ------
+    IndexError
+        If the tile lies outside the level
+    """
+    if x < 0 or y < 0 or x * tile_size >= level.shape[1] or y * tile_size >= level.shape[0]:
+        raise IndexError(f"Tile ({x}, {y}) is outside the level")
+    tile = level[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+    return encode_array(np.ascontiguousarray(tile), encoding, quality)
+
+
+# Pyramids keyed by (url, version, page, tile_size)
+pyramid_cache = ByteLRU(PYRAMID_CACHE_MAX_BYTES)
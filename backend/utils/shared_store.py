@@ -0,0 +1,305 @@
+"""
+On-disk cache shared by every worker process serving the app.
+
+Entries are byte strings stored one file per key under a directory that all
+workers point at. Writes go to a temporary file renamed into place, so a
+reader sees either a whole entry or none. A per-key file lock lets a single
+worker fill an entry while the others wait for it instead of repeating the
+work, and the least recently read entries are deleted beyond a byte budget.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Hashable, Iterator, Optional
+
+from utils.config import SHARED_CACHE_DIR, SHARED_CACHE_LOCK_TIMEOUT, SHARED_CACHE_MAX_BYTES
+from utils.metrics import record_cache
+
+try:
+    import fcntl
+except ImportError:  # fcntl is POSIX only; without it locks only cover this process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Set while the current task, or the task that created it, holds an alock
+_holding_lock: ContextVar[bool] = ContextVar("shared_store_holding_lock", default=False)
+
+# Number of lock files keys are spread over
+LOCK_STRIPES = 4096
+# Delay between attempts to take a held lock, growing up to the maximum
+LOCK_POLL_SECONDS = 0.01
+LOCK_POLL_MAX_SECONDS = 0.25
+# Share of the budget written by this process before usage is checked again
+EVICT_CHECK_FRACTION = 16
+# Usage is brought down to this share of the budget when evicting
+EVICT_TARGET = 0.9
+# Temporary files older than this were left by a crashed writer
+STALE_TMP_SECONDS = 3600
+
+
+@dataclass
+class _Stripe:
+    """A lock file held by this process for every coroutine locking one of its keys"""
+    holders: int = 0
+    fd: Optional[int] = None
+    taken: Optional[asyncio.Task] = None
+
+
+def _digest(key: Hashable) -> str:
+    # Keys are tuples of strings, numbers and None, whose repr is the same in every process
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+class SharedStore:
+    """
+    Byte strings by key, readable and writable from several processes.
+
+    Parameters
+    ----------
+    directory : Optional[str]
+        Where entries and lock files live; None disables the store, so gets
+        miss, puts are dropped and locks are no-ops
+    max_bytes : int
+        Disk budget; the least recently read entries are deleted beyond it
+    lock_timeout : float
+        Seconds to wait for another process filling a key before filling it
+        anyway, so a stuck worker cannot hold the others up
+    """
+
+    def __init__(self, directory: Optional[str], max_bytes: int, lock_timeout: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self._written = 0
+        self._stripes: Dict[str, _Stripe] = {}
+        if directory:
+            os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+            os.makedirs(os.path.join(directory, "locks"), exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _path(self, key: Hashable) -> str:
+        digest = _digest(key)
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def get(self, key: Hashable, cache: Optional[str] = "shared") -> Optional[bytes]:
+        """
+        Return the entry for key and mark it as recently used, or None.
+        Reads a file, so call it from a thread for large entries.
+
+        Parameters
+        ----------
+        key : Hashable
+            The entry's key
+        cache : Optional[str]
+            Cache name the lookup is counted under in the cache metrics;
+            None to not count it, e.g. when looking again after a lock wait
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            data = None
+        except OSError as e:
+            logger.warning(f"Could not read shared cache entry {path}: {str(e)}")
+            data = None
+        if cache is not None:
+            record_cache(cache, data is not None)
+        return data
+
+    def put(self, key: Hashable, data: bytes) -> None:
+        """
+        Store an entry atomically, replacing any previous one. Entries larger
+        than the whole budget are not stored. Writes a file, so call it from
+        a thread for large entries.
+        """
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                _remove(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Could not write shared cache entry {path}: {str(e)}")
+            return
+        self._written += len(data)
+        if self._written >= self.max_bytes // EVICT_CHECK_FRACTION:
+            self._written = 0
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Delete the least recently used entries until usage is back under
+        the budget. Only one process evicts at a time; the others skip it.
+
+        Returns
+        -------
+        int
+            The number of bytes deleted
+        """
+        if not self.enabled:
+            return 0
+        with _flock(os.path.join(self.directory, "evict.lock"), timeout=0) as locked:
+            if not locked:
+                return 0
+            entries = []
+            now = time.time()
+            for root, _, files in os.walk(os.path.join(self.directory, "objects")):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if name.endswith(".tmp"):
+                        if now - stat.st_mtime > STALE_TMP_SECONDS:
+                            _remove(path)
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return 0
+            deleted = 0
+            for _, size, path in sorted(entries):
+                if total - deleted <= self.max_bytes * EVICT_TARGET:
+                    break
+                _remove(path)
+                deleted += size
+            logger.info(f"Evicted {deleted} bytes from the shared cache, {total - deleted} bytes left")
+            return deleted
+
+    def _lock_path(self, key: Hashable) -> str:
+        stripe = int(_digest(key)[:8], 16) % LOCK_STRIPES
+        return os.path.join(self.directory, "locks", f"{stripe:04d}.lock")
+
+    @contextmanager
+    def lock(self, key: Hashable) -> Iterator[None]:
+        """
+        Hold the cross-process lock of key, blocking while another process
+        holds it. For threads; use alock on the event loop. The lock file is
+        the key's own rather than a stripe shared with alock, so a thread
+        never waits on a stripe its own process holds; keep it for the few
+        keys locked from threads, such as the method catalog.
+        """
+        if not self.enabled:
+            yield
+            return
+        path = os.path.join(self.directory, "locks", f"{_digest(key)}.lock")
+        with _flock(path, self.lock_timeout) as locked:
+            if not locked:
+                logger.warning(f"Gave up waiting for the shared cache lock of {key}")
+            yield
+
+    @asynccontextmanager
+    async def alock(self, key: Hashable) -> AsyncIterator[None]:
+        """
+        Hold the cross-process lock of key, waiting without blocking the
+        event loop.
+
+        Keys share LOCK_STRIPES lock files. Within this process a stripe is
+        taken once and shared by every coroutine locking one of its keys;
+        identical work within the process is coalesced by SingleFlight
+        instead. Other processes wait until no coroutine here holds it.
+
+        Work done under a lock is not locked again: an alock entered by a
+        task already holding one, or by a task it started, takes no lock
+        file. Two processes taking the same two stripes in opposite orders
+        would otherwise wait on each other until the lock timeout. Entries
+        filled under the outer lock only, such as the byte ranges of a page
+        being rendered, may then be fetched by two processes at once; writes
+        are atomic renames, so either copy is whole.
+        """
+        if not self.enabled or _holding_lock.get():
+            yield
+            return
+        path = self._lock_path(key)
+        stripe = self._stripes.get(path)
+        if stripe is None:
+            stripe = self._stripes[path] = _Stripe()
+            stripe.taken = asyncio.ensure_future(self._take_stripe(path, stripe, key))
+        stripe.holders += 1
+        token = _holding_lock.set(True)
+        try:
+            await asyncio.shield(stripe.taken)
+            yield
+        finally:
+            _holding_lock.reset(token)
+            stripe.holders -= 1
+            if stripe.holders == 0:
+                del self._stripes[path]
+                stripe.taken.cancel()
+                if stripe.fd is not None:
+                    # Closing the file releases the lock
+                    os.close(stripe.fd)
+
+    async def _take_stripe(self, path: str, stripe: _Stripe, key: Hashable) -> None:
+        stripe.fd = _open_lock(path)
+        deadline = time.monotonic() + self.lock_timeout
+        delay = LOCK_POLL_SECONDS
+        while not _try_lock(stripe.fd):
+            if time.monotonic() >= deadline:
+                logger.warning(f"Gave up waiting for the shared cache lock of {key}")
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX_SECONDS)
+
+
+def _open_lock(path: str) -> int:
+    return os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+
+def _try_lock(fd: int) -> bool:
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+@contextmanager
+def _flock(path: str, timeout: float) -> Iterator[bool]:
+    """Hold an exclusive lock on path, yielding False if it was not taken within timeout"""
+    fd = _open_lock(path)
+    try:
+        deadline = time.monotonic() + timeout
+        delay = LOCK_POLL_SECONDS
+        locked = _try_lock(fd)
+        while not locked and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX_SECONDS)
+            locked = _try_lock(fd)
+        yield locked
+    finally:
+        os.close(fd)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+shared_store = SharedStore(SHARED_CACHE_DIR, SHARED_CACHE_MAX_BYTES, SHARED_CACHE_LOCK_TIMEOUT)
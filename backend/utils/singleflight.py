@@ -0,0 +1,83 @@
+"""
+Coalescing of concurrent identical work: the first caller for a key starts
+one task and every caller that arrives while it runs awaits the same task.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from utils.metrics import singleflight_calls
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Share one in-flight task between concurrent calls with the same key.
+
+    Results are not kept once the task finishes; caching stays with the
+    callers. An exception raised by the task is raised in every caller. A
+    caller that is cancelled stops waiting without affecting the others, and
+    the task itself is cancelled only when no caller is left waiting for it.
+
+    Parameters
+    ----------
+    name : str
+        Label of the flight in the tomohub_singleflight_calls_total metric
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.leaders = 0
+        self.followers = 0
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Return the result of fn(), or of the call already running for key.
+
+        Parameters
+        ----------
+        key : Hashable
+            Identifies calls that would produce the same result
+        fn : Callable[[], Awaitable[T]]
+            Starts the work; only called when no call for key is running
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.leaders += 1
+            singleflight_calls.inc(1, self.name, "leader")
+        else:
+            self.followers += 1
+            singleflight_calls.inc(1, self.name, "follower")
+            logger.debug(f"Joined in-flight {self.name} call for {key}")
+
+        self._waiters[key] += 1
+        try:
+            # Shielded so that one caller being cancelled does not cancel the rest
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._tasks.get(key) is task and self._waiters[key] == 1:
+                task.cancel()
+            raise
+        finally:
+            if self._tasks.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+            del self._waiters[key]
+        # Mark the outcome as retrieved even if every caller was cancelled
+        if not task.cancelled():
+            task.exception()
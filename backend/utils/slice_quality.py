@@ -0,0 +1,141 @@
+"""
+Image-quality metrics of reconstructed slices, used to rank the pages of a
+parameter sweep (e.g. centre of rotation) so the best candidates can be
+shown first without looking at every page.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import tifffile
+
+from utils.montage import Roi, crop
+from utils.tiff_pages import _get_page, area_downsample
+from utils.tiff_range import TiffSource
+
+# Metrics and whether a higher score is better. Gradient energy and total
+# variation (mean absolute gradient) both reward sharp edges and fall as a
+# slice blurs; entropy penalises the streaks, arcs and doubled edges left by
+# a wrong centre, which spread the histogram.
+QUALITY_METRICS = {
+    "gradient_energy": True,
+    "entropy": False,
+    "total_variation": True,
+}
+# Ranking by the mean rank of every metric
+COMBINED = "combined"
+
+
+def _stack_scores(stack: np.ndarray, bins: int) -> Dict[str, np.ndarray]:
+    """Score every page of a (pages, height, width) stack scaled to 0-1"""
+    pages = stack.shape[0]
+    dx = np.diff(stack, axis=2)
+    dy = np.diff(stack, axis=1)
+    gradient_energy = np.square(dx).mean(axis=(1, 2)) + np.square(dy).mean(axis=(1, 2))
+    total_variation = np.abs(dx).mean(axis=(1, 2)) + np.abs(dy).mean(axis=(1, 2))
+
+    # One bincount over all pages, each page offset into its own bins
+    indices = np.minimum((stack * bins).astype(np.int64), bins - 1)
+    indices += (np.arange(pages) * bins)[:, None, None]
+    counts = np.bincount(indices.ravel(), minlength=pages * bins).reshape(pages, bins)
+    probabilities = counts / counts.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = -np.where(probabilities > 0, probabilities * np.log2(probabilities), 0).sum(axis=1)
+
+    return {
+        "gradient_energy": gradient_energy,
+        "entropy": entropy,
+        "total_variation": total_variation,
+    }
+
+
+def quality_scores(
+    source: TiffSource,
+    pages: List[int],
+    window: Tuple[float, float],
+    roi: Optional[Roi] = None,
+    downsample_rate: int = 1,
+    bins: int = 256,
+) -> Dict[str, List[float]]:
+    """
+    Compute QUALITY_METRICS for pages of a TIFF.
+
+    Every page is cropped to the roi, downsampled and scaled to 0-1 with the
+    same window, so that scores are comparable between pages and calls.
+    Pages of equal shape are scored together as one stack.
+
+    Parameters
+    ----------
+    source : TiffSource
+        The TIFF bytes, holding at least the pages
+    pages : List[int]
+        The 0-based pages to score
+    window : Tuple[float, float]
+        The values mapped to 0 and 1; values outside are clipped
+    roi : Optional[Roi]
+        (x, y, width, height) in full-resolution pixels
+    downsample_rate : int
+        Area downsampling applied after cropping
+    bins : int
+        Histogram bins of the entropy
+
+    Returns
+    -------
+    Dict[str, List[float]]
+        The scores of each metric, in the order of pages
+
+    Raises
+    ------
+    IndexError
+        If the TIFF has no such page
+    ValueError
+        If the region is outside a page
+    """
+    low, high = window
+    scale = np.float32(1.0 / max(high - low, np.finfo(np.float32).eps))
+    arrays = []
+    with tifffile.TiffFile(source.open()) as tif:
+        for page in pages:
+            array = crop(_get_page(tif, page).asarray(), roi)
+            if array.ndim == 3:
+                array = array.mean(axis=2, dtype=np.float32)
+            array = (area_downsample(array, downsample_rate).astype(np.float32) - np.float32(low)) * scale
+            np.nan_to_num(array, copy=False, nan=0.0)
+            arrays.append(np.clip(array, 0, 1, out=array))
+
+    scores = {name: np.zeros(len(pages)) for name in QUALITY_METRICS}
+    shapes: Dict[Tuple[int, ...], List[int]] = {}
+    for position, array in enumerate(arrays):
+        shapes.setdefault(array.shape, []).append(position)
+    for positions in shapes.values():
+        for name, values in _stack_scores(np.stack([arrays[p] for p in positions]), bins).items():
+            scores[name][positions] = values
+    return {name: values.tolist() for name, values in scores.items()}
+
+
+def rank_pages(scores: Dict[str, List[float]], metric: str = COMBINED) -> List[int]:
+    """
+    Return the positions of the scored pages from best to worst.
+
+    With COMBINED pages are ordered by their mean rank over all metrics;
+    ties keep the page order.
+
+    Raises
+    ------
+    ValueError
+        If the metric is unknown
+    """
+    if metric != COMBINED and metric not in QUALITY_METRICS:
+        raise ValueError(f"metric must be one of {', '.join([COMBINED, *QUALITY_METRICS])}")
+
+    def ranks(name: str) -> np.ndarray:
+        values = np.asarray(scores[name])
+        order = np.argsort(-values if QUALITY_METRICS[name] else values, kind="stable")
+        result = np.empty(len(values))
+        result[order] = np.arange(len(values))
+        return result
+
+    if metric == COMBINED:
+        key = np.mean([ranks(name) for name in QUALITY_METRICS], axis=0)
+    else:
+        key = ranks(metric)
+    return np.argsort(key, kind="stable").tolist()
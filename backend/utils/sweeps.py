@@ -0,0 +1,185 @@
+"""
+YAML output of pipelines, with httomo sweep tags written by the dumper, and
+expansion of parameter sweeps into concrete pipeline variants.
+"""
+import copy
+import itertools
+import math
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import yaml
+
+# Upper bound on the variants generated by one batch request
+MAX_SWEEP_VARIANTS = 1000
+
+
+class Sweep(list):
+    """Parameter values dumped as an httomo !Sweep sequence"""
+
+
+class SweepRange(dict):
+    """A start/stop/step mapping dumped as an httomo !SweepRange"""
+
+
+class SweepDumper(yaml.Dumper):
+    """Dumper writing Sweep and SweepRange values with their httomo tags"""
+
+
+SweepDumper.add_representer(Sweep, lambda dumper, value: dumper.represent_sequence("!Sweep", list(value)))
+SweepDumper.add_representer(SweepRange, lambda dumper, value: dumper.represent_mapping("!SweepRange", dict(value)))
+
+
+def _parameter_owner(entry: Dict[str, Any], param_name: str) -> Dict[str, Any]:
+    """Return the mapping holding a method parameter: its parameters, or the entry itself"""
+    parameters = entry.get("parameters")
+    if isinstance(parameters, dict) and param_name in parameters:
+        return parameters
+    return entry
+
+
+def set_parameter(data: List[Dict[str, Any]], method_id: str, param_name: str, value: Any) -> None:
+    """
+    Set a parameter of the first pipeline entry running method_id, in place.
+
+    Raises
+    ------
+    KeyError
+        If no entry runs method_id or it has no such parameter
+    """
+    for entry in data:
+        if entry.get("method") == method_id:
+            owner = _parameter_owner(entry, param_name)
+            if param_name not in owner:
+                raise KeyError(f"Method {method_id} has no parameter {param_name}")
+            owner[param_name] = value
+            return
+    raise KeyError(f"No method {method_id} in the pipeline")
+
+
+def tag_sweep(data: List[Dict[str, Any]], method_id: str, param_name: str, sweep_type: str) -> None:
+    """
+    Mark a parameter as an httomo sweep, in place, so that the dump writes
+    it as !SweepRange (sweep_type "range", a start/stop/step mapping) or
+    !Sweep (a list of values).
+
+    Raises
+    ------
+    KeyError
+        If no entry runs method_id or it has no such parameter
+    ValueError
+        If the parameter value does not have the shape of its sweep type
+    """
+    for entry in data:
+        if entry.get("method") == method_id:
+            owner = _parameter_owner(entry, param_name)
+            if param_name not in owner:
+                raise KeyError(f"Method {method_id} has no parameter {param_name}")
+            value = owner[param_name]
+            if sweep_type == "range":
+                if not isinstance(value, dict):
+                    raise ValueError(f"Range sweep of {param_name} needs a start/stop/step mapping")
+                owner[param_name] = SweepRange(value)
+            else:
+                if not isinstance(value, list):
+                    raise ValueError(f"Sweep of {param_name} needs a list of values")
+                owner[param_name] = Sweep(value)
+            return
+    raise KeyError(f"No method {method_id} in the pipeline")
+
+
+def dump_pipeline(data: List[Dict[str, Any]]) -> str:
+    """Dump a pipeline to YAML in a single pass, tagging any sweep values"""
+    return yaml.dump(data, Dumper=SweepDumper, sort_keys=False, default_flow_style=False)
+
+
+def expand_range(start: float, stop: float, step: float) -> List[float]:
+    """
+    Return the values of a start/stop/step range with stop excluded, like
+    numpy.arange. Integers stay integers; floats are rounded to suppress
+    accumulated error.
+
+    Raises
+    ------
+    ValueError
+        If step is zero or points away from stop
+    """
+    if step == 0 or (stop - start) * step < 0:
+        raise ValueError(f"Invalid range: start {start}, stop {stop}, step {step}")
+    count = math.ceil((stop - start) / step)
+    if all(isinstance(value, int) for value in (start, stop, step)):
+        return [start + index * step for index in range(count)]
+    return [round(start + index * step, 10) for index in range(count)]
+
+
+def _slug(value: Any) -> str:
+    return re.sub(r"[^A-Za-z0-9.+-]+", "_", str(value)).strip("_")[:40]
+
+
+def pipeline_variants(
+    data: List[Dict[str, Any]],
+    axes: List[Tuple[str, str, List[Any]]],
+    mode: str = "grid",
+    sweep: Optional[Tuple[str, str, str]] = None,
+) -> Iterator[Tuple[str, Dict[str, Any], str]]:
+    """
+    Generate the YAML of every variant of a pipeline.
+
+    Parameters
+    ----------
+    data : List[Dict[str, Any]]
+        The pipeline entries; they are not modified
+    axes : List[Tuple[str, str, List[Any]]]
+        (method id, parameter name, values) of each swept parameter
+    mode : str
+        "grid" for every combination of the axis values, "zip" to pair the
+        n-th values of all axes, which must then have the same length
+    sweep : Optional[Tuple[str, str, str]]
+        (method id, parameter name, sweep type) of a parameter left for
+        httomo to sweep in every variant
+
+    Yields
+    ------
+    Tuple[str, Dict[str, Any], str]
+        A file name stem, the parameter values of the variant keyed by
+        "method.parameter", and the YAML
+
+    Raises
+    ------
+    ValueError
+        If the axes are invalid or there are more than MAX_SWEEP_VARIANTS variants
+    KeyError
+        If an axis names a missing method or parameter
+    """
+    if not axes:
+        raise ValueError("At least one sweep axis is required")
+    if mode == "grid":
+        total = math.prod(len(values) for _, _, values in axes)
+        combinations = itertools.product(*(values for _, _, values in axes))
+    elif mode == "zip":
+        lengths = {len(values) for _, _, values in axes}
+        if len(lengths) != 1:
+            raise ValueError("Zipped sweep axes must have the same number of values")
+        total = lengths.pop()
+        combinations = zip(*(values for _, _, values in axes))
+    else:
+        raise ValueError(f"Unknown sweep mode: {mode}")
+    if total == 0:
+        raise ValueError("The sweep has no values")
+    if total > MAX_SWEEP_VARIANTS:
+        raise ValueError(f"The sweep has {total} variants, at most {MAX_SWEEP_VARIANTS} are allowed")
+
+    width = len(str(total - 1))
+    for index, combination in enumerate(combinations):
+        variant = copy.deepcopy(data)
+        overrides = {}
+        for (method_id, param_name, _), value in zip(axes, combination):
+            set_parameter(variant, method_id, param_name, value)
+            overrides[f"{method_id}.{param_name}"] = value
+        if sweep is not None:
+            tag_sweep(variant, *sweep)
+        stem = "_".join(
+            [str(index).zfill(width)]
+            + [f"{param_name}-{_slug(value)}" for (_, param_name, _), value in zip(axes, combination)]
+        )
+        yield stem, overrides, dump_pipeline(variant)
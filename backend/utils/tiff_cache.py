@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+
+import httpx
+
+from utils.config import (
+    TIFF_CACHE_MAX_BYTES,
+    TIFF_CACHE_TTL,
+    TIFF_CACHE_SPILL_DIR,
+    TIFF_CACHE_SPILL_MAX_BYTES,
+)
+from utils.lru import ByteLRU
+from utils.metrics import record_cache, upstream_bytes
+from utils.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """Raised when the object store answers with an unexpected status code"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class CachedTiff:
+    """A complete upstream object together with the validators it was served with"""
+    url: str
+    data: Optional[bytes]
+    size: int
+    content_type: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+    spill_path: Optional[str] = None
+    cache_status: str = "MISS"
+
+    @property
+    def version(self) -> str:
+        """Identifies this revision of the object, used to key derived results"""
+        return self.etag or self.last_modified or ""
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.monotonic() - self.fetched_at < ttl
+
+
+class TiffCache:
+    """
+    Process-wide cache of upstream TIFF bodies shared by the proxy endpoints.
+
+    Bodies are kept in memory under an LRU byte budget. Entries evicted from
+    memory are spilled to disk when a spill directory is configured. Once an
+    entry is older than the TTL it is revalidated with a conditional GET, so
+    an unchanged object is never downloaded twice.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        spill_dir: Optional[str] = None,
+        spill_max_bytes: int = 0,
+    ):
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self._memory = ByteLRU(max_bytes)
+        self._spilled = ByteLRU(spill_max_bytes) if spill_dir else None
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._flight = SingleFlight("tiff")
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    async def fetch(self, client: httpx.AsyncClient, url: str) -> CachedTiff:
+        """
+        Return the complete body of url, from the cache when possible.
+
+        Parameters
+        ----------
+        client : httpx.AsyncClient
+            The client used for any upstream request
+        url : str
+            The object store URL
+
+        Returns
+        -------
+        CachedTiff
+            The cached object with its data loaded into memory
+
+        Raises
+        ------
+        UpstreamError
+            If the object store answers with anything other than 200 or 304
+        """
+        entry = self._memory.get(url)
+        if entry is not None and entry.is_fresh(self.ttl):
+            self.hits += 1
+            record_cache("tiff", True)
+            return replace(entry, cache_status="HIT")
+        # Concurrent misses for the same URL share one download
+        return await self._flight.do(url, lambda: self._fetch(client, url))
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str) -> CachedTiff:
+        entry = await self._lookup(url)
+        if entry is not None and entry.is_fresh(self.ttl):
+            self.hits += 1
+            record_cache("tiff", True)
+            return replace(entry, cache_status="HIT")
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        response = await client.get(url, headers=headers)
+
+        if entry is not None and response.status_code == 304:
+            self.revalidations += 1
+            record_cache("tiff", True)
+            entry = replace(entry, fetched_at=time.monotonic())
+            await self._store(entry)
+            return replace(entry, cache_status="REVALIDATED")
+
+        if response.status_code != 200:
+            logger.error(f"Failed to fetch {url}: {response.status_code}")
+            raise UpstreamError(
+                response.status_code,
+                f"Failed to fetch file: {response.status_code}"
+            )
+
+        return await self.store_response(url, response)
+
+    async def store_response(self, url: str, response: httpx.Response) -> CachedTiff:
+        """Cache a complete 200 response that was fetched outside of fetch()"""
+        self.misses += 1
+        record_cache("tiff", False)
+        upstream_bytes.inc(len(response.content), "full")
+        entry = CachedTiff(
+            url=url,
+            data=response.content,
+            size=len(response.content),
+            content_type=response.headers.get("content-type", "image/tiff"),
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+            fetched_at=time.monotonic(),
+        )
+        await self._store(entry)
+        logger.info(f"Cached {url}, size: {entry.size} bytes")
+        return entry
+
+    def contains(self, url: str) -> bool:
+        """
+        Whether url was fetched whole before and is still held, in memory or
+        spilled to disk, fresh or not. fetch() then serves it, revalidating
+        it upstream with a conditional GET if it is older than the TTL.
+        """
+        return url in self._memory or (self._spilled is not None and url in self._spilled)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "memory_bytes": self._memory.current_bytes,
+            "memory_entries": len(self._memory),
+            "spilled_bytes": self._spilled.current_bytes if self._spilled else 0,
+            "spilled_entries": len(self._spilled) if self._spilled else 0,
+        }
+
+    async def _lookup(self, url: str) -> Optional[CachedTiff]:
+        entry = self._memory.get(url)
+        if entry is not None:
+            return entry
+        if self._spilled is None:
+            return None
+        spilled = self._spilled.pop(url)
+        if spilled is None:
+            return None
+        try:
+            data = await asyncio.to_thread(_read_file, spilled.spill_path)
+        except OSError as e:
+            logger.warning(f"Dropping unreadable spilled entry for {url}: {str(e)}")
+            return None
+        finally:
+            _remove_file(spilled.spill_path)
+        entry = replace(spilled, data=data, spill_path=None)
+        await self._store(entry)
+        return entry
+
+    async def _store(self, entry: CachedTiff) -> None:
+        for _, evicted in self._memory.put(entry.url, entry, entry.size):
+            await self._spill(evicted)
+
+    async def _spill(self, entry: CachedTiff) -> None:
+        if self._spilled is None or entry.data is None:
+            return
+        path = os.path.join(self.spill_dir, hashlib.sha256(entry.url.encode()).hexdigest())
+        try:
+            await asyncio.to_thread(_write_file, path, entry.data)
+        except OSError as e:
+            logger.warning(f"Could not spill {entry.url} to disk: {str(e)}")
+            return
+        spilled = replace(entry, data=None, spill_path=path)
+        for _, dropped in self._spilled.put(entry.url, spilled, entry.size):
+            _remove_file(dropped.spill_path)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _remove_file(path: Optional[str]) -> None:
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+tiff_cache = TiffCache(
+    max_bytes=TIFF_CACHE_MAX_BYTES,
+    ttl=TIFF_CACHE_TTL,
+    spill_dir=TIFF_CACHE_SPILL_DIR,
+    spill_max_bytes=TIFF_CACHE_SPILL_MAX_BYTES,
+)
@@ -0,0 +1,148 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import tifffile
+
+from utils.config import DESCRIPTOR_CACHE_MAX_BYTES, TIFF_CACHE_TTL
+from utils.lru import ByteLRU
+from utils.tiff_range import IfdInfo, TiffSource
+from utils.tiff_stats import StackStats
+
+# Pillow mode names reported for backwards compatible metadata
+PILLOW_MODES = {
+    ("uint8", 1): "L",
+    ("uint8", 3): "RGB",
+    ("uint8", 4): "RGBA",
+    ("uint16", 1): "I;16",
+    ("int32", 1): "I",
+    ("float32", 1): "F",
+}
+
+
+@dataclass
+class PageInfo:
+    """Structure of one page, read from its IFD alone"""
+    shape: Tuple[int, ...]
+    dtype: str
+    bits_per_sample: int
+    samples_per_pixel: int
+    compression: str
+    data_offsets: Tuple[int, ...]
+    data_byte_counts: Tuple[int, ...]
+
+    def to_dict(self) -> Dict:
+        return {
+            "shape": list(self.shape),
+            "dtype": self.dtype,
+            "bits_per_sample": self.bits_per_sample,
+            "samples_per_pixel": self.samples_per_pixel,
+            "compression": self.compression,
+            "data_offsets": list(self.data_offsets),
+            "data_byte_counts": list(self.data_byte_counts),
+        }
+
+
+@dataclass
+class StackDescriptor:
+    """
+    Everything known about a multi-page TIFF without reading its pixel data:
+    the per-page structure plus the raw header and IFD bytes, so that later
+    page requests only need to fetch the page data itself.
+    """
+    url: str
+    version: str
+    size: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    pages: List[PageInfo]
+    ifds: List[IfdInfo]
+    ifd_segments: List[Tuple[int, bytes]]
+    fetched_at: float = field(default_factory=time.monotonic)
+    # Stack-wide statistics, computed on the first request that needs them
+    stats: Optional[StackStats] = None
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            sum(len(data) for _, data in self.ifd_segments)
+            + sum(64 + 16 * len(page.data_offsets) for page in self.pages)
+            + (self.stats.nbytes if self.stats is not None else 0)
+        )
+
+    def data_bytes(self, pages: Iterable[int]) -> int:
+        """Return the size of the pixel data of the given pages, as stored in the file"""
+        return sum(sum(self.pages[page].data_byte_counts) for page in pages if 0 <= page < len(self.pages))
+
+    def to_metadata(self, detailed: bool = False) -> Dict:
+        first = self.pages[0] if self.pages else None
+        height, width = (first.shape[0], first.shape[1]) if first else (0, 0)
+        metadata = {
+            "page_count": len(self.pages),
+            "width": width,
+            "height": height,
+            "format": "TIFF",
+            "mode": PILLOW_MODES.get((first.dtype, first.samples_per_pixel), first.dtype) if first else None,
+            "dtype": first.dtype if first else None,
+            "bits_per_sample": first.bits_per_sample if first else None,
+            "compression": first.compression if first else None,
+            "size": self.size,
+        }
+        if detailed:
+            metadata["pages"] = [page.to_dict() for page in self.pages]
+        return metadata
+
+
+def describe_pages(source: TiffSource) -> List[PageInfo]:
+    """
+    Parse every IFD of a TIFF with tifffile. Only the header and IFD bytes
+    need to be present in source; no pixel data is read.
+    """
+    pages = []
+    with tifffile.TiffFile(source.open()) as tif:
+        for page in tif.pages:
+            pages.append(PageInfo(
+                shape=tuple(int(n) for n in page.shape),
+                dtype=str(page.dtype),
+                bits_per_sample=int(page.bitspersample),
+                samples_per_pixel=int(page.samplesperpixel),
+                compression=page.compression.name,
+                data_offsets=tuple(int(n) for n in page.dataoffsets),
+                data_byte_counts=tuple(int(n) for n in page.databytecounts),
+            ))
+    return pages
+
+
+class DescriptorCache:
+    """
+    Stack descriptors keyed by URL, trusted for the TTL and afterwards only
+    reused when the object store still reports the same version.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.ttl = ttl
+        self._entries = ByteLRU(max_bytes)
+
+    def get(self, url: str, version: Optional[str] = None) -> Optional[StackDescriptor]:
+        """
+        Return the descriptor for url. Without a version only a fresh
+        descriptor is returned; with one, any descriptor of that version.
+        """
+        descriptor = self._entries.get(url)
+        if descriptor is None:
+            return None
+        if version is None:
+            return descriptor if time.monotonic() - descriptor.fetched_at < self.ttl else None
+        if version and descriptor.version == version:
+            descriptor.fetched_at = time.monotonic()
+            return descriptor
+        return None
+
+    def put(self, descriptor: StackDescriptor) -> None:
+        self._entries.put(descriptor.url, descriptor, descriptor.nbytes)
+
+    def invalidate(self, url: str) -> None:
+        self._entries.pop(url)
+
+
+descriptor_cache = DescriptorCache(DESCRIPTOR_CACHE_MAX_BYTES, TIFF_CACHE_TTL)
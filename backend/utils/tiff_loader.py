@@ -0,0 +1,240 @@
+"""
+Loading of remote TIFF stacks for the proxy endpoints, choosing between the
+shared TIFF cache, cached stack descriptors and HTTP Range requests.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from utils.config import (
+    STACK_STATS_BINS,
+    STACK_STATS_EXACT,
+    STACK_STATS_MAX_PAGES,
+    STACK_STATS_PERCENTILES,
+    STACK_STATS_SAMPLE_PIXELS,
+)
+from utils.admission import BACKGROUND, current_priority
+from utils.metrics import record_cache
+from utils.singleflight import SingleFlight
+from utils.tiff_cache import CachedTiff, UpstreamError, tiff_cache
+from utils.tiff_descriptor import StackDescriptor, describe_pages, descriptor_cache
+from utils.tiff_range import RangeTiffReader, RangeNotSupported, TiffSource
+from utils.tiff_stats import PagesSummary, StackStats, combine_stack_stats, refine_extrema, sample_pages, summarise_pages
+from utils.workers import ImageWorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Pages fetched and read together when computing stack statistics
+STACK_STATS_CHUNK_PAGES = 64
+
+# Background passes refining stack min/max to exact values, by (url, version)
+stack_stats_refinements: Dict[Tuple[str, str], asyncio.Task] = {}
+
+# Describing a stack and computing its statistics, shared by concurrent requests
+descriptor_flight = SingleFlight("descriptor")
+stack_stats_flight = SingleFlight("stack_stats")
+
+
+async def load_descriptor(client: httpx.AsyncClient, pool: ImageWorkerPool, url: str) -> StackDescriptor:
+    """
+    Return the stack descriptor of the TIFF at url, walking only its IFD chain.
+
+    A fresh cached descriptor is returned without any request. After the TTL
+    a single probe request checks whether the object changed. Concurrent
+    calls for the same URL share one description.
+    """
+    descriptor = descriptor_cache.get(url)
+    if descriptor is not None:
+        record_cache("descriptor", True)
+        return descriptor
+    return await descriptor_flight.do(url, lambda: _describe(client, pool, url))
+
+
+async def _cached_file(client: httpx.AsyncClient, url: str) -> Optional[CachedTiff]:
+    """
+    Return the whole file from the TIFF cache, revalidated if needed, when
+    it was downloaded whole before, e.g. because the object store does not
+    serve Range requests for it; None otherwise.
+    """
+    if not tiff_cache.contains(url):
+        return None
+    return await tiff_cache.fetch(client, url)
+
+
+async def _describe(client: httpx.AsyncClient, pool: ImageWorkerPool, url: str) -> StackDescriptor:
+    cached = await _cached_file(client, url)
+    if cached is not None:
+        reader = RangeTiffReader.from_bytes(url, cached.data, cached.etag, cached.last_modified)
+    else:
+        reader = RangeTiffReader(client, url)
+        try:
+            await reader.open()
+        except RangeNotSupported as e:
+            logger.info(f"Range requests unsupported for {url}, downloading whole file")
+            cached = await tiff_cache.store_response(url, e.response)
+            reader = RangeTiffReader.from_bytes(url, cached.data, cached.etag, cached.last_modified)
+        else:
+            descriptor = descriptor_cache.get(url, reader.version)
+            if descriptor is not None:
+                record_cache("descriptor", True)
+                return descriptor
+
+    record_cache("descriptor", False)
+
+    await reader.load_ifds()
+    segments = reader.ifd_segments()
+    pages = await pool.run(describe_pages, TiffSource(size=reader.size, segments=segments))
+    descriptor = StackDescriptor(
+        url=url,
+        version=reader.version,
+        size=reader.size,
+        etag=reader.etag,
+        last_modified=reader.last_modified,
+        pages=pages,
+        ifds=reader.ifds,
+        ifd_segments=segments,
+    )
+    descriptor_cache.put(descriptor)
+    logger.info(f"Described {url}: {len(pages)} pages, {descriptor.nbytes} descriptor bytes")
+    return descriptor
+
+
+async def load_pages_source(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    pages: List[int],
+) -> TiffSource:
+    """
+    Return the TIFF bytes holding everything needed to decode the given pages.
+
+    Uses the TIFF cache when it already holds the whole file. Otherwise the
+    stack descriptor supplies the IFD bytes and page offsets, and only the
+    page data is fetched with Range requests.
+
+    Raises
+    ------
+    IndexError
+        If the TIFF is missing any of the pages
+    """
+    for attempt in range(2):
+        cached = await _cached_file(client, url)
+        if cached is not None:
+            return TiffSource.from_bytes(cached.data)
+
+        descriptor = await load_descriptor(client, pool, url)
+        cached = await _cached_file(client, url)
+        if cached is not None:
+            return TiffSource.from_bytes(cached.data)
+
+        reader = RangeTiffReader.from_ifds(
+            client, url, descriptor.size, descriptor.etag, descriptor.last_modified,
+            descriptor.ifds, descriptor.ifd_segments,
+        )
+        try:
+            await reader.load_pages(pages)
+        except UpstreamError as e:
+            # 412 means the object changed since it was described
+            if e.status_code != 412 or attempt:
+                raise
+            logger.info(f"{url} changed upstream, describing it again")
+            descriptor_cache.invalidate(url)
+            continue
+        logger.info(f"Fetched {len(pages)} page(s) with range requests, size: {reader.fetched_bytes} bytes")
+        return reader.source()
+
+
+async def load_stack_stats(client: httpx.AsyncClient, pool: ImageWorkerPool, url: str) -> StackStats:
+    """
+    Return the stack-wide statistics of the TIFF at url.
+
+    The statistics are computed from up to STACK_STATS_MAX_PAGES evenly
+    spaced pages, so min and max of larger stacks are approximate. With
+    STACK_STATS_EXACT, a background pass then reads the other pages and
+    replaces them with exact values; requests never wait for it. The
+    statistics are stored on the stack descriptor, so they are reused until
+    the object changes upstream. Concurrent calls for the same version share
+    one computation.
+    """
+    descriptor = await load_descriptor(client, pool, url)
+    record_cache("stack_stats", descriptor.stats is not None)
+    if descriptor.stats is not None:
+        return descriptor.stats
+    return await stack_stats_flight.do(
+        (url, descriptor.version), lambda: _compute_stack_stats(client, pool, url, descriptor)
+    )
+
+
+async def _compute_stack_stats(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    descriptor: StackDescriptor,
+) -> StackStats:
+    page_count = len(descriptor.pages)
+    sampled = sample_pages(page_count, STACK_STATS_MAX_PAGES)
+    per_page = max(STACK_STATS_SAMPLE_PIXELS // max(len(sampled), 1), 1)
+    semaphore = asyncio.Semaphore(pool.max_workers)
+
+    async def summarise(chunk: List[int]) -> PagesSummary:
+        async with semaphore:
+            source = await load_pages_source(client, pool, url, chunk)
+            return await pool.run(summarise_pages, source, chunk, frozenset(chunk), per_page)
+
+    chunks = [sampled[i:i + STACK_STATS_CHUNK_PAGES] for i in range(0, len(sampled), STACK_STATS_CHUNK_PAGES)]
+    summaries = await asyncio.gather(*(summarise(chunk) for chunk in chunks))
+    stats = await pool.run(
+        combine_stack_stats, page_count, sampled, summaries, STACK_STATS_BINS, STACK_STATS_PERCENTILES,
+    )
+    _store_stack_stats(url, descriptor, stats)
+    logger.info(f"Computed stack statistics for {url} from {len(sampled)} of {page_count} pages")
+    key = (url, descriptor.version)
+    if STACK_STATS_EXACT and not stats.exact and key not in stack_stats_refinements:
+        stack_stats_refinements[key] = asyncio.create_task(_refine_stack_stats(client, pool, url, descriptor, stats))
+    return stats
+
+
+async def _refine_stack_stats(
+    client: httpx.AsyncClient,
+    pool: ImageWorkerPool,
+    url: str,
+    descriptor: StackDescriptor,
+    stats: StackStats,
+) -> None:
+    """Read the pages left out of stats one chunk at a time and store exact min/max"""
+    # Waits behind request work for fetches and workers, and is never rejected
+    current_priority.set(BACKGROUND)
+    sampled = set(stats.pages)
+    rest = [page for page in range(stats.page_count) if page not in sampled]
+    try:
+        summaries = []
+        for i in range(0, len(rest), STACK_STATS_CHUNK_PAGES):
+            chunk = rest[i:i + STACK_STATS_CHUNK_PAGES]
+            source = await load_pages_source(client, pool, url, chunk)
+            summaries.append(await pool.run(summarise_pages, source, chunk, frozenset(), 1))
+        if descriptor.stats is stats:
+            _store_stack_stats(url, descriptor, refine_extrema(stats, summaries))
+            logger.info(f"Refined stack statistics for {url} to exact min/max over {stats.page_count} pages")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not refine stack statistics for {url}: {str(e)}")
+    finally:
+        stack_stats_refinements.pop((url, descriptor.version), None)
+
+
+def _store_stack_stats(url: str, descriptor: StackDescriptor, stats: StackStats) -> None:
+    descriptor.stats = stats
+    if descriptor_cache.get(url, descriptor.version) is descriptor:
+        # Store again so the cache accounts for the statistics
+        descriptor_cache.put(descriptor)
+
+
+async def cancel_stack_stats_refinements() -> None:
+    """Cancel the background min/max passes and wait for them to stop"""
+    tasks = list(stack_stats_refinements.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,243 @@
+"""
+CPU-bound TIFF work. Everything here is synchronous and takes picklable
+arguments so it can run in the image worker pool.
+"""
+import json
+import struct
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+from utils.tiff_range import TiffSource
+
+
+def read_page(source: TiffSource, page: int) -> np.ndarray:
+    """
+    Decode a single page of a (possibly partially fetched) TIFF file.
+
+    Parameters
+    ----------
+    source : TiffSource
+        The TIFF bytes, holding at least the IFD chain up to the page and the page data
+    page : int
+        The 0-based page index
+
+    Returns
+    -------
+    np.ndarray
+        The page pixels
+
+    Raises
+    ------
+    IndexError
+        If the TIFF has no such page
+    """
+    with tifffile.TiffFile(source.open()) as tif:
+        return _get_page(tif, page).asarray()
+
+
+def _get_page(tif: tifffile.TiffFile, page: int) -> tifffile.TiffPage:
+    if page < 0:
+        raise IndexError(f"Page {page} not found")
+    try:
+        return tif.pages[page]
+    except IndexError:
+        raise IndexError(f"Page {page} not found")
+
+
+def area_downsample(array: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Downsample the first two axes by an integer factor, averaging each
+    factor x factor block. Trailing rows and columns that do not fill a
+    block are dropped. The result keeps the input dtype.
+    """
+    if factor <= 1:
+        return array
+    height, width = array.shape[0] // factor, array.shape[1] // factor
+    if height == 0 or width == 0:
+        raise ValueError(f"Downsample rate {factor} is larger than the page")
+    blocks = array[:height * factor, :width * factor].reshape(
+        (height, factor, width, factor) + array.shape[2:]
+    )
+    averaged = blocks.mean(axis=(1, 3), dtype=np.float32)
+    if np.issubdtype(array.dtype, np.integer):
+        averaged = np.rint(averaged)
+    return averaged.astype(array.dtype)
+
+
+# Output encodings of the page endpoints and their media types
+ENCODINGS = {
+    "png": "image/png",
+    "png-fast": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "raw-uint8": "application/octet-stream",
+    "raw-uint16": "application/octet-stream",
+    "raw-float16": "application/octet-stream",
+}
+
+# Header of the raw encodings: magic, dtype code, channels, reserved, height, width
+RAW_HEADER = struct.Struct("<4sBBHII")
+RAW_MAGIC = b"TRAW"
+RAW_DTYPE_CODES = {"uint8": 1, "uint16": 2, "float16": 3}
+
+
+@dataclass
+class EncodedPage:
+    """An encoded page together with the time spent encoding it"""
+    body: bytes
+    media_type: str
+    encode_seconds: float
+
+
+def page_window(array: np.ndarray) -> Tuple[float, float]:
+    """Return the min/max of a page, ignoring NaN in float pages"""
+    if array.dtype.kind == "f":
+        return float(np.nanmin(array)), float(np.nanmax(array))
+    return float(array.min()), float(array.max())
+
+
+def to_display(array: np.ndarray, window: Optional[Tuple[float, float]] = None) -> np.ndarray:
+    """
+    Convert page pixels to 8-bit for display by linearly mapping window to
+    0-255 and clipping everything outside it. Without a window 8-bit pages
+    are returned unchanged and other pages are stretched to their own min/max.
+    """
+    if window is None:
+        if array.dtype == np.uint8:
+            return array
+        window = page_window(array)
+    low, high = window
+    scale = np.float32(255.0 / max(high - low, np.finfo(np.float32).eps))
+    scaled = (array.astype(np.float32) - np.float32(low)) * scale
+    if array.dtype.kind == "f":
+        np.nan_to_num(scaled, copy=False, nan=0.0)
+    return np.clip(scaled, 0, 255, out=scaled).astype(np.uint8)
+
+
+def encode_raw(array: np.ndarray, dtype: str) -> bytes:
+    """
+    Encode pixels as a RAW_HEADER followed by little-endian samples of the
+    given dtype, for rendering straight onto a canvas on the client.
+    """
+    if dtype == "uint16" and array.dtype != np.uint16:
+        array = np.clip(np.rint(array) if array.dtype.kind == "f" else array, 0, 65535)
+    pixels = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<"))
+    channels = pixels.shape[2] if pixels.ndim == 3 else 1
+    header = RAW_HEADER.pack(RAW_MAGIC, RAW_DTYPE_CODES[dtype], channels, 0, pixels.shape[0], pixels.shape[1])
+    return header + pixels.tobytes()
+
+
+def encode_array(
+    array: np.ndarray,
+    encoding: str = "png",
+    quality: int = 90,
+    window: Optional[Tuple[float, float]] = None,
+) -> EncodedPage:
+    """
+    Encode page pixels in one of ENCODINGS.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The page pixels, already downsampled
+    encoding : str
+        png is an optimised RGB PNG, png-fast a quickly compressed PNG, webp
+        lossless WebP and jpeg a JPEG of the given quality. The raw-* encodings
+        return a RAW_HEADER and the samples as uint8 (display scaled), uint16 or float16.
+    quality : int
+        JPEG quality, 1-100
+    window : Optional[Tuple[float, float]]
+        The (low, high) values mapped to black and white by the 8-bit
+        encodings. Defaults to the min/max of the page.
+
+    Returns
+    -------
+    EncodedPage
+        The encoded body, its media type and the encode time
+    """
+    started = time.perf_counter()
+    if encoding == "raw-uint16":
+        body = encode_raw(array, "uint16")
+    elif encoding == "raw-float16":
+        body = encode_raw(array, "float16")
+    else:
+        display = to_display(array, window)
+        if encoding == "raw-uint8":
+            body = encode_raw(display, "uint8")
+        else:
+            img = Image.fromarray(display)
+            buffer = BytesIO()
+            if encoding == "png":
+                # Convert to RGB if necessary (TIFF might be in different modes)
+                if img.mode not in ('RGB', 'RGBA'):
+                    img = img.convert('RGB')
+                img.save(buffer, format='PNG', optimize=True)
+            elif encoding == "png-fast":
+                img.save(buffer, format='PNG', compress_level=1)
+            elif encoding == "webp":
+                img.save(buffer, format='WEBP', lossless=True, method=0)
+            elif encoding == "jpeg":
+                img.save(buffer, format='JPEG', quality=quality)
+            else:
+                raise ValueError(f"Unknown encoding: {encoding}")
+            body = buffer.getvalue()
+    return EncodedPage(body, ENCODINGS[encoding], time.perf_counter() - started)
+
+
+def render_page(
+    source: TiffSource,
+    page: int,
+    downsample_rate: int = 1,
+    encoding: str = "png",
+    quality: int = 90,
+    window: Optional[Tuple[float, float]] = None,
+) -> EncodedPage:
+    """Decode one page, downsample it and encode it"""
+    return encode_array(area_downsample(read_page(source, page), downsample_rate), encoding, quality, window)
+
+
+def render_pages(
+    source: TiffSource,
+    pages: List[int],
+    downsample_rate: int = 1,
+    encoding: str = "png",
+    quality: int = 90,
+    window: Optional[Tuple[float, float]] = None,
+) -> List[EncodedPage]:
+    """Decode and encode several pages, parsing the TIFF structure only once"""
+    results = []
+    with tifffile.TiffFile(source.open()) as tif:
+        for page in pages:
+            array = area_downsample(_get_page(tif, page).asarray(), downsample_rate)
+            results.append(encode_array(array, encoding, quality, window))
+    return results
+
+
+def pack_pages(pages: List[int], encoded: List[EncodedPage], meta: Optional[dict] = None) -> bytes:
+    """
+    Pack encoded pages into a single binary body.
+
+    The body starts with a little-endian uint32 giving the length of a UTF-8
+    JSON index, followed by the index and then the page bodies back to back.
+    Each index entry gives the page number, its media type and the offset and
+    length of its body, counted from the end of the index. Any meta fields
+    are added to the top level of the index.
+    """
+    entries = []
+    offset = 0
+    for page, item in zip(pages, encoded):
+        entries.append({
+            "page": page,
+            "media_type": item.media_type,
+            "offset": offset,
+            "length": len(item.body),
+        })
+        offset += len(item.body)
+    index = json.dumps({"pages": entries, **(meta or {})}).encode("utf-8")
+    return b"".join([struct.pack("<I", len(index)), index, *(item.body for item in encoded)])
@@ -0,0 +1,471 @@
+import asyncio
+import bisect
+import io
+import logging
+import re
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import httpx
+
+from utils.metrics import upstream_bytes
+from utils.shared_store import shared_store
+from utils.singleflight import SingleFlight
+from utils.tiff_cache import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# Size of the first request, which normally covers the header and first IFD
+PROBE_BYTES = 64 * 1024
+# Initial read size for every further IFD
+IFD_WINDOW_BYTES = 4 * 1024
+# Ranges closer together than this are fetched with a single request
+MERGE_GAP_BYTES = 64 * 1024
+# Number of IFDs fetched ahead when the IFD chain has a constant stride
+READAHEAD_IFDS = 32
+# Maximum number of range requests in flight for a single reader
+MAX_CONCURRENT_RANGES = 8
+
+# Identical range requests in flight, shared between readers
+range_flight = SingleFlight("range")
+
+# Byte size of each TIFF field type
+TIFF_TYPE_SIZES = {
+    1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2,
+    9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8,
+}
+TIFF_INT_FORMATS = {3: "H", 4: "I", 13: "I", 16: "Q"}
+
+STRIP_OFFSETS, STRIP_BYTE_COUNTS = 273, 279
+TILE_OFFSETS, TILE_BYTE_COUNTS = 324, 325
+
+
+class MissingRangeError(IOError):
+    """Raised when a read touches bytes that were never fetched"""
+
+
+class RangeNotSupported(Exception):
+    """Raised when the object store ignores Range headers and sends the whole body"""
+
+    def __init__(self, response: httpx.Response):
+        super().__init__("Range requests are not supported by the object store")
+        self.response = response
+
+
+class SparseFile(io.RawIOBase):
+    """
+    Read-only, seekable file over a set of byte ranges fetched from a larger object.
+
+    Reading bytes outside the fetched ranges raises MissingRangeError, so a
+    decoder such as tifffile can only ever see data that was requested for it.
+    """
+
+    def __init__(self, size: int, segments: List[Tuple[int, bytes]]):
+        super().__init__()
+        self._size = size
+        self._segments = _merge_segments(segments)
+        self._starts = [start for start, _ in self._segments]
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        wanted = min(len(view), max(0, self._size - self._position))
+        copied = 0
+        while copied < wanted:
+            position = self._position + copied
+            index = bisect.bisect_right(self._starts, position) - 1
+            if index < 0:
+                raise MissingRangeError(f"Byte {position} was not fetched")
+            start, data = self._segments[index]
+            if position >= start + len(data):
+                raise MissingRangeError(f"Byte {position} was not fetched")
+            chunk = data[position - start:position - start + wanted - copied]
+            view[copied:copied + len(chunk)] = chunk
+            copied += len(chunk)
+        self._position += copied
+        return copied
+
+
+def _merge_segments(segments: List[Tuple[int, bytes]]) -> List[Tuple[int, bytes]]:
+    """Combine overlapping or touching segments so that every byte lives in exactly one"""
+    merged: List[Tuple[int, bytes]] = []
+    for start, data in sorted(segments, key=lambda segment: segment[0]):
+        if merged and start <= merged[-1][0] + len(merged[-1][1]):
+            previous_start, previous = merged[-1]
+            overlap = previous_start + len(previous) - start
+            if overlap < len(data):
+                merged[-1] = (previous_start, previous + data[overlap:])
+        else:
+            merged.append((start, data))
+    return merged
+
+
+@dataclass
+class TiffSource:
+    """
+    Picklable description of the TIFF bytes available for decoding, either the
+    whole file or the ranges fetched for some of its pages.
+    """
+    size: int
+    segments: List[Tuple[int, bytes]]
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TiffSource":
+        return cls(size=len(data), segments=[(0, data)])
+
+    def open(self) -> BinaryIO:
+        if len(self.segments) == 1 and self.segments[0][0] == 0 and len(self.segments[0][1]) == self.size:
+            return io.BytesIO(self.segments[0][1])
+        return SparseFile(self.size, self.segments)
+
+
+@dataclass
+class IfdInfo:
+    """Location of one IFD, its out-of-line tag values and the pixel data of its page"""
+    offset: int
+    spans: List[Tuple[int, int]] = field(default_factory=list)
+    data_ranges: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def end(self) -> int:
+        return max(end for _, end in self.spans)
+
+
+class RangeTiffReader:
+    """
+    Reads the parts of a remote TIFF that are needed for a page using HTTP Range requests.
+
+    The header and IFD chain are fetched in small ranges, followed by the strip
+    or tile ranges of the requested page only. The fetched bytes are exposed
+    as a TiffSource that tifffile can decode.
+
+    Parameters
+    ----------
+    client : httpx.AsyncClient
+        The client used for the range requests
+    url : str
+        The object store URL
+    """
+
+    def __init__(self, client: httpx.AsyncClient, url: str):
+        self.client = client
+        self.url = url
+        self.size = 0
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.ifds: List[IfdInfo] = []
+        self._seen_offsets = set()
+        self._segments: Dict[int, bytes] = {}
+        self._next_ifd = 0
+        self._byteorder = "<"
+        self._bigtiff = False
+        self._semaphore = asyncio.Semaphore(MAX_CONCURRENT_RANGES)
+
+    async def open(self) -> None:
+        """
+        Fetch the TIFF header and learn the object size and validators.
+
+        Raises
+        ------
+        RangeNotSupported
+            If the object store answered with the whole body
+        """
+        response = await self.client.get(
+            self.url, headers={"Range": f"bytes=0-{PROBE_BYTES - 1}"}
+        )
+        if response.status_code == 200:
+            raise RangeNotSupported(response)
+        if response.status_code != 206:
+            raise UpstreamError(
+                response.status_code,
+                f"Failed to fetch TIFF file: {response.status_code}"
+            )
+        match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("content-range", ""))
+        if match is None:
+            raise RangeNotSupported(response)
+
+        self.size = int(match.group(1))
+        self.etag = response.headers.get("etag")
+        self.last_modified = response.headers.get("last-modified")
+        upstream_bytes.inc(len(response.content), "range")
+        self._segments[0] = response.content
+        self._parse_header(response.content[:16])
+
+    @classmethod
+    def from_bytes(
+        cls,
+        url: str,
+        data: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> "RangeTiffReader":
+        """Create a reader over a TIFF that is already fully in memory"""
+        reader = cls(None, url)
+        reader.size = len(data)
+        reader.etag = etag
+        reader.last_modified = last_modified
+        reader._segments[0] = data
+        reader._parse_header(data[:16])
+        return reader
+
+    @classmethod
+    def from_ifds(
+        cls,
+        client: httpx.AsyncClient,
+        url: str,
+        size: int,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        ifds: List[IfdInfo],
+        segments: List[Tuple[int, bytes]],
+    ) -> "RangeTiffReader":
+        """
+        Create a reader from a previously walked IFD chain, so that only page
+        data remains to be fetched.
+        """
+        reader = cls(client, url)
+        reader.size = size
+        reader.etag = etag
+        reader.last_modified = last_modified
+        reader.ifds = list(ifds)
+        reader._segments = dict(segments)
+        return reader
+
+    def ifd_segments(self) -> List[Tuple[int, bytes]]:
+        """
+        Return just the header and IFD bytes (including out-of-line tag values)
+        of the walked chain, which is all tifffile needs to parse the structure.
+        """
+        header_size = 16 if self._bigtiff else 8
+        spans = [(0, header_size)] + [span for ifd in self.ifds for span in ifd.spans]
+        merged: List[List[int]] = []
+        for start, end in sorted(spans):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        file = self.source().open()
+        segments = []
+        for start, end in merged:
+            file.seek(start)
+            segments.append((start, file.read(min(end, self.size) - start)))
+        return segments
+
+    def _parse_header(self, header: bytes) -> None:
+        if header[:2] == b"II":
+            self._byteorder = "<"
+        elif header[:2] == b"MM":
+            self._byteorder = ">"
+        else:
+            raise ValueError("Not a TIFF file")
+        magic = struct.unpack(self._byteorder + "H", header[2:4])[0]
+        self._bigtiff = magic == 43
+        if self._bigtiff:
+            self._next_ifd = struct.unpack(self._byteorder + "Q", header[8:16])[0]
+        else:
+            self._next_ifd = struct.unpack(self._byteorder + "I", header[4:8])[0]
+
+    @property
+    def version(self) -> str:
+        return self.etag or self.last_modified or ""
+
+    async def load_ifds(self, count: Optional[int] = None) -> List[IfdInfo]:
+        """
+        Walk the IFD chain until count IFDs are known, or to its end when count is None.
+        """
+        while self._next_ifd and (count is None or len(self.ifds) < count):
+            offset = self._next_ifd
+            if offset >= self.size or offset in self._seen_offsets:
+                logger.warning(f"Stopping at invalid IFD offset {offset} in {self.url}")
+                break
+            if not self._has_range(offset, offset + 8):
+                await self._fetch_ranges(self._readahead_ranges(offset))
+            self._seen_offsets.add(offset)
+            ifd, self._next_ifd = await self._parse_ifd(offset)
+            self.ifds.append(ifd)
+        return self.ifds
+
+    async def load_page(self, page: int) -> None:
+        """
+        Fetch everything tifffile needs to decode one page.
+
+        Raises
+        ------
+        IndexError
+            If the TIFF has no such page
+        """
+        await self.load_pages([page])
+
+    async def load_pages(self, pages: List[int]) -> None:
+        """
+        Fetch everything tifffile needs to decode several pages, with the page
+        data of all of them requested concurrently.
+
+        Raises
+        ------
+        IndexError
+            If the TIFF is missing any of the pages
+        """
+        await self.load_ifds(max(pages) + 1)
+        for page in pages:
+            if page < 0 or page >= len(self.ifds):
+                raise IndexError(f"Page {page} not found")
+        await self._fetch_ranges([r for page in pages for r in self.ifds[page].data_ranges])
+
+    @property
+    def fetched_bytes(self) -> int:
+        return sum(len(data) for data in self._segments.values())
+
+    def source(self) -> TiffSource:
+        return TiffSource(size=self.size, segments=list(self._segments.items()))
+
+    async def _parse_ifd(self, offset: int) -> Tuple[IfdInfo, int]:
+        count_format, entry_size, pointer_format = (
+            ("Q", 20, "Q") if self._bigtiff else ("H", 12, "I")
+        )
+        count_size = struct.calcsize(count_format)
+        pointer_size = struct.calcsize(pointer_format)
+
+        count = struct.unpack(self._byteorder + count_format, await self._read(offset, count_size))[0]
+        entries_start = offset + count_size
+        entries_end = entries_start + count * entry_size
+        table = await self._read(entries_start, count * entry_size + pointer_size)
+        next_offset = struct.unpack(
+            self._byteorder + pointer_format, table[count * entry_size:]
+        )[0]
+
+        # Fetch every value that does not fit inside its entry
+        out_of_line = []
+        entries = []
+        for i in range(count):
+            entry = table[i * entry_size:(i + 1) * entry_size]
+            tag, field_type = struct.unpack(self._byteorder + "HH", entry[:4])
+            value_count, value = struct.unpack(
+                self._byteorder + ("QQ" if self._bigtiff else "II"), entry[4:]
+            )
+            value_size = TIFF_TYPE_SIZES.get(field_type, 1) * value_count
+            inline = value_size <= pointer_size
+            entries.append((tag, field_type, value_count, entry[4 + pointer_size:], value, inline))
+            if not inline:
+                out_of_line.append((value, value + value_size))
+        await self._fetch_ranges(out_of_line)
+
+        values = {}
+        for tag, field_type, value_count, raw, value, inline in entries:
+            if tag not in (STRIP_OFFSETS, STRIP_BYTE_COUNTS, TILE_OFFSETS, TILE_BYTE_COUNTS):
+                continue
+            if field_type not in TIFF_INT_FORMATS:
+                continue
+            item_format = TIFF_INT_FORMATS[field_type]
+            if not inline:
+                raw = await self._read(value, struct.calcsize(item_format) * value_count)
+            values[tag] = struct.unpack(
+                f"{self._byteorder}{value_count}{item_format}",
+                raw[:struct.calcsize(item_format) * value_count]
+            )
+
+        offsets = values.get(STRIP_OFFSETS) or values.get(TILE_OFFSETS) or ()
+        byte_counts = values.get(STRIP_BYTE_COUNTS) or values.get(TILE_BYTE_COUNTS) or ()
+        data_ranges = [
+            (start, start + length)
+            for start, length in zip(offsets, byte_counts)
+            if length
+        ]
+        spans = [(offset, entries_end + pointer_size)] + out_of_line
+        return IfdInfo(offset=offset, spans=spans, data_ranges=data_ranges), next_offset
+
+    def _readahead_ranges(self, offset: int) -> List[Tuple[int, int]]:
+        """
+        Predict where the next IFDs are. Stacks written by tifffile and most
+        acquisition software place IFDs at a constant stride, so once two
+        consecutive IFDs agree on it the following ones are fetched together.
+        """
+        window = IFD_WINDOW_BYTES
+        if self.ifds:
+            window = max(window, self.ifds[-1].end - self.ifds[-1].offset)
+        ranges = [(offset, offset + window)]
+        if len(self.ifds) >= 2:
+            stride = offset - self.ifds[-1].offset
+            if stride > 0 and stride == self.ifds[-1].offset - self.ifds[-2].offset:
+                for i in range(1, READAHEAD_IFDS):
+                    start = offset + i * stride
+                    if start >= self.size:
+                        break
+                    ranges.append((start, start + window))
+        return ranges
+
+    def _has_range(self, start: int, end: int) -> bool:
+        end = min(end, self.size)
+        for segment_start, data in self._segments.items():
+            if segment_start <= start and end <= segment_start + len(data):
+                return True
+        return False
+
+    async def _read(self, start: int, length: int) -> bytes:
+        end = min(start + length, self.size)
+        if not self._has_range(start, end):
+            await self._fetch_ranges([(start, end)])
+        for segment_start, data in self._segments.items():
+            if segment_start <= start and end <= segment_start + len(data):
+                return data[start - segment_start:end - segment_start]
+        raise MissingRangeError(f"Bytes {start}-{end} were not fetched")
+
+    async def _fetch_ranges(self, ranges: List[Tuple[int, int]]) -> None:
+        merged: List[List[int]] = []
+        ranges = [(s, min(e, self.size)) for s, e in ranges if s < self.size]
+        for start, end in sorted(r for r in ranges if not self._has_range(*r)):
+            if merged and start - merged[-1][1] <= MERGE_GAP_BYTES:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        await asyncio.gather(*(self._fetch_range(start, end) for start, end in merged))
+
+    async def _fetch_range(self, start: int, end: int) -> None:
+        # Readers of the same object needing the same bytes share one request
+        key = (self.url, self.etag, start, end)
+        self._segments[start] = await range_flight.do(key, lambda: self._get_range(start, end))
+
+    async def _get_range(self, start: int, end: int) -> bytes:
+        if not self.etag or not shared_store.enabled:
+            return await self._request_range(start, end)
+        # The bytes of one version never change, so other workers can reuse
+        # them, and only one worker at a time requests a given range
+        key = ("range", self.url, self.etag, start, end)
+        async with shared_store.alock(key):
+            data = await asyncio.to_thread(shared_store.get, key, "shared_range")
+            if data is None:
+                data = await self._request_range(start, end)
+                await asyncio.to_thread(shared_store.put, key, data)
+        return data
+
+    async def _request_range(self, start: int, end: int) -> bytes:
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        if self.etag:
+            headers["If-Match"] = self.etag
+        async with self._semaphore:
+            response = await self.client.get(self.url, headers=headers)
+        if response.status_code != 206:
+            raise UpstreamError(
+                response.status_code,
+                f"Failed to fetch TIFF range: {response.status_code}"
+            )
+        upstream_bytes.inc(len(response.content), "range")
+        return response.content
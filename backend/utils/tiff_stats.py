@@ -0,0 +1,192 @@
+"""
+Stack-wide intensity statistics, computed once per TIFF and cached with its
+stack descriptor so that every page can be rescaled with the same window.
+"""
+from dataclasses import dataclass, replace
+from typing import Collection, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import tifffile
+
+from utils.tiff_pages import _get_page
+from utils.tiff_range import TiffSource
+
+# Display normalisations accepted by the page endpoints
+NORMALISATIONS = ("page", "stack", "percentile")
+
+
+@dataclass
+class StackStats:
+    """
+    Intensity statistics of a stack, read from the sampled pages. min and max
+    are exact when every page was read, otherwise approximate until refined
+    by refine_extrema; the percentiles and histogram come from a strided
+    pixel sample.
+    """
+    page_count: int
+    pages: Tuple[int, ...]
+    min: float
+    max: float
+    exact: bool
+    percentiles: Dict[float, float]
+    histogram: np.ndarray
+    bin_edges: np.ndarray
+
+    @property
+    def nbytes(self) -> int:
+        return self.histogram.nbytes + self.bin_edges.nbytes + 64 + 8 * len(self.pages)
+
+    def window(self, norm: str) -> Tuple[float, float]:
+        """Return the (low, high) display window of a stack-wide normalisation"""
+        if norm == "stack":
+            return self.min, self.max
+        if norm == "percentile":
+            levels = sorted(self.percentiles)
+            return self.percentiles[levels[0]], self.percentiles[levels[-1]]
+        raise ValueError(f"Normalisation {norm} is not stack-wide")
+
+    def to_dict(self) -> Dict:
+        return {
+            "pages": self.page_count,
+            "sampled_pages": len(self.pages),
+            "exact": self.exact,
+            "min": self.min,
+            "max": self.max,
+            "percentiles": {str(level): value for level, value in self.percentiles.items()},
+            "histogram": {
+                "counts": self.histogram.tolist(),
+                "bin_edges": self.bin_edges.tolist(),
+            },
+        }
+
+
+def sample_pages(page_count: int, max_pages: int) -> List[int]:
+    """Return up to max_pages page indices spread evenly over the stack"""
+    if page_count <= max_pages:
+        return list(range(page_count))
+    return sorted(set(np.linspace(0, page_count - 1, max_pages).round().astype(int).tolist()))
+
+
+@dataclass
+class PagesSummary:
+    """Min, max and pixel sample of some pages, merged into StackStats by combine_stack_stats"""
+    min: Optional[float]
+    max: Optional[float]
+    samples: List[np.ndarray]
+
+
+def summarise_pages(
+    source: TiffSource,
+    pages: Sequence[int],
+    sampled: Collection[int],
+    per_page: int,
+) -> PagesSummary:
+    """
+    Read the given pages in one pass over their pixels.
+
+    Every page contributes to the min/max, which costs one reduction per
+    decoded page; pages in sampled also contribute an evenly strided sample
+    of per_page pixels for the percentiles and histogram. Non-finite
+    float values are ignored. Multi-sample pages use their first channel.
+
+    Parameters
+    ----------
+    source : TiffSource
+        The TIFF bytes, holding at least the IFDs and data of the pages
+    pages : Sequence[int]
+        The 0-based page indices to read
+    sampled : Collection[int]
+        The pages whose pixels are sampled
+    per_page : int
+        The number of pixels sampled from each sampled page
+
+    Returns
+    -------
+    PagesSummary
+        The min and max of the pages, None if they hold no finite values,
+        and the pixel samples
+    """
+    low, high, samples = None, None, []
+    with tifffile.TiffFile(source.open()) as tif:
+        for page in pages:
+            array = _get_page(tif, page).asarray()
+            if array.ndim == 3 and array.shape[2] <= 4:
+                array = array[..., 0]
+            values = array.ravel()
+            if values.dtype.kind == "f":
+                values = values[np.isfinite(values)]
+            if values.size == 0:
+                continue
+            page_low, page_high = float(values.min()), float(values.max())
+            low = page_low if low is None else min(low, page_low)
+            high = page_high if high is None else max(high, page_high)
+            if page in sampled:
+                samples.append(values[::max(values.size // per_page, 1)].astype(np.float64))
+    return PagesSummary(low, high, samples)
+
+
+def combine_stack_stats(
+    page_count: int,
+    sampled: Sequence[int],
+    summaries: Sequence[PagesSummary],
+    bins: int,
+    percentiles: Sequence[float],
+) -> StackStats:
+    """
+    Merge the summaries of the sampled pages of a stack into its statistics.
+    The percentiles and histogram are computed over the concatenated samples
+    in single vectorised calls. min and max are exact only when every page
+    was sampled.
+
+    Parameters
+    ----------
+    page_count : int
+        The number of pages in the stack
+    sampled : Sequence[int]
+        The pages read for the summaries
+    summaries : Sequence[PagesSummary]
+        The summaries from summarise_pages
+    bins : int
+        The number of histogram bins between min and max
+    percentiles : Sequence[float]
+        The percentile levels to compute, in 0-100
+
+    Returns
+    -------
+    StackStats
+        The statistics of the stack
+    """
+    lows = [summary.min for summary in summaries if summary.min is not None]
+    highs = [summary.max for summary in summaries if summary.max is not None]
+    samples = [sample for summary in summaries for sample in summary.samples]
+    exact = len(sampled) >= page_count
+    if not samples:
+        return StackStats(page_count, tuple(sampled), 0.0, 0.0, exact, {level: 0.0 for level in percentiles},
+                          np.zeros(bins, dtype=np.int64), np.zeros(bins + 1))
+
+    sample = np.concatenate(samples)
+    low, high = min(lows), max(highs)
+    levels = list(percentiles)
+    values = np.percentile(sample, levels)
+    histogram, bin_edges = np.histogram(sample, bins=bins, range=(low, high if high > low else low + 1))
+    return StackStats(
+        page_count=page_count,
+        pages=tuple(sampled),
+        min=low,
+        max=high,
+        exact=exact,
+        percentiles={level: float(value) for level, value in zip(levels, values)},
+        histogram=histogram,
+        bin_edges=bin_edges,
+    )
+
+
+def refine_extrema(stats: StackStats, summaries: Sequence[PagesSummary]) -> StackStats:
+    """
+    Return stats with min and max widened to the summaries of the pages that
+    were not sampled, marked exact. The percentiles and histogram keep their
+    sample.
+    """
+    lows = [stats.min] + [summary.min for summary in summaries if summary.min is not None]
+    highs = [stats.max] + [summary.max for summary in summaries if summary.max is not None]
+    return replace(stats, min=min(lows), max=max(highs), exact=True)
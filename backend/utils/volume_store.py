@@ -0,0 +1,246 @@
+"""
+Local store of remote TIFF stacks as uncompressed, memory-mapped volumes.
+
+A stack is written to local disk once, page chunk by page chunk, as a
+contiguous tifffile memmap. Pages, regions and orthogonal reslices are then
+read as NumPy views of the mapping, so only the bytes a slice touches are
+paged in and memory use does not grow with the volume size.
+"""
+import functools
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+import tifffile
+
+from utils.admission import BATCH, current_priority
+from utils.config import VOLUME_STORE_DIR, VOLUME_STORE_MAX_BYTES
+from utils.lru import ByteLRU
+from utils.metrics import record_cache
+from utils.montage import Roi, crop
+from utils.shared_store import shared_store
+from utils.singleflight import SingleFlight
+from utils.tiff_descriptor import StackDescriptor
+from utils.tiff_loader import load_descriptor, load_pages_source
+from utils.tiff_pages import EncodedPage, _get_page, area_downsample, encode_array
+from utils.tiff_range import TiffSource
+from utils.workers import ImageWorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Pages fetched, decoded and written together while building a volume
+BUILD_CHUNK_PAGES = 32
+# Slice axes: z is an XY page, y an XZ reslice and x a YZ reslice
+SLICE_AXES = ("z", "y", "x")
+
+
+@dataclass
+class VolumeInfo:
+    """A stored volume of shape (pages, height, width[, samples])"""
+    url: str
+    version: str
+    path: str
+    shape: Tuple[int, ...]
+    dtype: str
+    build_seconds: float = 0.0
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def to_dict(self) -> Dict:
+        return {
+            "shape": list(self.shape),
+            "axes": "ZYXS"[:len(self.shape)],
+            "dtype": self.dtype,
+            "nbytes": self.nbytes,
+            "build_seconds": self.build_seconds,
+        }
+
+
+@functools.lru_cache(maxsize=16)
+def open_volume(path: str) -> np.memmap:
+    """
+    Map a stored volume read-only. Mappings are kept per worker; a path is
+    only ever written once, so a cached mapping never goes stale.
+    """
+    return tifffile.memmap(path, mode="r")
+
+
+def create_volume(path: str, shape: Tuple[int, ...], dtype: str) -> None:
+    """Create an uncompressed, contiguous TIFF of the given shape to fill in place"""
+    volume = tifffile.memmap(path, shape=shape, dtype=dtype, photometric="minisblack")
+    del volume
+
+
+def write_volume_pages(path: str, source: TiffSource, pages: List[int]) -> None:
+    """Decode pages of a TIFF straight into their place in a volume being built"""
+    volume = tifffile.memmap(path, mode="r+")
+    try:
+        with tifffile.TiffFile(source.open()) as tif:
+            for page in pages:
+                volume[page] = _get_page(tif, page).asarray()
+        volume.flush()
+    finally:
+        del volume
+
+
+def volume_slice(path: str, axis: str, index: int, roi: Optional[Roi] = None) -> np.ndarray:
+    """
+    Return a 2D slice of a stored volume as a view of its mapping.
+
+    Parameters
+    ----------
+    path : str
+        The stored volume
+    axis : str
+        z for the XY page index, y for the XZ reslice at row index and x for
+        the YZ reslice at column index
+    index : int
+        Position along axis
+    roi : Optional[Roi]
+        (x, y, width, height) in the coordinates of the slice
+
+    Raises
+    ------
+    IndexError
+        If index is outside the volume
+    ValueError
+        If the axis is unknown or the region is outside the slice
+    """
+    volume = open_volume(path)
+    if axis not in SLICE_AXES:
+        raise ValueError(f"axis must be one of {', '.join(SLICE_AXES)}")
+    size = volume.shape[SLICE_AXES.index(axis)]
+    if not 0 <= index < size:
+        raise IndexError(f"Slice {index} along {axis} not found, the volume has {size}")
+    if axis == "z":
+        view = volume[index]
+    elif axis == "y":
+        view = volume[:, index]
+    else:
+        view = volume[:, :, index]
+    return crop(view, roi)
+
+
+def render_volume_slice(
+    path: str,
+    axis: str,
+    index: int,
+    roi: Optional[Roi] = None,
+    downsample_rate: int = 1,
+    encoding: str = "png",
+    quality: int = 90,
+    window: Optional[Tuple[float, float]] = None,
+) -> EncodedPage:
+    """Cut a slice from a stored volume, downsample it and encode it"""
+    return encode_array(
+        area_downsample(volume_slice(path, axis, index, roi), downsample_rate), encoding, quality, window
+    )
+
+
+def _volume_path(directory: str, url: str, version: str) -> str:
+    digest = hashlib.sha256(f"{url}\n{version}".encode()).hexdigest()
+    return os.path.join(directory, f"{digest}.tif")
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class VolumeStore:
+    """
+    Stored volumes by URL and object version, under an LRU disk budget.
+    Volumes already on disk from an earlier run are adopted on first use.
+
+    Parameters
+    ----------
+    directory : str
+        Where the volumes are written
+    max_bytes : int
+        Disk budget; the least recently used volumes are deleted beyond it
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self._volumes = ByteLRU(max_bytes)
+        self._flight = SingleFlight("volume")
+
+    async def load(self, client: httpx.AsyncClient, pool: ImageWorkerPool, url: str) -> VolumeInfo:
+        """
+        Return the stored volume of the TIFF at url, building it first if needed.
+
+        Raises
+        ------
+        ValueError
+            If the pages differ in shape or dtype, or the volume is larger than the budget
+        """
+        descriptor = await load_descriptor(client, pool, url)
+        key = (url, descriptor.version)
+        info = self._volumes.get(key)
+        if info is not None and not os.path.exists(info.path):
+            # Deleted by another worker process sharing the directory
+            self._volumes.pop(key)
+            info = None
+        record_cache("volume", info is not None)
+        if info is not None:
+            return info
+        return await self._flight.do(key, lambda: self._open_or_build(pool, client, descriptor))
+
+    async def _open_or_build(self, pool: ImageWorkerPool, client: httpx.AsyncClient, descriptor: StackDescriptor) -> VolumeInfo:
+        shapes = {(page.shape, page.dtype) for page in descriptor.pages}
+        if len(shapes) != 1:
+            raise ValueError("Only stacks whose pages share one shape and dtype can be stored as volumes")
+        (page_shape, dtype), = shapes
+        info = VolumeInfo(
+            url=descriptor.url,
+            version=descriptor.version,
+            path=_volume_path(self.directory, descriptor.url, descriptor.version),
+            shape=(len(descriptor.pages), *page_shape),
+            dtype=dtype,
+        )
+        if info.nbytes > self._volumes.max_bytes:
+            raise ValueError(f"The volume needs {info.nbytes} bytes, more than the store's {self._volumes.max_bytes}")
+
+        # Only one worker process builds a volume; the others adopt it
+        async with shared_store.alock(("volume", info.path)):
+            if os.path.exists(info.path):
+                logger.info(f"Adopting stored volume for {info.url}")
+            else:
+                await self._build(pool, client, info)
+        for _, evicted in self._volumes.put((info.url, info.version), info, info.nbytes):
+            logger.info(f"Deleting stored volume for {evicted.url}")
+            _remove(evicted.path)
+        return info
+
+    async def _build(self, pool: ImageWorkerPool, client: httpx.AsyncClient, info: VolumeInfo) -> None:
+        # Runs in its own task, so this only lowers the priority of the build
+        current_priority.set(BATCH)
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        # Written under a temporary name and renamed when complete, so a
+        # crash never leaves a partial volume behind under the final name
+        partial = f"{info.path}.{os.getpid()}.partial"
+        try:
+            await pool.run(create_volume, partial, info.shape, info.dtype)
+            for first in range(0, info.shape[0], BUILD_CHUNK_PAGES):
+                pages = list(range(first, min(first + BUILD_CHUNK_PAGES, info.shape[0])))
+                source = await load_pages_source(client, pool, info.url, pages)
+                await pool.run(write_volume_pages, partial, source, pages)
+            os.replace(partial, info.path)
+        except BaseException:
+            _remove(partial)
+            raise
+        info.build_seconds = time.perf_counter() - started
+        logger.info(f"Stored {info.url} as a {info.shape} {info.dtype} volume in {info.build_seconds:.2f} s")
+
+
+volume_store = VolumeStore(VOLUME_STORE_DIR, VOLUME_STORE_MAX_BYTES)
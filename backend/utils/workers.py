@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+from starlette.requests import HTTPConnection
+
+from utils.admission import Limiter
+from utils.config import ADMISSION_MAX_WAIT, IMAGE_EXECUTOR, IMAGE_WORKERS, IMAGE_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class ImageWorkerPool:
+    """
+    Runs CPU-bound image work (TIFF decoding, resizing, encoding) off the event loop.
+
+    At most max_workers jobs are handed to the executor at any time. Up to
+    queue_depth further jobs wait their turn in priority order (see
+    utils.admission); beyond that, and after waiting too long, callers are
+    rejected with Overloaded, so a burst of requests cannot queue an
+    unbounded amount of work. Background jobs always wait.
+
+    Parameters
+    ----------
+    kind : str
+        "thread" or "process". Threads suit Pillow, NumPy and zlib, which
+        release the GIL; processes avoid the GIL entirely at the cost of
+        pickling the TIFF bytes to the worker.
+    max_workers : int
+        The number of workers
+    queue_depth : int
+        The number of jobs allowed to wait for a worker
+    """
+
+    def __init__(self, kind: str, max_workers: int, queue_depth: int):
+        if kind == "process":
+            self._executor: Executor = ProcessPoolExecutor(max_workers=max_workers)
+        elif kind == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="image-worker"
+            )
+        else:
+            raise ValueError(f"Unknown image executor: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.admission = Limiter("decode", max_workers, queue_depth, ADMISSION_MAX_WAIT)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run fn(*args) in the pool and return its result
+
+        Raises
+        ------
+        Overloaded
+            If the job was not admitted
+        """
+        async with self.admission.acquire():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(fn, *args))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_image_pool() -> ImageWorkerPool:
+    logger.info(f"Starting {IMAGE_WORKERS} image workers ({IMAGE_EXECUTOR})")
+    return ImageWorkerPool(IMAGE_EXECUTOR, IMAGE_WORKERS, IMAGE_QUEUE_DEPTH)
+
+
+def get_image_pool(connection: HTTPConnection) -> ImageWorkerPool:
+    """FastAPI dependency returning the pool created in the app lifespan, for HTTP and WebSocket routes"""
+    return connection.app.state.image_pool